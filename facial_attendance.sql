@@ -243,6 +243,11 @@ ADD COLUMN description TEXT NULL;
 CREATE INDEX idx_courses_lecturer_id ON courses(lecturer_id);
 CREATE INDEX idx_courses_is_active ON courses(is_active);
 
+-- Track student changes so the encoder gallery syncs incrementally (FaceRecognitionManager::syncGallery)
+ALTER TABLE students
+ADD COLUMN updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP;
+CREATE INDEX idx_students_updated_at ON students(updated_at);
+
 -- Optional: Update existing courses to be active by default (if needed)
 -- UPDATE courses SET is_active = 1 WHERE is_active IS NULL;
 
@@ -5,6 +5,10 @@ class FaceRecognitionManager
     private $debug_mode;
     private $api_base_url;
     private $api_timeout;
+    private $encoding_format;
+    private $recognition_threshold;
+    private $template_capture_threshold;
+    private $resident_gallery;
 
     public function __construct($database_connection, $debug = false, $api_url = 'https://facerecognitionapi-24ec.onrender.com/')
     {
@@ -12,6 +16,10 @@ class FaceRecognitionManager
         $this->debug_mode = $debug;
         $this->api_base_url = rtrim($api_url, '/'); // Remove trailing slash
         $this->api_timeout = 30; // 30 seconds timeout for API calls
+        $this->encoding_format = 'json'; // 'json' float lists, or compact 'f32', 'f16', 'int8'
+        $this->recognition_threshold = 0.6; // 60% similarity required
+        $this->template_capture_threshold = null; // Captures at or above this similarity become gallery templates
+        $this->resident_gallery = null; // Set to false once the service shows it has no usable resident gallery
 
         if ($this->debug_mode) {
             error_log("Face recognition manager initialized with API: " . $this->api_base_url);
@@ -120,10 +128,318 @@ class FaceRecognitionManager
         }
     }
 
+    /**
+     * Queue a registration (student or lecturer) without waiting for face processing
+     *
+     * Returns the job id; poll getRegistrationJobStatus() or pass a callback URL
+     * that receives the finished job as a JSON POST.
+     */
+    public function submitRegistrationJob($image_path, $identifier, $callback_url = null)
+    {
+        if (!file_exists($image_path)) {
+            return [
+                'success' => false,
+                'message' => 'Image file not found: ' . $image_path
+            ];
+        }
+
+        $extra_fields = $callback_url ? ['callback_url' => $callback_url] : [];
+        $response = $this->callFaceRecognitionAPI($image_path, $identifier, '/register/async', $extra_fields);
+
+        if (!$response['success']) {
+            return [
+                'success' => false,
+                'message' => $response['message']
+            ];
+        }
+
+        return [
+            'success' => true,
+            'message' => 'Registration queued',
+            'job_id' => $response['data']['job_id'],
+            'status' => $response['data']['status']
+        ];
+    }
+
+    /**
+     * Status of a queued registration; once done the result matches processStudentRegistration()
+     *
+     * success is false when the job failed (message holds the error); queued and
+     * running jobs are success true without face_encoding_for_db until done.
+     */
+    public function getRegistrationJobStatus($job_id)
+    {
+        $response = $this->callEncoderAPI('/jobs/' . rawurlencode($job_id));
+        if (!$response['success']) {
+            return $response;
+        }
+
+        $result = $response['data'];
+        $job = $result['data'];
+
+        // A failed job reads like a failed synchronous registration: success false, the error as message
+        $status = [
+            'success' => $job['status'] !== 'failed',
+            'job_id' => $job['job_id'],
+            'status' => $job['status'],
+            'message' => $job['error'] ?? $result['message']
+        ];
+
+        // Same shape as a synchronous registration once the job has finished
+        if ($job['status'] === 'done' && !empty($job['result']['data'])) {
+            $data = $job['result']['data'];
+            $status['data'] = $data;
+            $status['face_encoding_for_db'] = isset($data['face_features_json']) ?
+                $data['face_features_json'] :
+                json_encode($data['face_encoding']);
+            $status['face_encoding_array'] = $data['face_encoding'] ?? null;
+        }
+
+        return $status;
+    }
+
+    /**
+     * Bring the encoder's resident gallery up to date with the students table
+     *
+     * Only rows whose updated_at is at or after the gallery's high-water mark are
+     * sent to /gallery/sync. Deactivated students and cleared encodings become
+     * removals. The version is a hash of the stored encoding, so rows touched for
+     * other reasons (a login, rows sharing the mark's second) are skipped by the
+     * gallery instead of re-enrolled. A full catch-up can post the whole table,
+     * so run it from cron (includes/sync_face_gallery.php), not in a web request;
+     * registration uses enrollStudentInGallery() instead.
+     */
+    public function syncGallery($batch_size = 200)
+    {
+        $state = $this->callEncoderAPI('/gallery/sync');
+        if (!$state['success']) {
+            return $state;
+        }
+
+        try {
+            $since = $state['data']['high_water_mark'] ?? '1970-01-01 00:00:01';
+
+            $stmt = $this->conn->prepare("
+                SELECT id, reg_number, face_encoding, is_active, updated_at
+                FROM students
+                WHERE updated_at >= ?
+                ORDER BY updated_at, id
+            ");
+            $stmt->execute([$since]);
+
+            $summary = ['added' => 0, 'removed' => 0, 'unchanged' => 0, 'errors' => []];
+            $changes = [];
+            $mark = $since;
+
+            while (true) {
+                $student = $stmt->fetch(PDO::FETCH_ASSOC);
+
+                if ($student !== false) {
+                    $changes[] = $this->galleryChange($student);
+                    $mark = $student['updated_at'];
+                }
+
+                // Each batch advances the mark, so an interrupted sync resumes where it stopped
+                if (!empty($changes) && ($student === false || count($changes) >= $batch_size)) {
+                    $result = $this->callEncoderAPI('/gallery/sync', [
+                        'changes' => $changes,
+                        'high_water_mark' => $mark
+                    ]);
+                    if (!$result['success']) {
+                        return $result;
+                    }
+                    foreach (['added', 'removed', 'unchanged'] as $key) {
+                        $summary[$key] += $result['data'][$key] ?? 0;
+                    }
+                    $summary['errors'] = array_merge($summary['errors'], $result['data']['errors'] ?? []);
+                    $changes = [];
+                }
+
+                if ($student === false) {
+                    break;
+                }
+            }
+
+            if ($this->debug_mode) {
+                error_log("Gallery sync up to {$mark}: " . json_encode($summary));
+            }
+
+            return [
+                'success' => true,
+                'high_water_mark' => $mark,
+                'data' => $summary
+            ];
+
+        } catch (Exception $e) {
+            return [
+                'success' => false,
+                'message' => 'Gallery sync error: ' . $e->getMessage()
+            ];
+        }
+    }
+
+    /**
+     * Enroll one just-saved student in the resident gallery without a full sync
+     *
+     * Sends that row alone, with a short timeout, and leaves the high-water mark
+     * alone so the cron sync still covers it (its version makes the repeat a
+     * no-op). Skipped while the gallery has never been synced: a store holding
+     * only new registrations would hide everyone else, whereas an unsynced one
+     * makes recognition fall back to the students table.
+     */
+    public function enrollStudentInGallery($student_id, $timeout = 3)
+    {
+        $state = $this->callEncoderAPI('/gallery/sync', null, false, $timeout);
+        if (!$state['success']) {
+            return $state;
+        }
+        if (empty($state['data']['high_water_mark'])) {
+            return [
+                'success' => false,
+                'message' => 'Resident gallery has not been synced yet; left to the cron sync'
+            ];
+        }
+
+        try {
+            $stmt = $this->conn->prepare("
+                SELECT id, reg_number, face_encoding, is_active
+                FROM students
+                WHERE id = ?
+            ");
+            $stmt->execute([$student_id]);
+            $student = $stmt->fetch(PDO::FETCH_ASSOC);
+        } catch (Exception $e) {
+            return [
+                'success' => false,
+                'message' => 'Gallery enrollment error: ' . $e->getMessage()
+            ];
+        }
+
+        if ($student === false) {
+            return [
+                'success' => false,
+                'message' => 'Student not found: ' . $student_id
+            ];
+        }
+
+        return $this->callEncoderAPI('/gallery/sync', [
+            'changes' => [$this->galleryChange($student)]
+        ], false, $timeout);
+    }
+
+    /**
+     * One /gallery/sync change for a students row; the version is a hash of the stored encoding
+     */
+    private function galleryChange($student)
+    {
+        $encoding = $this->decodeStoredEncoding($student['face_encoding']);
+        return [
+            'id' => (int)$student['id'],
+            'reg_number' => $student['reg_number'],
+            'face_encoding' => $encoding,
+            'version' => sha1((string)$student['face_encoding']),
+            'deleted' => !$student['is_active'] || $encoding === null
+        ];
+    }
+
+    /**
+     * Store an accepted capture as an extra template of an enrolled student in the resident gallery
+     *
+     * The gallery keeps a few templates per student (the registration photo is
+     * never evicted) and scores a student over all of them, so recognition
+     * improves with use instead of by re-registering.
+     */
+    public function addFaceTemplate($student_id, $features, $max_templates = 5, $eviction = 'oldest')
+    {
+        $result = $this->callEncoderAPI('/gallery/add-template', [
+            'id' => (int)$student_id,
+            'features' => $features,
+            'source' => 'attendance',
+            'max_templates' => $max_templates,
+            'eviction' => $eviction
+        ]);
+
+        if (!$result['success'] && $this->debug_mode) {
+            error_log("Template capture for student {$student_id} failed: " . $result['message']);
+        }
+
+        return $result;
+    }
+
+    /**
+     * Send one request to the encoder service and decode its JSON reply
+     *
+     * GET without fields, a JSON POST for an array of fields, or a multipart POST
+     * (uploads as CURLFile) when $multipart is set. $timeout overrides the API
+     * timeout in seconds for calls that must not hold up a page. Connection errors, non-200
+     * replies, bodies that are not JSON and "success": false all come back as
+     * ['success' => false, 'message' => ...], keeping the service's message.
+     */
+    private function callEncoderAPI($endpoint, $fields = null, $multipart = false, $timeout = null)
+    {
+        try {
+            $timeout = $timeout ?? $this->api_timeout;
+            $headers = ['Accept: application/json'];
+            $options = [
+                CURLOPT_URL => $this->api_base_url . $endpoint,
+                CURLOPT_RETURNTRANSFER => true,
+                CURLOPT_TIMEOUT => $timeout,
+                CURLOPT_CONNECTTIMEOUT => min(10, $timeout),
+                CURLOPT_SSL_VERIFYPEER => false,
+                CURLOPT_SSL_VERIFYHOST => false,
+            ];
+            if ($fields !== null) {
+                $options[CURLOPT_POST] = true;
+                if ($multipart) {
+                    $options[CURLOPT_POSTFIELDS] = $fields;
+                } else {
+                    $options[CURLOPT_POSTFIELDS] = json_encode($fields);
+                    $headers[] = 'Content-Type: application/json';
+                }
+            }
+            $options[CURLOPT_HTTPHEADER] = $headers;
+
+            $ch = curl_init();
+            curl_setopt_array($ch, $options);
+
+            $response = curl_exec($ch);
+            $http_code = curl_getinfo($ch, CURLINFO_HTTP_CODE);
+            $curl_error = curl_error($ch);
+            curl_close($ch);
+
+            if ($curl_error) {
+                return [
+                    'success' => false,
+                    'message' => 'API connection error: ' . $curl_error
+                ];
+            }
+
+            $result = json_decode($response, true);
+
+            if ($http_code !== 200 || !is_array($result) || empty($result['success'])) {
+                return [
+                    'success' => false,
+                    'message' => $result['message'] ?? $result['error'] ?? ('API returned HTTP ' . $http_code . ': ' . $response)
+                ];
+            }
+
+            return [
+                'success' => true,
+                'data' => $result
+            ];
+
+        } catch (Exception $e) {
+            return [
+                'success' => false,
+                'message' => 'Encoder API error: ' . $e->getMessage()
+            ];
+        }
+    }
+
     /**
      * Call Face Recognition API with proper endpoint mapping
      */
-    private function callFaceRecognitionAPI($image_path, $student_id, $endpoint = '/register')
+    private function callFaceRecognitionAPI($image_path, $student_id, $endpoint = '/register', $extra_fields = [])
     {
         try {
             if ($this->debug_mode) {
@@ -139,6 +455,13 @@ class FaceRecognitionManager
                 'student_id' => $safe_student_id
             ];
 
+            // Ask for the compact encoding only when configured; older API versions ignore it
+            if ($this->encoding_format !== 'json') {
+                $post_data['encoding_format'] = $this->encoding_format;
+            }
+
+            $post_data = array_merge($post_data, $extra_fields);
+
             $ch = curl_init();
             curl_setopt_array($ch, [
                 CURLOPT_URL => $this->api_base_url . $endpoint,
@@ -274,8 +597,11 @@ class FaceRecognitionManager
 
     /**
      * Recognize student for attendance using face comparison
+     *
+     * $course_scope (course_id, session_year, semester) limits the candidates to
+     * students enrolled in that course offering through student_courses.
      */
-    public function recognizeStudentForAttendance($image_path, $reg_number = null)
+    public function recognizeStudentForAttendance($image_path, $reg_number = null, $course_scope = null)
     {
         try {
             if ($this->debug_mode) {
@@ -303,7 +629,9 @@ class FaceRecognitionManager
             // Get the face features from the response
             $incoming_encoding = $face_data['data']['features'] ?? null;
 
-            if (!$incoming_encoding || !is_array($incoming_encoding)) {
+            $incoming_length = $this->getEncodingLength($incoming_encoding);
+
+            if ($incoming_length === 0) {
                 return [
                     'success' => false,
                     'message' => 'No valid face features extracted from image.'
@@ -311,85 +639,43 @@ class FaceRecognitionManager
             }
 
             if ($this->debug_mode) {
-                error_log("Incoming encoding length: " . count($incoming_encoding));
-                error_log("First few values: " . implode(', ', array_slice($incoming_encoding, 0, 5)));
+                error_log("Incoming encoding length: " . $incoming_length);
+                if (is_array($incoming_encoding)) {
+                    error_log("First few values: " . implode(', ', array_slice($incoming_encoding, 0, 5)));
+                }
             }
 
-            // Get all students with face encodings
-            $stmt = $this->conn->prepare("
-                SELECT 
-                    s.*,
-                    d.name as department_name,
-                    f.name as faculty_name
-                FROM students s
-                LEFT JOIN departments d ON s.department_id = d.id
-                LEFT JOIN faculties f ON s.faculty_id = f.id
-                WHERE s.face_encoding IS NOT NULL 
-                AND s.face_encoding != ''
-            ");
-            $stmt->execute();
-            $students = $stmt->fetchAll(PDO::FETCH_ASSOC);
+            // Search the resident gallery; post the students table only when the service has none
+            $resident = $this->identifyInResidentGallery($incoming_encoding, 5, $course_scope);
 
-            if (empty($students)) {
-                return [
-                    'success' => false,
-                    'message' => 'No registered students with face encodings found in database'
-                ];
+            if ($resident['success']) {
+                $comparisons = $resident['comparisons'];
+                $students_checked = $resident['gallery_size'];
+                $recognition_method = 'api_resident_gallery';
+            } else {
+                $inline = $this->compareWithStoredEncodings($incoming_encoding, $incoming_length, $course_scope);
+                if (!$inline['success']) {
+                    return $inline;
+                }
+                $comparisons = $inline['comparisons'];
+                $students_checked = $inline['students_checked'];
+                $recognition_method = 'api_comparison';
             }
 
-            $comparisons = [];
             $best_match = null;
             $highest_similarity = 0;
 
-            foreach ($students as $student) {
-                $stored_encoding = json_decode($student['face_encoding'], true);
+            foreach ($comparisons as $student_comparison) {
+                $similarity = $student_comparison['similarity_score'];
 
-                if (!is_array($stored_encoding)) {
-                    if ($this->debug_mode) {
-                        error_log("Invalid encoding for student: " . $student['reg_number']);
-                    }
-                    continue;
+                if ($this->debug_mode) {
+                    error_log("Student {$student_comparison['reg_number']}: Similarity={$similarity}");
                 }
 
-                if (count($stored_encoding) !== count($incoming_encoding)) {
-                    if ($this->debug_mode) {
-                        error_log("Encoding length mismatch for {$student['reg_number']}: " . 
-                                 count($stored_encoding) . " vs " . count($incoming_encoding));
-                    }
-                    continue;
-                }
-
-                // Use API to compare faces for better accuracy
-                $comparison_result = $this->compareFaceFeatures($incoming_encoding, $stored_encoding);
-                
-                if ($comparison_result['success']) {
-                    $similarity = $comparison_result['data']['similarity_score'];
-                    $student_name = trim($student['surname'] . ' ' . $student['firstname'] . ' ' . $student['middlename']);
-                    
-                    $student_comparison = [
-                        'id' => $student['id'],
-                        'reg_number' => $student['reg_number'],
-                        'full_name' => $student_name,
-                        'department_name' => $student['department_name'] ?? 'Unknown Department',
-                        'faculty_name' => $student['faculty_name'] ?? 'Unknown Faculty',
-                        'department_id' => $student['department_id'],
-                        'faculty_id' => $student['faculty_id'],
-                        'level' => $student['level'],
-                        'similarity_score' => $similarity,
-                        'comparison_details' => $comparison_result['data']
-                    ];
-
-                    $comparisons[] = $student_comparison;
-
-                    if ($this->debug_mode) {
-                        error_log("Student {$student['reg_number']}: Similarity={$similarity}");
-                    }
-
-                    // Track the best match
-                    if ($similarity > $highest_similarity) {
-                        $highest_similarity = $similarity;
-                        $best_match = $student_comparison;
-                    }
+                // Track the best match
+                if ($similarity > $highest_similarity) {
+                    $highest_similarity = $similarity;
+                    $best_match = $student_comparison;
                 }
             }
 
@@ -398,16 +684,30 @@ class FaceRecognitionManager
                 return $b['similarity_score'] <=> $a['similarity_score'];
             });
 
-            // Threshold for recognition (adjustable)
-            $recognition_threshold = 0.6; // 60% similarity required
+            // Threshold for recognition (see setRecognitionThresholds); the resident gallery
+            // decides is_match with the student's calibrated threshold where there is one
+            $recognition_threshold = $this->recognition_threshold;
+            if ($recognition_method === 'api_resident_gallery' && $best_match) {
+                $recognition_threshold = $best_match['comparison_details']['threshold'] ?? $recognition_threshold;
+                $recognized = !empty($best_match['comparison_details']['is_match']);
+            } else {
+                $recognized = $best_match && $highest_similarity >= $recognition_threshold;
+            }
+
+            if ($recognized) {
+                // A confidently recognized capture becomes another template; only the resident gallery
+                // (where the student is enrolled and scored over all templates) can use it
+                if ($recognition_method === 'api_resident_gallery' && $this->template_capture_threshold !== null &&
+                    $highest_similarity >= $this->template_capture_threshold) {
+                    $this->addFaceTemplate($best_match['id'], $incoming_encoding);
+                }
 
-            if ($best_match && $highest_similarity >= $recognition_threshold) {
                 return [
                     'success' => true,
                     'message' => 'Student recognized',
                     'matched_student' => $best_match,
                     'confidence' => round($highest_similarity * 100, 2),
-                    'recognition_method' => 'api_comparison',
+                    'recognition_method' => $recognition_method,
                     'all_comparisons' => array_slice($comparisons, 0, 5) // Top 5 matches
                 ];
             }
@@ -417,7 +717,7 @@ class FaceRecognitionManager
                 'message' => 'No matching student found',
                 'best_similarity' => $highest_similarity,
                 'threshold_used' => $recognition_threshold,
-                'total_students_checked' => count($students),
+                'total_students_checked' => $students_checked,
                 'all_comparisons' => array_slice($comparisons, 0, 5)
             ];
 
@@ -430,6 +730,426 @@ class FaceRecognitionManager
         }
     }
 
+    /**
+     * Recognize every student in one classroom frame (group photo)
+     *
+     * Each detected face is returned with its bounding box and, when recognized,
+     * the matched student. A student is matched to at most one face per frame.
+     */
+    public function recognizeStudentsInGroupFrame($image_path, $course_scope = null, $max_faces = null)
+    {
+        try {
+            if (!file_exists($image_path)) {
+                return [
+                    'success' => false,
+                    'message' => 'Image file not found: ' . $image_path
+                ];
+            }
+
+            $recognition_threshold = $this->recognition_threshold;
+
+            $fields = [
+                'top_k' => 3,
+                'threshold' => $recognition_threshold
+            ];
+            if ($max_faces) {
+                $fields['max_faces'] = $max_faces;
+            }
+
+            // Search the resident gallery first; post the students table only when the service has none
+            $result = null;
+            if ($this->resident_gallery !== false) {
+                $resident_fields = array_merge($fields, [
+                    'aggregate' => 'max',
+                    'calibrated' => '1'
+                ], $this->residentCourseFields($course_scope));
+                if (isset($resident_fields['candidate_ids'])) {
+                    $resident_fields['candidate_ids'] = json_encode($resident_fields['candidate_ids']);
+                }
+
+                $response = $this->callEncoderAPI('/identify-group', $this->withImageUpload($image_path, $resident_fields), true);
+
+                if ($response['success'] && !empty($response['data']['gallery_size'])) {
+                    $this->resident_gallery = true;
+                    $result = $response['data'];
+                    $students_checked = $result['gallery_size'];
+                    $match_key = 'id';
+
+                    $matched_ids = [];
+                    foreach ($result['faces'] as $face) {
+                        if (!empty($face['best_match'])) {
+                            $matched_ids[] = $face['best_match']['id'];
+                        }
+                    }
+                    $gallery_students = $this->getStudentsByIds($matched_ids);
+                } elseif (!$response['success']) {
+                    if ($this->debug_mode) {
+                        error_log("Resident gallery search unavailable: " . $response['message']);
+                    }
+                    $this->resident_gallery = false;
+                }
+            }
+
+            if ($result === null) {
+                $students = $this->getCandidateStudents($course_scope);
+
+                if (empty($students)) {
+                    return [
+                        'success' => false,
+                        'message' => $this->noCandidatesMessage($course_scope)
+                    ];
+                }
+
+                $gallery_students = [];
+                $gallery_encodings = [];
+                foreach ($students as $student) {
+                    $stored_encoding = $this->decodeStoredEncoding($student['face_encoding']);
+                    if ($stored_encoding !== null) {
+                        $gallery_students[] = $student;
+                        $gallery_encodings[] = $stored_encoding;
+                    }
+                }
+
+                $fields['gallery'] = json_encode($gallery_encodings);
+                $response = $this->callEncoderAPI('/identify-group', $this->withImageUpload($image_path, $fields), true);
+
+                if (!$response['success']) {
+                    return [
+                        'success' => false,
+                        'message' => 'Group recognition failed: ' . $response['message']
+                    ];
+                }
+
+                $result = $response['data'];
+                $students_checked = count($gallery_students);
+                $match_key = 'index';
+            }
+
+            $faces = [];
+            $recognized_students = [];
+            foreach ($result['faces'] as $face) {
+                $matched_student = null;
+                if (!empty($face['best_match']) && isset($gallery_students[$face['best_match'][$match_key]])) {
+                    $matched_student = $this->buildStudentComparison(
+                        $gallery_students[$face['best_match'][$match_key]],
+                        $face['best_match']['similarity_score'],
+                        $face['best_match']
+                    );
+                    $recognized_students[] = $matched_student;
+                }
+
+                $faces[] = [
+                    'face_index' => $face['face_index'],
+                    'face_region' => $face['face_region'],
+                    'matched_student' => $matched_student,
+                    'confidence' => $matched_student ? round($matched_student['similarity_score'] * 100, 2) : null
+                ];
+            }
+
+            if ($this->debug_mode) {
+                error_log("Group frame: " . count($faces) . " face(s), " . count($recognized_students) . " recognized");
+            }
+
+            return [
+                'success' => !empty($recognized_students),
+                'message' => count($recognized_students) . ' of ' . count($faces) . ' face(s) recognized',
+                'faces' => $faces,
+                'recognized_students' => $recognized_students,
+                'threshold_used' => $recognition_threshold,
+                'total_students_checked' => $students_checked,
+                'recognition_method' => 'api_group_identification'
+            ];
+
+        } catch (Exception $e) {
+            error_log("Group recognition error: " . $e->getMessage());
+            return [
+                'success' => false,
+                'message' => 'Group recognition failed: ' . $e->getMessage()
+            ];
+        }
+    }
+
+    /**
+     * Multipart fields with the image attached as the 'file' upload
+     */
+    private function withImageUpload($image_path, $fields)
+    {
+        return array_merge([
+            'file' => new CURLFile($image_path, mime_content_type($image_path), basename($image_path))
+        ], $fields);
+    }
+
+    /**
+     * Identify a probe in the encoder's resident gallery, which syncGallery() keeps current
+     *
+     * Students are ranked by their best template and each match carries is_match
+     * under the student's calibrated threshold (face_gallery.py calibrate) when
+     * one exists. Only the matched students are read from the database.
+     * success=false means the service has no usable resident gallery (none
+     * configured, unreachable or never synced) and the caller should fall back
+     * to the students table.
+     */
+    private function identifyInResidentGallery($probe, $top_k = 5, $course_scope = null)
+    {
+        if ($this->resident_gallery === false) {
+            return [
+                'success' => false,
+                'message' => 'Resident gallery unavailable'
+            ];
+        }
+
+        // One entry per student over all their templates, judged by calibrated thresholds where available
+        $request = array_merge([
+            'probe' => $probe,
+            'top_k' => $top_k,
+            'threshold' => $this->recognition_threshold,
+            'aggregate' => 'max',
+            'calibrated' => true
+        ], $this->residentCourseFields($course_scope));
+
+        $response = $this->callEncoderAPI('/identify', $request);
+
+        if (!$response['success']) {
+            if ($this->debug_mode) {
+                error_log("Resident gallery search unavailable: " . $response['message']);
+            }
+            $this->resident_gallery = false;
+            return $response;
+        }
+
+        // Nothing synced (for this course) reads as "no match"; let the students table answer instead
+        if (empty($response['data']['gallery_size'])) {
+            return [
+                'success' => false,
+                'message' => 'No synced students to search; run syncGallery()'
+            ];
+        }
+
+        $this->resident_gallery = true;
+        $matches = $response['data']['matches'];
+        $students = $this->getStudentsByIds(array_column($matches, 'id'));
+
+        $comparisons = [];
+        foreach ($matches as $match) {
+            // Rows the gallery has not caught up on (e.g. a cleared encoding) are skipped
+            if (isset($students[$match['id']])) {
+                $comparisons[] = $this->buildStudentComparison($students[$match['id']], $match['similarity_score'], $match);
+            }
+        }
+
+        return [
+            'success' => true,
+            'comparisons' => $comparisons,
+            'gallery_size' => $response['data']['gallery_size']
+        ];
+    }
+
+    /**
+     * Score a probe against every stored encoding (students table) in one identification call
+     *
+     * Fallback for services without a resident gallery; falls back in turn to
+     * pairwise /compare calls when batched identification is unavailable.
+     */
+    private function compareWithStoredEncodings($incoming_encoding, $incoming_length, $course_scope = null)
+    {
+        // Get students with face encodings, only those enrolled in the course when scoped
+        $students = $this->getCandidateStudents($course_scope);
+
+        if (empty($students)) {
+            return [
+                'success' => false,
+                'message' => $this->noCandidatesMessage($course_scope)
+            ];
+        }
+
+        $comparisons = [];
+
+        // Collect valid encodings into one gallery for batched identification
+        $gallery_students = [];
+        $gallery_encodings = [];
+
+        foreach ($students as $student) {
+            $stored_encoding = $this->decodeStoredEncoding($student['face_encoding']);
+
+            if ($stored_encoding === null) {
+                if ($this->debug_mode) {
+                    error_log("Invalid encoding for student: " . $student['reg_number']);
+                }
+                continue;
+            }
+
+            $stored_length = $this->getEncodingLength($stored_encoding);
+
+            if ($stored_length !== $incoming_length) {
+                if ($this->debug_mode) {
+                    error_log("Encoding length mismatch for {$student['reg_number']}: " . 
+                             $stored_length . " vs " . $incoming_length);
+                }
+                continue;
+            }
+
+            $gallery_students[] = $student;
+            $gallery_encodings[] = $stored_encoding;
+        }
+
+        // Score the whole gallery in one API call
+        $identify_result = empty($gallery_encodings) ? ['success' => false] :
+            $this->identifyFaceFeatures($incoming_encoding, $gallery_encodings, 5);
+
+        if ($identify_result['success']) {
+            foreach ($identify_result['data']['matches'] as $match) {
+                $comparisons[] = $this->buildStudentComparison(
+                    $gallery_students[$match['index']],
+                    $match['similarity_score'],
+                    $match
+                );
+            }
+        } else {
+            if ($this->debug_mode && !empty($gallery_encodings)) {
+                error_log("Batched identification unavailable, falling back to pairwise comparison: " .
+                         ($identify_result['message'] ?? 'unknown error'));
+            }
+
+            foreach ($gallery_students as $i => $student) {
+                // Use API to compare faces for better accuracy
+                $comparison_result = $this->compareFaceFeatures($incoming_encoding, $gallery_encodings[$i]);
+
+                if ($comparison_result['success']) {
+                    $comparisons[] = $this->buildStudentComparison(
+                        $student,
+                        $comparison_result['data']['similarity_score'],
+                        $comparison_result['data']
+                    );
+                }
+            }
+        }
+
+        return [
+            'success' => true,
+            'comparisons' => $comparisons,
+            'students_checked' => count($students)
+        ];
+    }
+
+    /**
+     * Fields scoping a resident gallery search to a course offering ([] when unscoped)
+     *
+     * The candidate ids are read from student_courses on every call, so enrollment
+     * changes apply at once. The course fields name the partition the service
+     * caches those students' rows under; the cached slice is rebuilt whenever the
+     * ids it receives differ, so nothing has to be pushed when student_courses changes.
+     */
+    private function residentCourseFields($course_scope)
+    {
+        if (empty($course_scope['course_id'])) {
+            return [];
+        }
+
+        return [
+            'candidate_ids' => $this->getCourseStudentIds($course_scope),
+            'course_id' => $course_scope['course_id'],
+            'session_year' => $course_scope['session_year'],
+            'semester' => $course_scope['semester']
+        ];
+    }
+
+    /**
+     * Ids of the students enrolled in a course offering (student_courses), without their encodings
+     */
+    private function getCourseStudentIds($course_scope)
+    {
+        $stmt = $this->conn->prepare("
+            SELECT student_id
+            FROM student_courses
+            WHERE course_id = ? AND session_year = ? AND semester = ?
+        ");
+        $stmt->execute([
+            $course_scope['course_id'],
+            $course_scope['session_year'],
+            $course_scope['semester']
+        ]);
+
+        return array_map('intval', $stmt->fetchAll(PDO::FETCH_COLUMN));
+    }
+
+    /**
+     * Student rows (with department and faculty names) for the given ids, keyed by id
+     */
+    private function getStudentsByIds($ids)
+    {
+        $ids = array_values(array_unique(array_map('intval', $ids)));
+        if (empty($ids)) {
+            return [];
+        }
+
+        $placeholders = implode(',', array_fill(0, count($ids), '?'));
+        $stmt = $this->conn->prepare("
+            SELECT 
+                s.*,
+                d.name as department_name,
+                f.name as faculty_name
+            FROM students s
+            LEFT JOIN departments d ON s.department_id = d.id
+            LEFT JOIN faculties f ON s.faculty_id = f.id
+            WHERE s.id IN ({$placeholders})
+            AND s.face_encoding IS NOT NULL 
+            AND s.face_encoding != ''
+        ");
+        $stmt->execute($ids);
+
+        $students = [];
+        foreach ($stmt->fetchAll(PDO::FETCH_ASSOC) as $student) {
+            $students[$student['id']] = $student;
+        }
+        return $students;
+    }
+
+    /**
+     * Students with face encodings, limited to a course offering's enrollment when scoped
+     */
+    private function getCandidateStudents($course_scope = null)
+    {
+        $course_join = '';
+        $params = [];
+        if (!empty($course_scope['course_id'])) {
+            $course_join = "INNER JOIN student_courses sc ON sc.student_id = s.id
+                AND sc.course_id = ? AND sc.session_year = ? AND sc.semester = ?";
+            $params = [
+                $course_scope['course_id'],
+                $course_scope['session_year'],
+                $course_scope['semester']
+            ];
+        }
+
+        $stmt = $this->conn->prepare("
+            SELECT 
+                s.*,
+                d.name as department_name,
+                f.name as faculty_name
+            FROM students s
+            {$course_join}
+            LEFT JOIN departments d ON s.department_id = d.id
+            LEFT JOIN faculties f ON s.faculty_id = f.id
+            WHERE s.face_encoding IS NOT NULL 
+            AND s.face_encoding != ''
+        ");
+        $stmt->execute($params);
+        $students = $stmt->fetchAll(PDO::FETCH_ASSOC);
+
+        if ($this->debug_mode) {
+            error_log("Candidate students: " . count($students) . ($course_join ? " (course-scoped)" : ""));
+        }
+
+        return $students;
+    }
+
+    private function noCandidatesMessage($course_scope = null)
+    {
+        return !empty($course_scope['course_id'])
+            ? 'No students enrolled in this course have face encodings registered'
+            : 'No registered students with face encodings found in database';
+    }
+
     /**
      * Extract face features from image using API
      */
@@ -438,10 +1158,16 @@ class FaceRecognitionManager
         try {
             $cfile = new CURLFile($image_path, mime_content_type($image_path), basename($image_path));
             
+            // Recognition only needs the features; skip the PNG face crop
             $post_data = [
-                'file' => $cfile
+                'file' => $cfile,
+                'include_thumbnail' => '0'
             ];
 
+            if ($this->encoding_format !== 'json') {
+                $post_data['encoding_format'] = $this->encoding_format;
+            }
+
             $ch = curl_init();
             curl_setopt_array($ch, [
                 CURLOPT_URL => $this->api_base_url . '/extract-features',
@@ -564,6 +1290,84 @@ class FaceRecognitionManager
         }
     }
 
+    /**
+     * Decode a stored face_encoding: compact "FEv1:" strings are passed through to the API as-is
+     */
+    private function decodeStoredEncoding($stored)
+    {
+        if (is_string($stored) && strncmp($stored, 'FEv1:', 5) === 0) {
+            return $stored;
+        }
+
+        $decoded = json_decode($stored, true);
+        return is_array($decoded) ? $decoded : null;
+    }
+
+    /**
+     * Number of values in a face encoding (float array or compact "FEv1:" string)
+     */
+    private function getEncodingLength($encoding)
+    {
+        if (is_array($encoding)) {
+            return count($encoding);
+        }
+
+        if (is_string($encoding) && strncmp($encoding, 'FEv1:', 5) === 0) {
+            // The first 12 base64 characters hold the magic, version, format code and dimension
+            $header = base64_decode(substr($encoding, 5, 12));
+            if ($header === false || strlen($header) < 6 || substr($header, 0, 2) !== 'FE') {
+                return 0;
+            }
+            $fields = unpack('Cversion/Cformat/vdimension', substr($header, 2, 4));
+            return $fields['dimension'];
+        }
+
+        return 0;
+    }
+
+    /**
+     * Build the comparison record returned for a single student
+     */
+    private function buildStudentComparison($student, $similarity, $details)
+    {
+        $student_name = trim($student['surname'] . ' ' . $student['firstname'] . ' ' . $student['middlename']);
+
+        return [
+            'id' => $student['id'],
+            'reg_number' => $student['reg_number'],
+            'full_name' => $student_name,
+            'department_name' => $student['department_name'] ?? 'Unknown Department',
+            'faculty_name' => $student['faculty_name'] ?? 'Unknown Faculty',
+            'department_id' => $student['department_id'],
+            'faculty_id' => $student['faculty_id'],
+            'level' => $student['level'],
+            'similarity_score' => $similarity,
+            'comparison_details' => $details
+        ];
+    }
+
+    /**
+     * Identify a face feature array against a whole gallery using API
+     */
+    private function identifyFaceFeatures($probe, $gallery, $top_k = 5, $threshold = 0.6)
+    {
+        $response = $this->callEncoderAPI('/identify', [
+            'probe' => $probe,
+            'gallery' => $gallery,
+            'top_k' => $top_k,
+            'threshold' => $threshold
+        ]);
+
+        if ($response['success'] && !isset($response['data']['matches'])) {
+            return [
+                'success' => false,
+                'message' => 'Invalid identification response from API'
+            ];
+        }
+
+        return $response;
+    }
+
     /**
      * Validate image using API
      */
@@ -679,6 +1483,32 @@ class FaceRecognitionManager
         return sqrt($sum) / count($vec1);
     }
 
+    /**
+     * Choose how the API returns face encodings: 'json' float lists or compact 'f32', 'f16', 'int8'
+     */
+    public function setEncodingFormat($format)
+    {
+        if (!in_array($format, ['json', 'f32', 'f16', 'int8'], true)) {
+            throw new InvalidArgumentException('Unsupported face encoding format: ' . $format);
+        }
+        $this->encoding_format = $format;
+    }
+
+    /**
+     * Similarity needed to accept a match, and (optionally) to keep the capture as a gallery template
+     *
+     * In the resident gallery a student's calibrated threshold, when there is one,
+     * replaces the recognition threshold. Templates are only captured there.
+     */
+    public function setRecognitionThresholds($recognition_threshold, $template_capture_threshold = null)
+    {
+        if ($template_capture_threshold !== null && $template_capture_threshold < $recognition_threshold) {
+            throw new InvalidArgumentException('Template capture threshold must not be below the recognition threshold');
+        }
+        $this->recognition_threshold = $recognition_threshold;
+        $this->template_capture_threshold = $template_capture_threshold;
+    }
+
     /**
      * Set API configuration
      */
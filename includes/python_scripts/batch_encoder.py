@@ -0,0 +1,324 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from opencv_face_encoder import (DETECTION_MODES, ENCODING_FORMATS, ImageEncoder, configure_opencv_threads,
+                                 decode_features, encode_features)
+
+# Numeric compare_faces fields, in the column order of the shared result matrix
+COMPARE_FIELDS = ('similarity_score', 'cosine_similarity', 'euclidean_similarity', 'correlation',
+                  'manhattan_similarity', 'euclidean_distance', 'manhattan_distance')
+
+# One encoder per pool worker, created by _init_worker
+_worker_encoder = None
+
+
+def _init_worker(detection_mode, pool_size):
+    """Pool initializer: load the cascades once per worker process"""
+    global _worker_encoder
+    configure_opencv_threads(pool_size)
+    _worker_encoder = ImageEncoder(detection_mode=detection_mode)
+
+
+def _attach_shared_memory(name):
+    """Open an existing block without tracking it; only the creating process may unlink it"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        # Older versions register attached blocks too and "clean up" (unlink) them when a worker exits
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class SharedArray:
+    """NumPy array in a named shared memory block; workers reopen it from .spec instead of receiving a pickled copy"""
+
+    def __init__(self, shape, dtype, name=None):
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        if name is None:
+            size = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = _attach_shared_memory(name)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    @property
+    def spec(self):
+        return self.shm.name, self.shape, self.dtype.str
+
+    @classmethod
+    def attach(cls, spec):
+        name, shape, dtype = spec
+        return cls(shape, dtype, name)
+
+    def close(self):
+        self.array = None  # Drop the buffer view first; SharedMemory.close fails while it is exported
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
+
+
+def _feature_length():
+    """Length of the encoder's feature vector (pool task; sizes the shared output matrix)"""
+    features, _, _ = _worker_encoder._extract_face_region(np.zeros((100, 100), dtype=np.uint8), (0, 0, 100, 100))
+    return int(features.size)
+
+
+def _register_chunk(task):
+    """Run process_student_image for a chunk of items, writing each encoding into the shared feature matrix"""
+    items, images_spec, features_spec = task
+    images = SharedArray.attach(images_spec) if images_spec else None
+    features = SharedArray.attach(features_spec)
+    results = []
+    try:
+        for index, source, student_id in items:
+            try:
+                if isinstance(source, tuple):
+                    # In-memory image: (offset, length) into the shared image buffer
+                    offset, length = source
+                    source = images.array[offset:offset + length]
+                result = _worker_encoder.process_student_image(source, student_id, 'json')
+                if result['success']:
+                    data = result['data']
+                    features.array[index] = data.pop('face_encoding')
+                    del data['face_features_json']
+            except Exception as e:
+                result = {'success': False, 'message': f'Error processing image: {str(e)}', 'data': None,
+                          'error_type': type(e).__name__}
+            results.append((index, result))
+    finally:
+        features.close()
+        if images is not None:
+            images.close()
+    return results
+
+
+def _compare_chunk(task):
+    """Compare the given rows of the shared left/right matrices, writing metrics into the shared result matrix"""
+    left_spec, right_spec, scores_spec, rows, threshold = task
+    left, right, scores = (SharedArray.attach(spec) for spec in (left_spec, right_spec, scores_spec))
+    errors = {}
+    try:
+        for i in rows:
+            result = _worker_encoder.compare_faces(left.array[i], right.array[i], threshold)
+            if 'error' in result:
+                errors[i] = result['error']
+            else:
+                scores.array[i] = [result[field] for field in COMPARE_FIELDS]
+    finally:
+        for shared in (left, right, scores):
+            shared.close()
+    return errors
+
+
+class BatchEncoderPool:
+    """Persistent process pool with one warm ImageEncoder per worker
+
+    Inputs and outputs travel through shared memory: feature pairs and in-memory
+    images go in as shared arrays and encodings come back in a shared matrix, so
+    only small per-item metadata is pickled. Results are returned in input order,
+    one entry per item, and a failing item never fails the whole batch.
+    """
+
+    def __init__(self, workers=None, detection_mode='exhaustive', encoding_format='json', chunks_per_worker=4):
+        if encoding_format not in ENCODING_FORMATS:
+            raise ValueError(f"Unknown encoding format '{encoding_format}'. Use one of: {', '.join(ENCODING_FORMATS)}")
+        self.workers = workers or os.cpu_count() or 1
+        self.encoding_format = encoding_format
+        self.chunks_per_worker = chunks_per_worker
+        self._feature_length = None
+        self._pool = multiprocessing.Pool(processes=self.workers, initializer=_init_worker,
+                                          initargs=(detection_mode, self.workers))
+
+    def _chunk_bounds(self, count):
+        """(start, stop) ranges giving each worker a few chunks for load balancing"""
+        size = max(1, -(-count // (self.workers * self.chunks_per_worker)))
+        return [(start, min(count, start + size)) for start in range(0, count, size)]
+
+    def feature_length(self):
+        if self._feature_length is None:
+            self._feature_length = self._pool.apply(_feature_length)
+        return self._feature_length
+
+    def register_images(self, items, encoding_format=None):
+        """process_student_image results for (image, student_id) items, in order
+
+        image may be a file path or encoded image bytes (e.g. a decoded webcam capture).
+        """
+        encoding_format = encoding_format or self.encoding_format
+        items = [(item['image_path'], item['student_id']) if isinstance(item, dict) else tuple(item) for item in items]
+        if not items:
+            return []
+
+        # 1. In-memory images are packed into one shared buffer; paths are sent as they are
+        blobs = [bytes(image) for image, _ in items if not isinstance(image, str)]
+        images = SharedArray((sum(len(blob) for blob in blobs),), np.uint8) if blobs else None
+        features = SharedArray((len(items), self.feature_length()), np.float32)
+
+        try:
+            tasks_items, offset = [], 0
+            for index, (image, student_id) in enumerate(items):
+                if not isinstance(image, str):
+                    blob = bytes(image)
+                    images.array[offset:offset + len(blob)] = np.frombuffer(blob, dtype=np.uint8)
+                    image = (offset, len(blob))
+                    offset += len(blob)
+                tasks_items.append((index, image, student_id))
+
+            tasks = [(tasks_items[start:stop], images.spec if images else None, features.spec)
+                     for start, stop in self._chunk_bounds(len(items))]
+
+            # 2. Workers fill the shared feature matrix; per-item metadata comes back through the pool
+            results = [None] * len(items)
+            for chunk in self._pool.imap(_register_chunk, tasks):
+                for index, result in chunk:
+                    results[index] = result
+
+            # 3. Rebuild the encodings from the shared matrix in the requested format
+            for index, result in enumerate(results):
+                if not result['success']:
+                    continue
+                row = features.array[index]
+                if encoding_format == 'json':
+                    face_encoding = row.tolist()
+                    face_features_json = json.dumps(face_encoding)
+                else:
+                    face_encoding = face_features_json = encode_features(row, encoding_format)
+                result['data']['face_encoding'] = face_encoding
+                result['data']['face_features_json'] = face_features_json
+                result['data']['encoding_format'] = encoding_format
+            return results
+        finally:
+            features.unlink()
+            if images is not None:
+                images.unlink()
+
+    def compare_pairs(self, pairs, threshold=0.6):
+        """compare_faces results for (features1, features2) pairs, in order"""
+        pairs = list(pairs)
+        if not pairs:
+            return []
+
+        # 1. Decode in the parent; undecodable or mismatched pairs get their error without a worker round trip
+        results = [None] * len(pairs)
+        decoded = []
+        for i, (features1, features2) in enumerate(pairs):
+            try:
+                decoded.append((i, decode_features(features1), decode_features(features2)))
+            except Exception as e:
+                results[i] = {'is_match': False, 'similarity_score': 0.0, 'error': f'Comparison error: {str(e)}'}
+
+        dimension = len(decoded[0][1]) if decoded else 0
+        left = SharedArray((len(pairs), dimension), np.float32)
+        right = SharedArray((len(pairs), dimension), np.float32)
+        scores = SharedArray((len(pairs), len(COMPARE_FIELDS)), np.float64)
+
+        try:
+            for i, features1, features2 in decoded:
+                if len(features1) != dimension or len(features2) != dimension:
+                    results[i] = {'is_match': False, 'similarity_score': 0.0,
+                                  'error': 'Feature vectors have different lengths'}
+                    continue
+                left.array[i] = features1
+                right.array[i] = features2
+
+            # 2. Workers score the filled rows straight from shared memory; rows of failed pairs stay zero
+            pending = [i for i, result in enumerate(results) if result is None]
+            tasks = [(left.spec, right.spec, scores.spec, pending[start:stop], threshold)
+                     for start, stop in self._chunk_bounds(len(pending))]
+            errors = {}
+            for chunk_errors in self._pool.imap(_compare_chunk, tasks):
+                errors.update(chunk_errors)
+
+            for i in pending:
+                if i in errors:
+                    results[i] = {'is_match': False, 'similarity_score': 0.0, 'error': errors[i]}
+                    continue
+                result = {field: float(value) for field, value in zip(COMPARE_FIELDS, scores.array[i])}
+                result = dict({'is_match': bool(result['similarity_score'] >= threshold)}, **result)
+                result['threshold'] = threshold
+                results[i] = result
+            return results
+        finally:
+            for shared in (left, right, scores):
+                shared.unlink()
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+_shared_pool = None
+
+def get_batch_pool():
+    """Return the process-wide BatchEncoderPool, starting it on first use"""
+    global _shared_pool
+    if _shared_pool is None:
+        _shared_pool = BatchEncoderPool(
+            workers=int(os.environ['FACE_BATCH_WORKERS']) if os.environ.get('FACE_BATCH_WORKERS') else None,
+            detection_mode=os.environ.get('FACE_DETECTION_MODE', 'exhaustive'),
+            encoding_format=os.environ.get('FACE_ENCODING_FORMAT', 'json')
+        )
+    return _shared_pool
+
+def register_student_images(items):
+    """Batch form of register_student_image: a JSON list of results in input order"""
+    try:
+        return json.dumps(get_batch_pool().register_images(items))
+    except Exception as e:
+        return json.dumps({'success': False, 'message': f'Critical error: {str(e)}', 'data': None})
+
+def compare_student_faces_batch(pairs, threshold=0.6):
+    """Batch form of compare_student_faces: a JSON list of results in input order"""
+    try:
+        return json.dumps(get_batch_pool().compare_pairs(pairs, threshold))
+    except Exception as e:
+        return json.dumps({'is_match': False, 'error': f'Comparison error: {str(e)}'})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Batch registration and comparison on a persistent process pool')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count)')
+    parser.add_argument('--detection-mode', choices=DETECTION_MODES, default='exhaustive')
+    parser.add_argument('--encoding-format', choices=ENCODING_FORMATS, default='json')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    register_parser = subparsers.add_parser('register', help='Encode every image of a directory or manifest')
+    source = register_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--dir', help='Directory of images, e.g. uploads/students')
+    source.add_argument('--manifest', help='CSV or JSON-lines manifest with image_path, student_id')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare feature pairs from a JSON file')
+    compare_parser.add_argument('pairs', help='JSON file with a list of [features1, features2] pairs')
+    compare_parser.add_argument('--threshold', type=float, default=0.6)
+    args = parser.parse_args()
+
+    with BatchEncoderPool(args.workers, args.detection_mode, args.encoding_format) as pool:
+        if args.command == 'register':
+            from bulk_enroll import load_manifest, scan_directory
+            items = scan_directory(args.dir) if args.dir else load_manifest(args.manifest)
+            results = pool.register_images(items)
+        else:
+            with open(args.pairs, 'r') as f:
+                results = pool.compare_pairs(json.load(f), args.threshold)
+
+    # One JSON line per item, in input order
+    for result in results:
+        sys.stdout.write(json.dumps(result) + '\n')
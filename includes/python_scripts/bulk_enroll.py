@@ -0,0 +1,191 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from opencv_face_encoder import DETECTION_MODES, ImageEncoder, configure_opencv_threads
+
+SUPPORTED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+# One encoder per pool worker, created by _init_worker
+_worker_encoder = None
+
+
+def _init_worker(detection_mode, cache_dir=None, pool_size=None):
+    """Pool initializer: load the cascades once per worker process"""
+    global _worker_encoder
+    # Each process gets its share of the cores instead of a full OpenCV thread pool
+    configure_opencv_threads(pool_size or os.cpu_count() or 1)
+    _worker_encoder = ImageEncoder(detection_mode=detection_mode)
+    if cache_dir:
+        # Workers share the on-disk tier, so re-processing unchanged uploads skips decode and detection
+        from result_cache import ResultCache
+        _worker_encoder.result_cache = ResultCache(cache_dir=cache_dir)
+
+
+def _process_item(item):
+    """Run process_student_image for one manifest item inside a pool worker"""
+    started = time.perf_counter()
+    result = _worker_encoder.process_student_image(item['image_path'], item['student_id'])
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    record = {
+        'image_path': item['image_path'],
+        'student_id': item['student_id'],
+        'reg_number': item.get('reg_number'),
+        'success': result['success'],
+        'message': result['message'],
+        'elapsed_ms': round(elapsed_ms, 2)
+    }
+    if result['success']:
+        data = result['data']
+        record['features_length'] = data['features_length']
+        record['total_faces_detected'] = data['total_faces_detected']
+        record['detection_passes'] = data.get('detection_passes')
+        record['face_encoding'] = data['face_encoding']
+    return record
+
+
+def scan_directory(directory):
+    """Manifest items for every supported image under a directory (e.g. uploads/students)"""
+    items = []
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            if name.lower().endswith(SUPPORTED_EXTENSIONS):
+                path = os.path.abspath(os.path.join(root, name))
+                # Without a manifest the file name stem labels the results; it is not a students.id,
+                # so these items cannot be written to a gallery (see bulk_enroll)
+                items.append({
+                    'image_path': path,
+                    'student_id': os.path.splitext(name)[0],
+                    'id_from_filename': True
+                })
+    items.sort(key=lambda item: item['image_path'])
+    return items
+
+
+def load_manifest(manifest_path):
+    """Manifest items from a CSV (image_path,student_id[,reg_number]) or JSON-lines file"""
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    items = []
+
+    with open(manifest_path, 'r', newline='') as f:
+        if manifest_path.lower().endswith('.csv'):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+
+    for row in rows:
+        if not row.get('image_path') or not row.get('student_id'):
+            raise ValueError(f"Manifest rows need image_path and student_id: {row}")
+        path = row['image_path']
+        if not os.path.isabs(path):
+            path = os.path.join(base_dir, path)
+        items.append({
+            'image_path': os.path.abspath(path),
+            'student_id': row['student_id'],
+            'reg_number': row.get('reg_number') or None
+        })
+    return items
+
+
+def load_completed(output_path, retry_failed=True):
+    """Image paths already handled by a previous (possibly interrupted) run"""
+    completed = set()
+    if not output_path or not os.path.exists(output_path):
+        return completed
+
+    with open(output_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # A torn last line from a crash is simply redone
+            if record.get('success') or not retry_failed:
+                completed.add(record.get('image_path'))
+    return completed
+
+
+def bulk_enroll(items, workers=None, detection_mode='exhaustive', gallery_dir=None, output=None,
+                include_encoding=False, chunksize=1, cache_dir=None):
+    """Process items across a process pool, streaming one JSON line per image"""
+    gallery = None
+    if gallery_dir:
+        # Gallery rows are keyed by student_id, which must be the students.id the app maps results back to
+        unmapped = [item['image_path'] for item in items if item.get('id_from_filename')]
+        if unmapped:
+            raise ValueError(f"{len(unmapped)} items have no student id (e.g. {unmapped[0]}); "
+                             "enroll into a gallery from a manifest with image_path,student_id")
+        from face_gallery import FaceGallery
+        gallery = FaceGallery(gallery_dir)
+
+    out = output or sys.stdout
+    summary = {'processed': 0, 'succeeded': 0, 'failed': 0, 'enrolled': 0}
+    started = time.perf_counter()
+
+    with multiprocessing.Pool(processes=workers, initializer=_init_worker,
+                              initargs=(detection_mode, cache_dir, workers)) as pool:
+        for record in pool.imap_unordered(_process_item, items, chunksize=chunksize):
+            summary['processed'] += 1
+            encoding = record.pop('face_encoding', None)
+
+            if record['success']:
+                summary['succeeded'] += 1
+                # Gallery writes stay in the parent so enrollment order is serialized
+                if gallery is not None:
+                    try:
+                        record['gallery_row'] = gallery.add(record['student_id'], encoding,
+                                                            reg_number=record.get('reg_number'))
+                        summary['enrolled'] += 1
+                    except Exception as e:
+                        record['gallery_error'] = str(e)
+                if include_encoding:
+                    record['face_encoding'] = encoding
+            else:
+                summary['failed'] += 1
+
+            # Flush per line so an interrupted run can resume from the output file
+            out.write(json.dumps(record) + '\n')
+            out.flush()
+
+    elapsed = time.perf_counter() - started
+    summary['elapsed_seconds'] = round(elapsed, 2)
+    summary['images_per_second'] = round(summary['processed'] / elapsed, 2) if elapsed > 0 else 0.0
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Bulk face enrollment from a directory or manifest')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--dir', help='Directory of images, e.g. uploads/students')
+    source.add_argument('--manifest', help='CSV or JSON-lines manifest with image_path, student_id, reg_number')
+    parser.add_argument('--gallery', help='Gallery directory to write encodings into (requires --manifest)')
+    parser.add_argument('--output', help='JSON-lines results file (appended to; enables --resume)')
+    parser.add_argument('--resume', action='store_true', help='Skip images already recorded in --output')
+    parser.add_argument('--keep-failed', action='store_true', help='With --resume, do not retry failed images')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count)')
+    parser.add_argument('--detection-mode', choices=DETECTION_MODES, default='exhaustive')
+    parser.add_argument('--include-encoding', action='store_true', help='Include face_encoding in each result line')
+    parser.add_argument('--cache-dir', help='Result cache directory; unchanged images are not processed again')
+    args = parser.parse_args()
+    if args.gallery and args.dir:
+        parser.error('--gallery needs --manifest: file names in --dir do not carry the students.id')
+
+    items = scan_directory(args.dir) if args.dir else load_manifest(args.manifest)
+
+    if args.resume:
+        completed = load_completed(args.output, retry_failed=not args.keep_failed)
+        items = [item for item in items if item['image_path'] not in completed]
+
+    output = open(args.output, 'a') if args.output else None
+    try:
+        summary = bulk_enroll(items, args.workers, args.detection_mode, args.gallery, output, args.include_encoding,
+                              cache_dir=args.cache_dir)
+    finally:
+        if output is not None:
+            output.close()
+
+    sys.stderr.write(json.dumps({'summary': summary}) + '\n')
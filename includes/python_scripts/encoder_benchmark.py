@@ -0,0 +1,427 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from opencv_face_encoder import ImageEncoder, configure_opencv_threads
+from search_benchmark import DEFAULT_UPLOADS_DIR, synthesize_gallery, synthesize_probes
+
+try:
+    import resource
+except ImportError:  # Windows: peak RSS is not reported
+    resource = None
+
+# Latency increases below this many milliseconds are treated as timer noise when comparing runs
+NOISE_FLOOR_MS = 0.05
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Cold-start entry points, each run in a fresh interpreter; they print whether OpenCV got imported
+STARTUP_ENTRY_POINTS = {
+    'import': "import sys, opencv_face_encoder",
+    'compare': ("import sys, json, opencv_face_encoder as m; v = json.dumps([0.1] * 470); "
+                "m.compare_student_faces(v, v)"),
+    'register': "import sys, opencv_face_encoder as m; m.register_student_image({image!r}, 'bench')"
+}
+
+# (include_thumbnail, reuse_buffers) settings compared by the memory benchmark
+RESPONSE_SHAPING_CONFIGS = {
+    'thumbnail.fresh_arrays': (True, False),
+    'thumbnail.buffers': (True, True),
+    'no_thumbnail.fresh_arrays': (False, False),
+    'no_thumbnail.buffers': (False, True)
+}
+
+# Run in a fresh interpreter per setting so peak RSS belongs to that setting alone;
+# prints registration latencies, per-face extraction latencies, allocation peak and response size
+RESPONSE_SHAPING_PROBE = """
+import json, sys, time, tracemalloc
+import encoder_benchmark as b
+from opencv_face_encoder import ImageEncoder
+paths, rounds = json.loads(sys.argv[1]), int(sys.argv[2])
+encoder = ImageEncoder(detection_mode='exhaustive')
+encoder.include_thumbnail, encoder.reuse_buffers = sys.argv[3] == '1', sys.argv[4] == '1'
+register, response_bytes, detections = [], [], []
+for round_index in range(rounds):
+    for path in paths:
+        started = time.perf_counter()
+        result = encoder.process_student_image(path, 'bench')
+        register.append((time.perf_counter() - started) * 1000)
+        response_bytes.append(len(json.dumps(result)))
+        if result['success'] and round_index == 0:
+            state = encoder._validate_and_detect(path)[2]
+            detections.append((state['gray'], state['faces'], encoder.include_thumbnail))
+extract = b.time_calls(encoder._extract_from_detections, detections, 20)
+tracemalloc.start()
+b.time_calls(encoder._extract_from_detections, detections, 2)
+alloc_peak = tracemalloc.get_traced_memory()[1]
+tracemalloc.stop()
+print(json.dumps({'register': b.summarize(register), 'extract': b.summarize(extract),
+                  'extract_alloc_peak_kb': round(alloc_peak / 1024.0, 1),
+                  'mean_response_bytes': round(sum(response_bytes) / len(response_bytes)),
+                  'peak_rss_mb': b.peak_rss_mb()}))
+"""
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process, or None where unavailable"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return round(peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0, 1)
+
+
+def summarize(samples_ms):
+    """p50/p95/mean latency and single-thread throughput for a list of timings"""
+    samples = np.asarray(samples_ms, dtype=np.float64)
+    mean = float(samples.mean())
+    return {
+        'n': int(len(samples)),
+        'p50_ms': round(float(np.percentile(samples, 50)), 4),
+        'p95_ms': round(float(np.percentile(samples, 95)), 4),
+        'mean_ms': round(mean, 4),
+        'throughput_per_s': round(1000.0 / mean, 2) if mean > 0 else None
+    }
+
+
+def time_calls(fn, inputs, repeat=1):
+    """Time fn(*args) for every args tuple in inputs, repeat times each; returns milliseconds"""
+    samples = []
+    for _ in range(repeat):
+        for args in inputs:
+            started = time.perf_counter()
+            fn(*args)
+            samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+def make_variants(image_paths, out_dir, rng):
+    """Downscaled, upscaled and noisy copies of each image, written to out_dir"""
+    variants = []
+    for path in image_paths:
+        image = cv2.imread(path)
+        if image is None:
+            continue
+        stem = os.path.splitext(os.path.basename(path))[0]
+
+        for scale in (0.5, 2.0):
+            scaled = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+            variant_path = os.path.join(out_dir, f'{stem}_x{scale}.jpg')
+            cv2.imwrite(variant_path, scaled)
+            variants.append(variant_path)
+
+        noisy = np.clip(image.astype(np.float32) + rng.normal(0, 8, image.shape), 0, 255).astype(np.uint8)
+        variant_path = os.path.join(out_dir, f'{stem}_noisy.jpg')
+        cv2.imwrite(variant_path, noisy)
+        variants.append(variant_path)
+    return variants
+
+
+def run_benchmarks(uploads_dir=DEFAULT_UPLOADS_DIR, gallery_sizes=(100, 1000, 10000), repeat=3, variants=True, seed=0):
+    """Time the encoder hot paths on the bundled uploads (and synthetic variants)"""
+    rng = np.random.default_rng(seed)
+    encoder = ImageEncoder(detection_mode='exhaustive')
+    tiered = ImageEncoder(detection_mode='tiered')
+
+    image_paths = sorted(glob.glob(os.path.join(uploads_dir, 'students', '*')) +
+                         glob.glob(os.path.join(uploads_dir, 'lecturers', '*')))
+    if not image_paths:
+        raise RuntimeError(f'No images found under {uploads_dir}/students or {uploads_dir}/lecturers')
+
+    variant_dir = tempfile.mkdtemp(prefix='encoder_bench_')
+    results = {}
+    try:
+        all_paths = image_paths + (make_variants(image_paths, variant_dir, rng) if variants else [])
+        path_inputs = [(path,) for path in all_paths]
+
+        # 1. Whole-image stages (one repetition: these are the slow paths)
+        results['validate_image'] = summarize(time_calls(encoder.validate_image, path_inputs))
+        results['process_student_image'] = summarize(
+            time_calls(lambda path: encoder.process_student_image(path, 'bench'), path_inputs))
+
+        grays = [(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY),) for image in map(cv2.imread, all_paths) if image is not None]
+        results['detect_faces.exhaustive'] = summarize(time_calls(encoder._detect_faces_multiple_methods, grays))
+        results['detect_faces.tiered'] = summarize(time_calls(tiered._detect_faces_multiple_methods, grays))
+
+        # 2. Per-face extraction stages on the main face crop of every image with a face
+        crops, face_inputs, encodings = [], [], []
+        for (gray,) in grays:
+            faces = tiered._detect_faces_multiple_methods(gray)
+            if len(faces) == 0:
+                continue
+            face = max(faces, key=lambda f: f[2] * f[3])
+            face_inputs.append((gray, face))
+            x, y, w, h = face
+            crops.append(cv2.resize(gray[y:y + h, x:x + w], (100, 100)))
+            encodings.append(encoder._extract_face_region(gray, face)[0])
+
+        processed = [encoder._preprocess_face(crop) for crop in crops]
+        gradients = [encoder._compute_face_gradients(face) for face in processed]
+        stage_inputs = {
+            '_preprocess_face': (encoder._preprocess_face, [(crop,) for crop in crops]),
+            '_compute_face_gradients': (encoder._compute_face_gradients, [(face,) for face in processed]),
+            '_extract_histogram_features': (encoder._extract_histogram_features, [(face,) for face in processed]),
+            '_extract_simple_lbp_features': (encoder._extract_simple_lbp_features, list(zip(processed, gradients))),
+            '_extract_pixel_features': (encoder._extract_pixel_features, [(face,) for face in processed]),
+            '_extract_gradient_features': (encoder._extract_gradient_features, list(zip(processed, gradients))),
+            '_normalize_features': (encoder._normalize_features, [(features,) for features in encodings]),
+            '_extract_face_region': (encoder._extract_face_region, face_inputs)
+        }
+        for name, (fn, inputs) in stage_inputs.items():
+            results[f'extract.{name}'] = summarize(time_calls(fn, inputs, repeat * 10))
+
+        # 3. Matching: pairwise comparison and simulated N-student identification
+        pairs = [(encodings[i], encodings[j]) for i in range(len(encodings)) for j in range(i + 1, len(encodings))]
+        results['compare_faces'] = summarize(time_calls(encoder.compare_faces, pairs, repeat))
+
+        seeds = np.array(encodings, dtype=np.float32)
+        for size in gallery_sizes:
+            gallery = synthesize_gallery(seeds, size, rng)
+            probes, _ = synthesize_probes(gallery, 20, rng)
+            codes = encoder.build_quantized_index(gallery)
+            results[f'identify.exact.{size}'] = summarize(
+                time_calls(lambda probe: encoder.identify(probe, gallery, 5), [(p,) for p in probes], repeat))
+            results[f'identify.two_stage.{size}'] = summarize(
+                time_calls(lambda probe: encoder.identify(probe, gallery, 5, search_mode='two_stage', quantized_index=codes),
+                           [(p,) for p in probes], repeat))
+    finally:
+        shutil.rmtree(variant_dir, ignore_errors=True)
+
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'platform': platform.platform(),
+            'images': len(image_paths),
+            'variants': variants,
+            'repeat': repeat
+        },
+        'results': results,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def measure_startup(image_path, runs=5, module_dir=SCRIPT_DIR):
+    """Wall time of fresh-interpreter runs of each entry point (module_dir may hold an older encoder)"""
+    results = {}
+    for name, script in STARTUP_ENTRY_POINTS.items():
+        code = script.format(image=image_path) + "; print('cv2' in sys.modules)"
+        samples, loads_cv2 = [], None
+        for _ in range(runs):
+            started = time.perf_counter()
+            output = subprocess.run([sys.executable, '-c', code], cwd=module_dir, capture_output=True, text=True, check=True)
+            samples.append((time.perf_counter() - started) * 1000)
+            loads_cv2 = output.stdout.strip().splitlines()[-1] == 'True'
+        results[f'startup.{name}'] = dict(summarize(samples), loads_cv2=loads_cv2)
+    return results
+
+
+def measure_response_shaping(image_paths, rounds=2, module_dir=SCRIPT_DIR):
+    """Latency, allocation peak, response size and peak RSS with and without thumbnails and working buffers"""
+    results = {}
+    for name, (include_thumbnail, reuse_buffers) in RESPONSE_SHAPING_CONFIGS.items():
+        output = subprocess.run(
+            [sys.executable, '-c', RESPONSE_SHAPING_PROBE, json.dumps(image_paths), str(rounds),
+             '1' if include_thumbnail else '0', '1' if reuse_buffers else '0'],
+            cwd=module_dir, capture_output=True, text=True, check=True
+        )
+        probe = json.loads(output.stdout.strip().splitlines()[-1])
+        results[f'register.{name}'] = dict(probe['register'], mean_response_bytes=probe['mean_response_bytes'],
+                                           peak_rss_mb=probe['peak_rss_mb'])
+        results[f'extract.{name}'] = dict(probe['extract'], alloc_peak_kb=probe['extract_alloc_peak_kb'])
+    return results
+
+
+def default_thread_configs(cores=None):
+    """(workers, detection_threads) pairs: sequential, per-request parallel and cross-request parallel"""
+    cores = cores or os.cpu_count() or 1
+    configs = [(1, 1), (1, cores), (cores, 1)]
+    if cores >= 4:
+        configs.append((cores // 2, 2))
+    return sorted(set(configs), key=configs.index)
+
+
+def measure_threading(image_paths, configs, rounds=2):
+    """Exhaustive detection latency and throughput for each (workers, detection_threads) setting
+
+    Each worker thread owns an encoder and pulls images from a shared queue, like
+    the resident service does; OpenCV threads are sized by configure_opencv_threads.
+    """
+    grays = [cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) for image in map(cv2.imread, image_paths) if image is not None]
+    results = {}
+    for workers, detection_threads in configs:
+        opencv_threads = configure_opencv_threads(workers, detection_threads)
+        encoders = []
+        for _ in range(workers):
+            encoder = ImageEncoder(detection_mode='exhaustive')
+            encoder.detection_threads = detection_threads
+            encoder._detect_faces_multiple_methods(grays[0])  # Load cascades outside the timed run
+            encoders.append(encoder)
+
+        pending = list(grays) * rounds
+        lock = threading.Lock()
+        samples = []
+
+        def work(encoder):
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    gray = pending.pop()
+                started = time.perf_counter()
+                encoder._detect_faces_multiple_methods(gray)
+                elapsed = (time.perf_counter() - started) * 1000
+                with lock:
+                    samples.append(elapsed)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=work, args=(encoder,)) for encoder in encoders]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - started
+
+        results[f'detect_threads.w{workers}.d{detection_threads}'] = dict(
+            summarize(samples),
+            requests_per_s=round(len(samples) / wall, 2),
+            workers=workers,
+            detection_threads=detection_threads,
+            opencv_threads=opencv_threads
+        )
+    return results
+
+
+def compare_runs(baseline, current, tolerance=0.10):
+    """Per-benchmark p50/p95 changes between two runs; regressions exceed the tolerance ratio"""
+    rows, regressions = [], []
+    for name, before in baseline['results'].items():
+        after = current['results'].get(name)
+        if after is None:
+            continue
+        row = {'benchmark': name}
+        regressed = False
+        for metric in ('p50_ms', 'p95_ms'):
+            change = (after[metric] - before[metric]) / before[metric] if before[metric] > 0 else 0.0
+            row[metric] = [before[metric], after[metric]]
+            row[metric.replace('_ms', '_change')] = round(change, 4)
+            if change > tolerance and after[metric] - before[metric] > NOISE_FLOOR_MS:
+                regressed = True
+        row['regression'] = regressed
+        rows.append(row)
+        if regressed:
+            regressions.append(name)
+
+    # Runs over different inputs are not like for like; flag it rather than refusing
+    settings = ('images', 'variants', 'repeat')
+    same_inputs = all(baseline['meta'].get(key) == current['meta'].get(key) for key in settings)
+
+    return {
+        'tolerance': tolerance,
+        'same_inputs': same_inputs,
+        'compared': len(rows),
+        'regressions': regressions,
+        'rows': rows,
+        'peak_rss_mb': [baseline.get('peak_rss_mb'), current.get('peak_rss_mb')]
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the ImageEncoder hot paths and compare runs')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run the benchmarks and write JSON results')
+    run_parser.add_argument('--output', help='Results file (default: stdout)')
+    run_parser.add_argument('--uploads', default=DEFAULT_UPLOADS_DIR, help='Directory holding students/ and lecturers/ images')
+    run_parser.add_argument('--gallery-sizes', default='100,1000,10000', help='Comma-separated identification gallery sizes')
+    run_parser.add_argument('--repeat', type=int, default=3)
+    run_parser.add_argument('--no-variants', action='store_true', help='Skip the scaled and noisy image variants')
+    run_parser.add_argument('--seed', type=int, default=0)
+
+    startup_parser = subparsers.add_parser('startup', help='Cold-start time of the import, compare and register entry points')
+    startup_parser.add_argument('--runs', type=int, default=5)
+    startup_parser.add_argument('--image', default=os.path.join(DEFAULT_UPLOADS_DIR, 'students', 'student_2_1749073984.jpg'),
+                                help='Image used by the register entry point')
+    startup_parser.add_argument('--module-dir', default=SCRIPT_DIR,
+                                help='Directory holding the opencv_face_encoder.py to measure (e.g. an older checkout)')
+
+    threads_parser = subparsers.add_parser(
+        'threads', help='Detection latency vs throughput for request workers x parallel detector passes')
+    threads_parser.add_argument('--uploads', default=DEFAULT_UPLOADS_DIR, help='Directory holding students/ and lecturers/ images')
+    threads_parser.add_argument('--configs', help='Comma-separated WORKERSxDETECTION_THREADS, e.g. 1x1,1x4,4x1 '
+                                                  '(default: derived from the CPU count)')
+    threads_parser.add_argument('--rounds', type=int, default=2, help='Times each image is detected per setting')
+
+    memory_parser = subparsers.add_parser(
+        'memory', help='Registration latency, response size and peak RSS with/without thumbnails and working buffers')
+    memory_parser.add_argument('--uploads', default=DEFAULT_UPLOADS_DIR, help='Directory holding students/ and lecturers/ images')
+    memory_parser.add_argument('--rounds', type=int, default=2, help='Times each image is registered per setting')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two result files; exit status 1 on regression')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--tolerance', type=float, default=0.10, help='Allowed relative slowdown (0.10 = 10%%)')
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        sizes = [int(size) for size in args.gallery_sizes.split(',') if size.strip()]
+        report = run_benchmarks(args.uploads, sizes, args.repeat, not args.no_variants, args.seed)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+        else:
+            json.dump(report, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+    elif args.command == 'startup':
+        report = {
+            'meta': {'python': platform.python_version(), 'module_dir': os.path.abspath(args.module_dir), 'runs': args.runs},
+            'results': measure_startup(os.path.abspath(args.image), args.runs, args.module_dir)
+        }
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    elif args.command == 'threads':
+        configs = default_thread_configs()
+        if args.configs:
+            configs = [tuple(int(n) for n in config.split('x')) for config in args.configs.split(',') if config.strip()]
+        image_paths = sorted(glob.glob(os.path.join(args.uploads, 'students', '*')) +
+                             glob.glob(os.path.join(args.uploads, 'lecturers', '*')))
+        report = {
+            'meta': {'python': platform.python_version(), 'opencv': cv2.__version__, 'cpu_count': os.cpu_count(),
+                     'images': len(image_paths), 'rounds': args.rounds},
+            'results': measure_threading(image_paths, configs, args.rounds)
+        }
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    elif args.command == 'memory':
+        image_paths = sorted(glob.glob(os.path.join(args.uploads, 'students', '*')) +
+                             glob.glob(os.path.join(args.uploads, 'lecturers', '*')))
+        report = {
+            'meta': {'python': platform.python_version(), 'opencv': cv2.__version__,
+                     'images': len(image_paths), 'rounds': args.rounds},
+            'results': measure_response_shaping(image_paths, args.rounds)
+        }
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        with open(args.current, 'r') as f:
+            current = json.load(f)
+        comparison = compare_runs(baseline, current, args.tolerance)
+        json.dump(comparison, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        sys.exit(1 if comparison['regressions'] else 0)
@@ -0,0 +1,329 @@
+import argparse
+import glob
+import itertools
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from encoder_benchmark import summarize
+from opencv_face_encoder import SIMILARITY_WEIGHTS, ImageEncoder
+from search_benchmark import DEFAULT_UPLOADS_DIR
+
+# Detector settings to compare, as ImageEncoder attribute overrides
+DETECTION_CONFIGS = {
+    'exhaustive': {'detection_mode': 'exhaustive'},
+    'exhaustive.fused': {'detection_mode': 'exhaustive', 'merge_strategy': 'fused'},
+    'exhaustive.skip_fallbacks': {'detection_mode': 'exhaustive', 'fallback_skip_votes': 3},
+    'tiered': {'detection_mode': 'tiered'},
+    'tiered.decode640': {'detection_mode': 'tiered', 'max_decode_side': 640}
+}
+
+# Column ranges of the 470-value feature vector, in the order _extract_face_region builds it
+FEATURE_BLOCKS = {'histogram': (0, 64), 'grid': (64, 208), 'pixels': (208, 464), 'gradient': (464, 470)}
+
+# Feature variants are block subsets of the stored vectors, re-normalized; no re-extraction needed
+FEATURE_VARIANTS = {
+    'all': ('histogram', 'grid', 'pixels', 'gradient'),
+    'no_pixels': ('histogram', 'grid', 'gradient'),
+    'no_histogram': ('grid', 'pixels', 'gradient'),
+    'grid_gradient': ('grid', 'gradient')
+}
+
+WEIGHT_VARIANTS = {
+    'default': dict(SIMILARITY_WEIGHTS),
+    'cosine': {'cosine': 1.0, 'euclidean': 0.0, 'correlation': 0.0, 'manhattan': 0.0},
+    'cosine_correlation': {'cosine': 0.5, 'euclidean': 0.0, 'correlation': 0.5, 'manhattan': 0.0},
+    'distance': {'cosine': 0.2, 'euclidean': 0.4, 'correlation': 0.2, 'manhattan': 0.2}
+}
+
+SEARCH_MODES = ('exact', 'two_stage')
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+# Per-probe latencies within this ratio of each other are treated as equal when ranking configurations
+LATENCY_TIE_RATIO = 0.05
+
+
+def augment_image(image, rng):
+    """Capture-like variations of one image: (name, image) pairs"""
+    h, w = image.shape[:2]
+    rotation = cv2.getRotationMatrix2D((w / 2.0, h / 2.0), 8, 1.0)
+    ok, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 35])
+    return [
+        ('x0.5', cv2.resize(image, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)),
+        ('dark', cv2.convertScaleAbs(image, alpha=0.6, beta=0)),
+        ('bright', cv2.convertScaleAbs(image, alpha=1.2, beta=25)),
+        ('noisy', np.clip(image.astype(np.float32) + rng.normal(0, 10, image.shape), 0, 255).astype(np.uint8)),
+        ('blur', cv2.GaussianBlur(image, (5, 5), 0)),
+        ('rotate8', cv2.warpAffine(image, rotation, (w, h), borderMode=cv2.BORDER_REPLICATE)),
+        ('jpeg35', cv2.imdecode(jpeg, cv2.IMREAD_COLOR) if ok else image)
+    ]
+
+
+def build_dataset(uploads_dir, out_dir, rng, labels=None, augment=True):
+    """Gallery and probe images with identity labels
+
+    Without a labels file every upload is its own identity. With one
+    ({filename: identity}) the first image of each identity is enrolled and
+    the rest are probes. Augmented copies of every image are probes too.
+    Returns (gallery, probes) lists of {'path', 'label', 'kind'}.
+    """
+    paths = sorted(path for path in glob.glob(os.path.join(uploads_dir, '*', '*'))
+                   if os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS)
+    if not paths:
+        raise RuntimeError(f'No images found under {uploads_dir}')
+
+    gallery, probes, enrolled = [], [], set()
+    for path in paths:
+        filename = os.path.basename(path)
+        if labels is not None and filename not in labels:
+            continue
+        label = str(labels[filename]) if labels is not None else os.path.splitext(filename)[0]
+        if label in enrolled:
+            probes.append({'path': path, 'label': label, 'kind': 'original'})
+        else:
+            gallery.append({'path': path, 'label': label, 'kind': 'original'})
+            enrolled.add(label)
+
+        image = cv2.imread(path) if augment else None
+        if image is None:
+            continue
+        stem = os.path.splitext(filename)[0]
+        for name, variant in augment_image(image, rng):
+            variant_path = os.path.join(out_dir, f'{stem}_{name}.png')
+            cv2.imwrite(variant_path, variant)
+            probes.append({'path': variant_path, 'label': label, 'kind': name})
+    return gallery, probes
+
+
+def extract_dataset(encoder, items):
+    """Main-face features and end-to-end extraction latency for every image (None when no face is found)"""
+    features, latencies = [], []
+    for item in items:
+        started = time.perf_counter()
+        face_data, _ = encoder.extract_face_features(item['path'], include_thumbnail=False)
+        latencies.append((time.perf_counter() - started) * 1000)
+        features.append(np.asarray(face_data['features'], dtype=np.float32) if face_data is not None else None)
+    return features, latencies
+
+
+def feature_columns(blocks):
+    return np.concatenate([np.arange(*FEATURE_BLOCKS[block]) for block in blocks])
+
+
+def _select(vectors, columns):
+    """Feature subset of each vector, L2 re-normalized like the full vector"""
+    matrix = np.stack(vectors)[:, columns]
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return (matrix / np.where(norms > 1e-6, norms, 1.0)).astype(np.float32)
+
+
+def error_rates(genuine, impostor, threshold):
+    """FAR and FRR at a threshold, plus the equal error rate and the threshold where it occurs"""
+    genuine, impostor = np.sort(genuine), np.sort(impostor)
+    far = float((impostor >= threshold).mean()) if len(impostor) else 0.0
+    frr = float((genuine < threshold).mean()) if len(genuine) else 0.0
+
+    eer, eer_threshold = None, None
+    if len(genuine) and len(impostor):
+        candidates = np.unique(np.concatenate([genuine, impostor]))
+        far_curve = 1.0 - np.searchsorted(impostor, candidates, side='left') / len(impostor)
+        frr_curve = np.searchsorted(genuine, candidates, side='left') / len(genuine)
+        best = int(np.argmin(np.abs(far_curve - frr_curve)))
+        eer = float((far_curve[best] + frr_curve[best]) / 2)
+        eer_threshold = float(candidates[best])
+    return far, frr, eer, eer_threshold
+
+
+def evaluate_matcher(encoder, gallery_features, gallery_labels, probe_features, probe_labels, search_mode='exact',
+                     threshold=0.6):
+    """Rank-1 identification, FAR/FRR and identify latency for probes that produced a face"""
+    codes = encoder.build_quantized_index(gallery_features) if search_mode == 'two_stage' else None
+    gallery_labels = np.asarray(gallery_labels)
+
+    correct, latencies, genuine, impostor = 0, [], [], []
+    for probe, label in zip(probe_features, probe_labels):
+        started = time.perf_counter()
+        result = encoder.identify(probe, gallery_features, 1, threshold, search_mode=search_mode,
+                                  quantized_index=codes)
+        latencies.append((time.perf_counter() - started) * 1000)
+        if result['matches'] and gallery_labels[result['matches'][0]['index']] == label:
+            correct += 1
+
+        # Verification scores: the probe against its own enrollment and against everyone else
+        scores = encoder._score_gallery(probe, gallery_features)['similarity_score']
+        own = gallery_labels == label
+        genuine.extend(scores[own].tolist())
+        impostor.extend(scores[~own].tolist())
+
+    far, frr, eer, eer_threshold = error_rates(np.array(genuine), np.array(impostor), threshold)
+    return {
+        'rank1_correct': correct,
+        'identify': summarize(latencies) if latencies else None,
+        'far': round(far, 4),
+        'frr': round(frr, 4),
+        'eer': round(eer, 4) if eer is not None else None,
+        'eer_threshold': round(eer_threshold, 4) if eer_threshold is not None else None,
+        'genuine_pairs': len(genuine),
+        'impostor_pairs': len(impostor)
+    }
+
+
+def pareto_front(rows):
+    """Names of rows not dominated on (accuracy up, EER down, latency down)
+
+    Latencies within LATENCY_TIE_RATIO count as ties, so timer noise alone
+    never knocks a configuration off the front.
+    """
+    def dominates(other, row):
+        other_eer = other['eer'] if other['eer'] is not None else 1.0
+        row_eer = row['eer'] if row['eer'] is not None else 1.0
+        tolerance = row['latency_ms'] * LATENCY_TIE_RATIO
+        no_worse = (other['end_to_end_accuracy'] >= row['end_to_end_accuracy'] and other_eer <= row_eer and
+                    other['latency_ms'] <= row['latency_ms'] + tolerance)
+        better = (other['end_to_end_accuracy'] > row['end_to_end_accuracy'] or other_eer < row_eer or
+                  other['latency_ms'] < row['latency_ms'] - tolerance)
+        return no_worse and better
+
+    return [row['config'] for row in rows if not any(dominates(other, row) for other in rows if other is not row)]
+
+
+def run_evaluation(uploads_dir=DEFAULT_UPLOADS_DIR, labels=None, augment=True, threshold=0.6, seed=0,
+                   detection_configs=None, feature_variants=None, weight_variants=None, search_modes=SEARCH_MODES):
+    """Every detection x feature x weight x search configuration over the labeled set"""
+    detection_configs = detection_configs or list(DETECTION_CONFIGS)
+    feature_variants = feature_variants or list(FEATURE_VARIANTS)
+    weight_variants = weight_variants or list(WEIGHT_VARIANTS)
+
+    rng = np.random.default_rng(seed)
+    work_dir = tempfile.mkdtemp(prefix='encoder_eval_')
+    rows, detection = [], {}
+    try:
+        gallery, probes = build_dataset(uploads_dir, work_dir, rng, labels, augment)
+
+        for detection_name in detection_configs:
+            # 1. Detection and extraction: the expensive stage, run once per detector setting
+            encoder = ImageEncoder()
+            for attr, value in DETECTION_CONFIGS[detection_name].items():
+                setattr(encoder, attr, value)
+            gallery_features, gallery_ms = extract_dataset(encoder, gallery)
+            probe_features, probe_ms = extract_dataset(encoder, probes)
+
+            detected = sum(f is not None for f in gallery_features) + sum(f is not None for f in probe_features)
+            detection[detection_name] = {
+                'images': len(gallery) + len(probes),
+                'detection_rate': round(detected / float(len(gallery) + len(probes)), 4),
+                'extract': summarize(gallery_ms + probe_ms)
+            }
+
+            enrolled = [i for i, f in enumerate(gallery_features) if f is not None]
+            scored = [i for i, f in enumerate(probe_features) if f is not None
+                      and any(gallery[j]['label'] == probes[i]['label'] for j in enrolled)]
+            if not enrolled or not scored:
+                continue
+            gallery_labels = [gallery[i]['label'] for i in enrolled]
+            probe_labels = [probes[i]['label'] for i in scored]
+
+            # 2. Matching variants reuse the extracted vectors
+            for feature_name, weight_name, search_mode in itertools.product(feature_variants, weight_variants,
+                                                                            search_modes):
+                columns = feature_columns(FEATURE_VARIANTS[feature_name])
+                encoder.similarity_weights = dict(WEIGHT_VARIANTS[weight_name])
+                matcher = evaluate_matcher(encoder, _select([gallery_features[i] for i in enrolled], columns),
+                                           gallery_labels, _select([probe_features[i] for i in scored], columns),
+                                           probe_labels, search_mode, threshold)
+
+                # A probe whose face was missed, or whose identity failed to enroll, counts as a miss
+                latency_ms = detection[detection_name]['extract']['mean_ms'] + matcher['identify']['mean_ms']
+                rows.append({
+                    'config': f'{detection_name}/{feature_name}/{weight_name}/{search_mode}',
+                    'detection': detection_name,
+                    'features': feature_name,
+                    'weights': weight_name,
+                    'search_mode': search_mode,
+                    'detection_rate': detection[detection_name]['detection_rate'],
+                    'rank1_accuracy': round(matcher['rank1_correct'] / float(len(scored)), 4),
+                    'end_to_end_accuracy': round(matcher['rank1_correct'] / float(len(probes)), 4),
+                    'far': matcher['far'],
+                    'frr': matcher['frr'],
+                    'eer': matcher['eer'],
+                    'eer_threshold': matcher['eer_threshold'],
+                    'latency_ms': round(latency_ms, 3),
+                    'throughput_per_s': round(1000.0 / latency_ms, 2) if latency_ms > 0 else None,
+                    'identify_p50_ms': matcher['identify']['p50_ms'],
+                    'genuine_pairs': matcher['genuine_pairs'],
+                    'impostor_pairs': matcher['impostor_pairs']
+                })
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'uploads': os.path.abspath(uploads_dir),
+            'identities': len(gallery),
+            'gallery_images': len(gallery),
+            'probe_images': len(probes),
+            'augmented': augment,
+            'labeled': labels is not None,
+            'threshold': threshold,
+            'seed': seed
+        },
+        'detection': detection,
+        'results': rows,
+        'pareto': pareto_front(rows)
+    }
+
+
+def _names(value, known, what):
+    if not value:
+        return None
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in names if name not in known]
+    if unknown:
+        raise SystemExit(f"Unknown {what}: {', '.join(unknown)}. Use: {', '.join(known)}")
+    return names
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Accuracy vs speed of detector and matcher configurations on a labeled image set')
+    parser.add_argument('--uploads', default=DEFAULT_UPLOADS_DIR, help='Directory whose subfolders hold the images')
+    parser.add_argument('--labels', help='JSON {filename: identity}; by default every image is its own identity')
+    parser.add_argument('--no-augment', action='store_true', help='Skip the augmented probe copies')
+    parser.add_argument('--threshold', type=float, default=0.6, help='Match threshold for FAR/FRR')
+    parser.add_argument('--detection', help=f"Comma-separated subset of: {', '.join(DETECTION_CONFIGS)}")
+    parser.add_argument('--features', help=f"Comma-separated subset of: {', '.join(FEATURE_VARIANTS)}")
+    parser.add_argument('--weights', help=f"Comma-separated subset of: {', '.join(WEIGHT_VARIANTS)}")
+    parser.add_argument('--search-modes', help=f"Comma-separated subset of: {', '.join(SEARCH_MODES)}")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Results file (default: stdout)')
+    args = parser.parse_args()
+
+    labels = None
+    if args.labels:
+        with open(args.labels, 'r') as f:
+            labels = json.load(f)
+
+    report = run_evaluation(
+        args.uploads, labels, not args.no_augment, args.threshold, args.seed,
+        _names(args.detection, DETECTION_CONFIGS, 'detection configs'),
+        _names(args.features, FEATURE_VARIANTS, 'feature variants'),
+        _names(args.weights, WEIGHT_VARIANTS, 'weight variants'),
+        _names(args.search_modes, SEARCH_MODES, 'search modes') or SEARCH_MODES
+    )
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
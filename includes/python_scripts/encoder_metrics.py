@@ -0,0 +1,68 @@
+import threading
+
+# Latency histogram bucket upper bounds in seconds (Prometheus convention)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class StageMetrics:
+    """Thread-safe per-stage latency histograms and counters shared by ImageEncoder instances"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    def observe(self, stage, seconds):
+        """Add one latency sample for a stage"""
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram['counts'][i] += 1
+                    break
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    def increment(self, counter, amount=1):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + amount
+
+    def snapshot(self):
+        """Counters and per-stage count/sum/mean as a JSON-friendly dict"""
+        with self._lock:
+            stages = {
+                stage: {
+                    'count': histogram['count'],
+                    'total_ms': round(histogram['sum'] * 1000, 3),
+                    'mean_ms': round(histogram['sum'] * 1000 / histogram['count'], 3) if histogram['count'] else 0.0
+                }
+                for stage, histogram in self._histograms.items()
+            }
+            return {'stages': stages, 'counters': dict(self._counters)}
+
+    def prometheus_text(self, prefix='face_encoder'):
+        """Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        with self._lock:
+            if self._histograms:
+                lines.append(f'# HELP {prefix}_stage_seconds Time spent in each encoder stage')
+                lines.append(f'# TYPE {prefix}_stage_seconds histogram')
+                for stage in sorted(self._histograms):
+                    histogram = self._histograms[stage]
+                    cumulative = 0
+                    for bound, count in zip(self.buckets, histogram['counts']):
+                        cumulative += count
+                        lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                    lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+                    lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {histogram["sum"]:.6f}')
+                    lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+
+            for counter in sorted(self._counters):
+                name = f'{prefix}_{counter}_total'
+                lines.append(f'# TYPE {name} counter')
+                lines.append(f'{name} {self._counters[counter]}')
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,696 @@
+import argparse
+import json
+import os
+import queue
+import signal
+import socketserver
+import sys
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from opencv_face_encoder import (DETECTION_MODES, ENCODING_FORMATS, ImageEncoder, configure_opencv_threads,
+                                 encode_features)
+
+MAX_REQUEST_BYTES = 10 * 1024 * 1024  # Uploads are capped at 5MB by PHP; leave headroom for multipart overhead
+SERVICE_NAME = 'OpenCV Face Encoder Service'
+
+
+class EncoderService:
+    """Resident encoder state shared by every request: warm cascades and gallery"""
+
+    def __init__(self, workers=2, gallery_dir=None, detection_mode='exhaustive', encoding_format='json',
+                 cache_size=256, cache_dir=None, metrics=False, job_db=None, job_workers=1, max_pending_jobs=500,
+                 max_decode_side=None, detection_threads=1, opencv_threads=None, compact_interval=300,
+                 include_thumbnail=True):
+        # Stage timings from every worker aggregate into one StageMetrics
+        self.metrics = None
+        if metrics:
+            from encoder_metrics import StageMetrics
+            self.metrics = StageMetrics()
+
+        # One result cache shared by all workers, so a resubmitted photo is never decoded twice
+        self.result_cache = None
+        if cache_size > 0:
+            from result_cache import ResultCache
+            self.result_cache = ResultCache(cache_size, cache_dir)
+
+        # One warm ImageEncoder per worker; cascade classifiers are not shared across threads
+        self.workers = max(1, int(workers))
+        self.detection_mode = detection_mode
+        self.include_thumbnail = include_thumbnail
+
+        # Split the cores between request workers and parallel detector passes (see configure_opencv_threads)
+        self.detection_threads = max(1, int(detection_threads))
+        self.opencv_threads = configure_opencv_threads(self.workers, self.detection_threads, opencv_threads)
+        self.encoders = queue.Queue()
+        for _ in range(self.workers):
+            encoder = ImageEncoder(detection_mode=detection_mode, encoding_format=encoding_format)
+            encoder.result_cache = self.result_cache
+            encoder.max_decode_side = max_decode_side
+            encoder.detection_threads = self.detection_threads
+            encoder.include_thumbnail = include_thumbnail
+            if self.metrics is not None:
+                encoder.enable_metrics(self.metrics)
+            self.encoders.put(encoder)
+
+        self.gallery = None
+        self.compactor = None
+        if gallery_dir:
+            from face_gallery import FaceGallery, GalleryCompactor
+            self.gallery = FaceGallery(gallery_dir)
+            # Tombstones left by /gallery/sync are compacted in the background, never on a request
+            if compact_interval > 0:
+                self.compactor = GalleryCompactor(self.gallery, interval=compact_interval)
+                self.compactor.start()
+
+        self.started_at = time.time()
+        # Handler threads count concurrently; a bare += loses increments under load
+        self.requests_served = 0
+        self._requests_lock = threading.Lock()
+
+        # Durable queue for /register/async; job workers borrow encoders from the same pool
+        self.jobs = None
+        self.job_pool = None
+        if job_db:
+            from registration_jobs import JobQueue, JobWorkerPool
+            self.jobs = JobQueue(job_db, max_pending=max_pending_jobs)
+            self.job_pool = JobWorkerPool(self.jobs, self._run_registration_job, workers=job_workers,
+                                          on_finished=self._discard_spooled_upload)
+            self.job_pool.start()
+
+    def count_request(self):
+        with self._requests_lock:
+            self.requests_served += 1
+
+    def _borrow(self):
+        return self.encoders.get()
+
+    def _release(self, encoder):
+        self.encoders.put(encoder)
+
+    def _timed(self, encoder, payload):
+        """Add the encoder's stage timing block to a response when metrics are enabled"""
+        if self.metrics is not None and isinstance(payload, dict) and encoder.last_timing is not None:
+            payload['timing'] = encoder.last_timing
+            encoder.last_timing = None
+        return payload
+
+    def metrics_text(self):
+        """Prometheus text for stage histograms, counters and the result cache"""
+        text = self.metrics.prometheus_text() if self.metrics is not None else ''
+        if self.result_cache is not None:
+            stats = self.result_cache.stats()
+            for name in ('hits', 'disk_hits', 'misses', 'evictions'):
+                text += f'# TYPE face_encoder_result_cache_{name}_total counter\n'
+                text += f'face_encoder_result_cache_{name}_total {stats[name]}\n'
+        text += '# TYPE face_encoder_requests_served_total counter\n'
+        text += f'face_encoder_requests_served_total {self.requests_served}\n'
+        return text
+
+    def _with_upload(self, files, callback):
+        """Run callback(encoder, image_bytes) on the uploaded 'file' field"""
+        upload = files.get('file') or files.get('image')
+        if upload is None:
+            return 400, {'success': False, 'message': "Missing 'file' upload", 'data': None}
+
+        filename, content = upload
+        ext = os.path.splitext(filename or '')[1].lower().lstrip('.') or 'jpg'
+
+        encoder = self._borrow()
+        try:
+            if ext not in encoder.supported_formats:
+                return 200, {'success': False,
+                             'message': f"Unsupported format. Supported formats: {', '.join(encoder.supported_formats)}",
+                             'data': None}
+            # The encoder decodes straight from memory; no temp file round trip
+            return 200, self._timed(encoder, callback(encoder, content))
+        finally:
+            self._release(encoder)
+
+    def info(self):
+        info = {
+            'service': SERVICE_NAME,
+            'status': 'ok',
+            'workers': self.workers,
+            'detection_mode': self.detection_mode,
+            'detection_threads': self.detection_threads,
+            'opencv_threads': self.opencv_threads,
+            'include_thumbnail': self.include_thumbnail,
+            'encoding_formats': list(ENCODING_FORMATS),
+            'uptime_seconds': round(time.time() - self.started_at, 1),
+            'requests_served': self.requests_served,
+            'endpoints': ['/register', '/register/async', '/register/base64', '/extract-features', '/validate',
+                          '/compare', '/identify', '/identify-group', '/gallery/add', '/gallery/remove',
+                          '/gallery/partition', '/gallery/sync', '/thumbnail',
+                          '/gallery/add-template']
+        }
+        if self.gallery is not None:
+            self.gallery.refresh()
+            info['gallery'] = self.gallery.info()
+        if self.result_cache is not None:
+            info['result_cache'] = self.result_cache.stats()
+        if self.jobs is not None:
+            info['jobs'] = self.jobs.counts()
+        return 200, info
+
+    def _requested_format(self, fields):
+        """Per-request encoding_format override; None means the encoder default"""
+        encoding_format = fields.get('encoding_format') or None
+        if encoding_format is not None and encoding_format not in ENCODING_FORMATS:
+            raise ValueError(f"Unknown encoding_format '{encoding_format}'. Use one of: {', '.join(ENCODING_FORMATS)}")
+        return encoding_format
+
+    def _requested_thumbnail(self, fields):
+        """Per-request include_thumbnail override; None means the encoder default"""
+        value = fields.get('include_thumbnail')
+        if value is None or value == '':
+            return None
+        return str(value).lower() in ('1', 'true', 'yes')
+
+    def register(self, fields, files):
+        student_id = fields.get('student_id')
+        if not student_id:
+            return 400, {'success': False, 'message': "Missing 'student_id'", 'data': None}
+        encoding_format = self._requested_format(fields)
+        include_thumbnail = self._requested_thumbnail(fields)
+
+        def run(encoder, image_data):
+            result = encoder.process_student_image(image_data, student_id, encoding_format, include_thumbnail)
+            self._maybe_enroll(fields, student_id, result)
+            return result
+
+        return self._with_upload(files, run)
+
+    def register_base64(self, body):
+        import base64
+
+        student_id = body.get('student_id')
+        image_data = body.get('image_data')
+        if not student_id or not image_data:
+            return 400, {'success': False, 'message': "Both 'image_data' and 'student_id' are required", 'data': None}
+
+        # Accept data URLs as sent by the webcam capture page
+        if isinstance(image_data, str) and image_data.startswith('data:') and ',' in image_data:
+            header, image_data = image_data.split(',', 1)
+            ext = '.' + header.split('/')[1].split(';')[0]
+        else:
+            ext = '.' + body.get('format', 'jpg')
+
+        try:
+            content = base64.b64decode(image_data)
+        except Exception as e:
+            return 400, {'success': False, 'message': f'Invalid base64 image data: {str(e)}', 'data': None}
+
+        return self.register(body, {'file': ('upload' + ext, content)})
+
+    def register_async(self, fields, files):
+        """Queue a registration and return its job id straight away"""
+        from registration_jobs import QueueFull
+
+        if self.jobs is None:
+            return 400, {'success': False, 'message': 'No job queue configured', 'data': None}
+        student_id = fields.get('student_id')
+        if not student_id:
+            return 400, {'success': False, 'message': "Missing 'student_id'", 'data': None}
+        upload = files.get('file') or files.get('image')
+        if upload is None:
+            return 400, {'success': False, 'message': "Missing 'file' upload", 'data': None}
+
+        job_id = self.jobs.new_job_id()
+        image_path = self.jobs.spool_upload(job_id, upload[0], upload[1])
+        payload = {
+            'image_path': image_path,
+            'student_id': student_id,
+            'encoding_format': self._requested_format(fields),
+            'include_thumbnail': self._requested_thumbnail(fields),
+            'enroll': fields.get('enroll'),
+            'reg_number': fields.get('reg_number'),
+            'callback_url': fields.get('callback_url')
+        }
+        try:
+            self.jobs.submit('register', payload, job_id)
+        except QueueFull:
+            self._discard_spooled_upload({'payload': payload})
+            return 429, {'success': False, 'message': 'Registration queue is full, please retry shortly', 'data': None}
+
+        self.job_pool.notify()
+        return 200, {
+            'success': True,
+            'message': 'Registration queued',
+            'data': {'job_id': job_id, 'status': 'queued', 'status_url': f'/jobs/{job_id}'}
+        }
+
+    def job_status(self, job_id):
+        if self.jobs is None:
+            return 400, {'success': False, 'message': 'No job queue configured', 'data': None}
+        job = self.jobs.get(job_id)
+        if job is None:
+            return 404, {'success': False, 'message': f'Unknown job: {job_id}', 'data': None}
+        return 200, {
+            'success': True,
+            'message': f"Job {job['status']}",
+            'data': {
+                'job_id': job['id'],
+                'status': job['status'],
+                'attempts': job['attempts'],
+                'created_at': job['created_at'],
+                'started_at': job['started_at'],
+                'finished_at': job['finished_at'],
+                'error': job['error'],
+                'result': job['result']
+            }
+        }
+
+    def _run_registration_job(self, job):
+        payload = job['payload']
+        encoder = self._borrow()
+        try:
+            result = encoder.process_student_image(payload['image_path'], payload['student_id'],
+                                                   payload.get('encoding_format'), payload.get('include_thumbnail'))
+        finally:
+            self._release(encoder)
+        self._maybe_enroll(payload, payload['student_id'], result)
+        return result
+
+    def _discard_spooled_upload(self, job):
+        try:
+            os.remove(job['payload']['image_path'])
+        except OSError:
+            pass
+
+    def _maybe_enroll(self, fields, student_id, result):
+        """Append a successful registration to the gallery when the caller asks for it"""
+        if self.gallery is None or not result.get('success'):
+            return
+        if str(fields.get('enroll', '')).lower() not in ('1', 'true', 'yes'):
+            return
+        try:
+            row = self.gallery.add(student_id, result['data']['face_encoding'], reg_number=fields.get('reg_number'))
+            result['data']['gallery_row'] = row
+        except Exception as e:
+            result['data']['gallery_error'] = str(e)
+
+    def extract_features(self, fields, files):
+        encoding_format = self._requested_format(fields)
+        include_thumbnail = self._requested_thumbnail(fields)
+
+        def run(encoder, image_data):
+            face_data, message = encoder.extract_face_features(image_data, include_thumbnail)
+            fmt = encoding_format or encoder.encoding_format
+            if face_data is not None and fmt != 'json':
+                face_data['features'] = encode_features(face_data['features'], fmt)
+                face_data['encoding_format'] = fmt
+            return {
+                'success': face_data is not None,
+                'message': message,
+                'data': face_data
+            }
+
+        return self._with_upload(files, run)
+
+    def thumbnail(self, fields, files):
+        """Face crop for a face_region from an earlier response that skipped the thumbnail"""
+        if not fields.get('face_region'):
+            return 400, {'success': False, 'message': "Missing 'face_region'", 'data': None}
+        face_region = json.loads(fields['face_region'])
+
+        def run(encoder, image_data):
+            face_image, message = encoder.face_thumbnail(image_data, face_region)
+            return {
+                'success': face_image is not None,
+                'message': message,
+                'data': {'face_image_base64': face_image} if face_image is not None else None
+            }
+
+        return self._with_upload(files, run)
+
+    def validate(self, fields, files):
+        def run(encoder, image_data):
+            is_valid, message = encoder.validate_image(image_data)
+            return {'is_valid': is_valid, 'message': message}
+
+        return self._with_upload(files, run)
+
+    def compare(self, body):
+        if 'features1' not in body or 'features2' not in body:
+            return 400, {'is_match': False, 'error': "Both 'features1' and 'features2' are required"}
+
+        encoder = self._borrow()
+        try:
+            return 200, self._timed(encoder, encoder.compare_faces(body['features1'], body['features2'],
+                                                                   body.get('threshold', 0.6)))
+        finally:
+            self._release(encoder)
+
+    def identify(self, body):
+        if 'probe' not in body:
+            return 400, {'success': False, 'matches': [], 'error': "Missing 'probe'"}
+
+        top_k = body.get('top_k', 5)
+        threshold = body.get('threshold', 0.6)
+        search_mode = body.get('search_mode', 'exact')
+        rerank_candidates = body.get('rerank_candidates')
+        aggregate = body.get('aggregate') or None
+
+        encoder = self._borrow()
+        try:
+            # Without an explicit gallery, search the resident gallery store
+            if 'gallery' in body:
+                return 200, self._timed(encoder, encoder.identify(body['probe'], body['gallery'], top_k, threshold,
+                                                                  body.get('gallery_ids'), search_mode=search_mode,
+                                                                  rerank_candidates=rerank_candidates,
+                                                                  aggregate=aggregate,
+                                                                  identity_thresholds=body.get('identity_thresholds')))
+            if self.gallery is None:
+                return 400, {'success': False, 'matches': [], 'error': 'No gallery supplied and no gallery store configured'}
+            return 200, self._timed(encoder, self.gallery.identify(encoder, body['probe'], top_k, threshold, search_mode,
+                                                                   rerank_candidates,
+                                                                   candidate_ids=body.get('candidate_ids'),
+                                                                   partition=self._partition_name(body),
+                                                                   aggregate=aggregate,
+                                                                   calibrated=bool(body.get('calibrated'))))
+        finally:
+            self._release(encoder)
+
+    def identify_group(self, fields, files):
+        """Identify every face of a classroom frame; gallery fields arrive as JSON-encoded form values"""
+        top_k = int(fields.get('top_k', 3))
+        threshold = float(fields.get('threshold', 0.6))
+        search_mode = fields.get('search_mode', 'exact')
+        rerank_candidates = int(fields['rerank_candidates']) if fields.get('rerank_candidates') else None
+        max_faces = int(fields['max_faces']) if fields.get('max_faces') else None
+        include_thumbnails = str(fields.get('include_thumbnails', '')).lower() in ('1', 'true', 'yes')
+        aggregate = fields.get('aggregate') or None
+        calibrated = str(fields.get('calibrated', '')).lower() in ('1', 'true', 'yes')
+
+        gallery = json.loads(fields['gallery']) if fields.get('gallery') else None
+        gallery_ids = json.loads(fields['gallery_ids']) if fields.get('gallery_ids') else None
+        candidate_ids = json.loads(fields['candidate_ids']) if fields.get('candidate_ids') else None
+        identity_thresholds = json.loads(fields['identity_thresholds']) if fields.get('identity_thresholds') else None
+        if gallery is None and self.gallery is None:
+            return 400, {'success': False, 'faces': [], 'message': 'No gallery supplied and no gallery store configured'}
+
+        def run(encoder, image_data):
+            group, message = encoder.extract_all_face_features(image_data, max_faces, include_thumbnails)
+            if group is None:
+                return {'success': False, 'message': message, 'faces': []}
+
+            probes = [face['features'] for face in group['faces']]
+            if gallery is not None:
+                batch = encoder.identify_faces(probes, gallery, top_k, threshold, gallery_ids,
+                                               search_mode=search_mode, rerank_candidates=rerank_candidates,
+                                               aggregate=aggregate, identity_thresholds=identity_thresholds)
+            else:
+                batch = self.gallery.identify_many(encoder, probes, top_k, threshold, search_mode, rerank_candidates,
+                                                   candidate_ids=candidate_ids, partition=self._partition_name(fields),
+                                                   aggregate=aggregate, calibrated=calibrated)
+            return encoder.group_response(group, batch, message)
+
+        return self._with_upload(files, run)
+
+    def _partition_name(self, body):
+        """Named partition from 'partition' or a course_id/session_year/semester triple"""
+        if body.get('partition'):
+            return body['partition']
+        if body.get('course_id') is not None and body.get('session_year') and body.get('semester'):
+            return self.gallery.course_partition(body['course_id'], body['session_year'], body['semester'])
+        return None
+
+    def gallery_partition(self, body):
+        """Set (with 'student_ids') or drop a named candidate partition"""
+        if self.gallery is None:
+            return 400, {'success': False, 'message': 'No gallery store configured'}
+        name = self._partition_name(body)
+        if not name:
+            return 400, {'success': False, 'message': "Missing 'partition' or course_id/session_year/semester"}
+        if body.get('student_ids') is None:
+            return 200, {'success': True, 'partition': name, 'dropped': self.gallery.drop_partition(name)}
+        self.gallery.set_partition(name, body['student_ids'])
+        return 200, {'success': True, 'partition': name, 'members': len(body['student_ids'])}
+
+    def gallery_sync(self, body=None):
+        """Apply a change-feed batch ('changes', 'high_water_mark'); without a body report the current mark"""
+        if self.gallery is None:
+            return 400, {'success': False, 'message': 'No gallery store configured'}
+        if body is None:
+            return 200, {'success': True, 'high_water_mark': self.gallery.sync_mark, 'live_rows': len(self.gallery)}
+        if not isinstance(body.get('changes'), list):
+            return 400, {'success': False, 'message': "Missing 'changes' list"}
+        summary = self.gallery.apply_changes(body['changes'], body.get('high_water_mark'))
+        return 200, dict({'success': True}, **summary)
+
+    def gallery_add(self, body):
+        if self.gallery is None:
+            return 400, {'success': False, 'message': 'No gallery store configured'}
+        try:
+            row = self.gallery.add(body['id'], body['features'], reg_number=body.get('reg_number'))
+            return 200, {'success': True, 'message': 'Enrollment stored', 'row': row}
+        except Exception as e:
+            return 400, {'success': False, 'message': f'Gallery error: {str(e)}'}
+
+    def gallery_add_template(self, body):
+        """Add an extra template (e.g. an accepted attendance capture) for an enrolled student"""
+        from face_gallery import DEFAULT_MAX_TEMPLATES
+
+        if self.gallery is None:
+            return 400, {'success': False, 'message': 'No gallery store configured'}
+        try:
+            result = self.gallery.add_template(body['id'], body['features'], source=body.get('source', 'attendance'),
+                                               max_templates=body.get('max_templates', DEFAULT_MAX_TEMPLATES),
+                                               eviction=body.get('eviction', 'oldest'))
+            return 200, {'success': True, 'message': 'Template stored', **result}
+        except Exception as e:
+            return 400, {'success': False, 'message': f'Gallery error: {str(e)}'}
+
+    def gallery_remove(self, body):
+        if self.gallery is None:
+            return 400, {'success': False, 'message': 'No gallery store configured'}
+        if 'id' not in body:
+            return 400, {'success': False, 'message': "Missing 'id'"}
+        return 200, {'success': True, 'removed_rows': self.gallery.remove(body['id'])}
+
+
+class EncoderRequestHandler(BaseHTTPRequestHandler):
+    """HTTP front end for EncoderService, matching the endpoints FaceRecognitionManager calls"""
+
+    server_version = 'FaceEncoder/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    multipart_routes = {
+        '/register': 'register',
+        '/register/async': 'register_async',
+        '/extract-features': 'extract_features',
+        '/validate': 'validate',
+        '/thumbnail': 'thumbnail',
+        '/identify-group': 'identify_group'
+    }
+    json_routes = {
+        '/register/base64': 'register_base64',
+        '/compare': 'compare',
+        '/identify': 'identify',
+        '/gallery/add': 'gallery_add',
+        '/gallery/add-template': 'gallery_add_template',
+        '/gallery/remove': 'gallery_remove',
+        '/gallery/partition': 'gallery_partition',
+        '/gallery/sync': 'gallery_sync'
+    }
+
+    def address_string(self):
+        # Unix socket clients have no address tuple
+        if isinstance(self.client_address, tuple) and self.client_address:
+            return str(self.client_address[0])
+        return 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            sys.stderr.write("%s - %s\n" % (self.address_string(), format % args))
+
+    def _send_text(self, status, text, content_type='text/plain; version=0.0.4'):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_REQUEST_BYTES:
+            raise ValueError('Request body too large')
+        return self.rfile.read(length) if length > 0 else b''
+
+    def _parse_multipart(self, body):
+        """Split a multipart/form-data body into text fields and (filename, bytes) files"""
+        content_type = self.headers.get('Content-Type', '')
+        message = BytesParser(policy=default_policy).parsebytes(
+            b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body
+        )
+        fields, files = {}, {}
+        if not message.is_multipart():
+            return fields, files
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if not name:
+                continue
+            payload = part.get_payload(decode=True) or b''
+            filename = part.get_filename()
+            if filename is not None:
+                files[name] = (filename, payload)
+            else:
+                fields[name] = payload.decode('utf-8', errors='replace')
+        return fields, files
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0].rstrip('/') or '/'
+        if path in ('/', '/health'):
+            status, payload = self.server.service.info()
+            self._send_json(status, payload)
+        elif path == '/metrics':
+            self._send_text(200, self.server.service.metrics_text())
+        elif path == '/gallery/sync':
+            status, payload = self.server.service.gallery_sync()
+            self._send_json(status, payload)
+        elif path.startswith('/jobs/'):
+            status, payload = self.server.service.job_status(path[len('/jobs/'):])
+            self._send_json(status, payload)
+        else:
+            self._send_json(404, {'success': False, 'message': f'Unknown endpoint: {path}'})
+
+    def do_POST(self):
+        path = self.path.split('?', 1)[0].rstrip('/')
+        service = self.server.service
+        started = time.perf_counter()
+
+        try:
+            body = self._read_body()
+
+            if path in self.multipart_routes:
+                fields, files = self._parse_multipart(body)
+                status, payload = getattr(service, self.multipart_routes[path])(fields, files)
+            elif path in self.json_routes:
+                data = json.loads(body.decode('utf-8') or '{}')
+                if not isinstance(data, dict):
+                    raise ValueError('JSON body must be an object')
+                status, payload = getattr(service, self.json_routes[path])(data)
+            else:
+                status, payload = 404, {'success': False, 'message': f'Unknown endpoint: {path}'}
+
+        except KeyError as e:
+            status, payload = 404, {'success': False, 'message': f'Not found: {str(e)}', 'data': None}
+        except Exception as e:
+            status, payload = 400, {'success': False, 'message': f'Bad request: {str(e)}', 'data': None}
+
+        service.count_request()
+        self._send_json(status, payload)
+        if service.metrics is not None:
+            service.metrics.observe(f'http:{path}', time.perf_counter() - started)
+
+
+class EncoderHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service, verbose=False):
+        self.service = service
+        self.verbose = verbose
+        super().__init__(address, EncoderRequestHandler)
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class EncoderUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def __init__(self, socket_path, service, verbose=False):
+            self.service = service
+            self.verbose = verbose
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            super().__init__(socket_path, EncoderRequestHandler)
+
+
+def run_server(host='127.0.0.1', port=8765, unix_socket=None, workers=2, gallery_dir=None, verbose=False,
+               detection_mode='exhaustive', encoding_format='json', cache_size=256, cache_dir=None, metrics=False,
+               job_db=None, job_workers=1, max_pending_jobs=500, max_decode_side=None, detection_threads=1,
+               opencv_threads=None, compact_interval=300, include_thumbnail=True):
+    """Start the resident encoder service and block until interrupted"""
+    service = EncoderService(workers=workers, gallery_dir=gallery_dir, detection_mode=detection_mode,
+                             encoding_format=encoding_format, cache_size=cache_size, cache_dir=cache_dir,
+                             metrics=metrics, job_db=job_db, job_workers=job_workers,
+                             max_pending_jobs=max_pending_jobs, max_decode_side=max_decode_side,
+                             detection_threads=detection_threads, opencv_threads=opencv_threads,
+                             compact_interval=compact_interval, include_thumbnail=include_thumbnail)
+
+    if unix_socket:
+        server = EncoderUnixServer(unix_socket, service, verbose)
+        where = f'unix:{unix_socket}'
+    else:
+        server = EncoderHTTPServer((host, port), service, verbose)
+        where = f'http://{host}:{server.server_address[1]}'
+
+    # Treat SIGTERM from a process supervisor like Ctrl+C so the socket is cleaned up
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    sys.stderr.write(f"{SERVICE_NAME} listening on {where} with {service.workers} worker(s)\n")
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        if service.job_pool is not None:
+            service.job_pool.stop()
+        if service.compactor is not None:
+            service.compactor.stop()
+        server.server_close()
+        if unix_socket and os.path.exists(unix_socket):
+            os.remove(unix_socket)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Resident face encoder service for FaceRecognitionManager')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix-socket', help='Listen on a Unix domain socket instead of TCP')
+    parser.add_argument('--workers', type=int, default=2, help='Number of warm ImageEncoder instances')
+    parser.add_argument('--gallery', help='Gallery directory used by /identify and enrollment')
+    parser.add_argument('--detection-mode', choices=DETECTION_MODES, default='exhaustive',
+                        help="'tiered' stops at the first detector pass that finds a face")
+    parser.add_argument('--encoding-format', choices=ENCODING_FORMATS, default='json',
+                        help='Default face encoding format in responses (requests may override it)')
+    parser.add_argument('--cache-size', type=int, default=256,
+                        help='Validate/extract results kept in memory by image content hash (0 disables the cache)')
+    parser.add_argument('--cache-dir', help='Optional on-disk tier for the result cache')
+    parser.add_argument('--metrics', action='store_true',
+                        help='Collect per-stage timings: a timing block in responses and Prometheus text on /metrics')
+    parser.add_argument('--job-db', help='SQLite file for queued /register/async jobs (enables async registration)')
+    parser.add_argument('--job-workers', type=int, default=1, help='Threads processing queued registrations')
+    parser.add_argument('--max-pending-jobs', type=int, default=500,
+                        help='Queued registrations accepted before /register/async answers 429')
+    parser.add_argument('--max-decode-side', type=int, default=None,
+                        help='Decode large JPEGs at 1/2, 1/4 or 1/8 scale down to about this many pixels on the longest side')
+    parser.add_argument('--compact-interval', type=float, default=300,
+                        help='Seconds between background checks for gallery tombstones to compact (0 disables)')
+    # Low latency for one request at a time: --workers 1 --detection-threads <cores>
+    # High throughput under concurrent load: --workers <cores> --detection-threads 1 (the default)
+    parser.add_argument('--detection-threads', type=int, default=1,
+                        help='Threads running the exhaustive detector passes of one request in parallel')
+    parser.add_argument('--opencv-threads', type=int, default=None,
+                        help='OpenCV internal threads (default: cores / (workers * detection threads))')
+    parser.add_argument('--no-thumbnails', action='store_true',
+                        help='Leave face_image_base64 empty unless a request sets include_thumbnail (see /thumbnail)')
+    parser.add_argument('--verbose', action='store_true', help='Log every request to stderr')
+    args = parser.parse_args()
+
+    run_server(args.host, args.port, args.unix_socket, args.workers, args.gallery, args.verbose, args.detection_mode,
+               args.encoding_format, args.cache_size, args.cache_dir, args.metrics, args.job_db, args.job_workers,
+               args.max_pending_jobs, args.max_decode_side, args.detection_threads, args.opencv_threads,
+               args.compact_interval, not args.no_thumbnails)
@@ -0,0 +1,837 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from opencv_face_encoder import EXTRACTION_METHOD, decode_features
+
+try:
+    import fcntl
+except ImportError:  # Windows (XAMPP) has no fcntl; single-writer use only
+    fcntl = None
+
+GALLERY_FORMAT_VERSION = 1
+DEFAULT_FEATURE_DIM = 470
+DEFAULT_EXTRACTION_METHOD = EXTRACTION_METHOD
+
+META_FILE = 'meta.json'
+MATRIX_FILE = 'encodings.f32'
+INDEX_FILE = 'index.jsonl'
+LOCK_FILE = 'gallery.lock'
+PARTITIONS_FILE = 'partitions.json'
+THRESHOLDS_FILE = 'thresholds.json'
+
+MAX_CACHED_SLICES = 256
+
+# Templates kept per student (registration photo included) and how extra captures are evicted:
+# 'oldest' drops the earliest capture, 'redundant' the capture most similar to the student's other templates
+DEFAULT_MAX_TEMPLATES = 5
+TEMPLATE_EVICTION_POLICIES = ('oldest', 'redundant')
+ENROLLMENT_TEMPLATE = 'enrollment'
+
+
+class FaceGallery:
+    """Persistent memory-mapped store of enrolled face encodings
+
+    Layout of a gallery directory:
+      meta.json     - format version, feature dimension, extraction method, generation
+      encodings.f32 - contiguous little-endian float32 matrix, one row per enrollment
+      index.jsonl   - append-only log of {"op": "add"|"delete", ...} records
+
+    Rows are only ever appended. Deleting or re-enrolling a student tombstones
+    the old row; compact() rewrites the files without tombstoned rows. Readers
+    map the matrix read-only, so every worker process shares the same pages.
+
+    A student may hold several rows: the registration template plus captures
+    added with add_template() (e.g. accepted attendance photos), capped per
+    student. calibrate_thresholds() derives per-student thresholds from the
+    stored score distributions and keeps them in thresholds.json.
+
+    apply_changes() takes incremental batches from the students table (a change
+    feed); meta.json keeps the feed's high-water mark so a restart resumes from it.
+    """
+
+    def __init__(self, gallery_dir, dim=DEFAULT_FEATURE_DIM, extraction_method=DEFAULT_EXTRACTION_METHOD):
+        self.gallery_dir = gallery_dir
+        self.meta_path = os.path.join(gallery_dir, META_FILE)
+        self.matrix_path = os.path.join(gallery_dir, MATRIX_FILE)
+        self.index_path = os.path.join(gallery_dir, INDEX_FILE)
+        self.lock_path = os.path.join(gallery_dir, LOCK_FILE)
+        self.partitions_path = os.path.join(gallery_dir, PARTITIONS_FILE)
+        self.thresholds_path = os.path.join(gallery_dir, THRESHOLDS_FILE)
+
+        # Guards in-process state when one gallery is shared by server threads; writers serialize
+        # on a separate lock so searches keep running while a write or compaction is in progress
+        self._state_lock = threading.RLock()
+        self._write_lock = threading.Lock()
+
+        os.makedirs(gallery_dir, exist_ok=True)
+
+        if not os.path.exists(self.meta_path):
+            self._write_meta({
+                'version': GALLERY_FORMAT_VERSION,
+                'dim': int(dim),
+                'dtype': '<f4',
+                'extraction_method': extraction_method,
+                'generation': 0
+            })
+            for path in (self.matrix_path, self.index_path):
+                open(path, 'ab').close()
+
+        self.meta = self._read_meta()
+        if self.meta.get('version') != GALLERY_FORMAT_VERSION:
+            raise ValueError(f"Unsupported gallery format version: {self.meta.get('version')}")
+        self.dim = int(self.meta['dim'])
+        self.extraction_method = self.meta.get('extraction_method', DEFAULT_EXTRACTION_METHOD)
+
+        # Named candidate subsets (e.g. one course's enrolled students) and their cached row slices
+        self._partitions = self._read_partitions()
+        self._slice_cache = OrderedDict()
+        self._state_version = 0
+
+        # Calibrated per-student thresholds, reloaded when thresholds.json changes on disk
+        self._thresholds = None
+        self._thresholds_mtime = None
+
+        self._reset_state()
+        self.refresh()
+
+    def _reset_state(self):
+        """Forget everything loaded from the index log"""
+        self._state_version = getattr(self, '_state_version', 0) + 1
+        self._generation = None
+        self._index_offset = 0
+        self.ids = []
+        self.reg_numbers = []
+        self.versions = []
+        self.templates = []
+        self._live = np.zeros(0, dtype=bool)
+        self._rows_by_id = {}
+        self._matrix = np.empty((0, self.dim), dtype=np.float32)
+        self._mapped_rows = 0
+        self._codes = np.empty((0, self.dim), dtype=np.int8)
+
+    def _read_meta(self):
+        with open(self.meta_path, 'r') as f:
+            return json.load(f)
+
+    def _write_meta(self, meta):
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def _lock(self):
+        """Exclusive writer lock shared by every thread and process using this gallery"""
+        self._write_lock.acquire()
+        handle = open(self.lock_path, 'a')
+        if fcntl is not None:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+        return handle
+
+    def _unlock(self, handle):
+        if fcntl is not None:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+        handle.close()
+        self._write_lock.release()
+
+    def refresh(self):
+        """Apply index records written since the last refresh (by any process)"""
+        with self._state_lock:
+            self._refresh_locked()
+
+    def _refresh_locked(self):
+        meta = self._read_meta()
+        if meta.get('generation') != self._generation:
+            # The gallery was compacted: start over from the new files
+            self.meta = meta
+            self._reset_state()
+            self._generation = meta.get('generation')
+
+        with open(self.index_path, 'rb') as f:
+            f.seek(self._index_offset)
+            data = f.read()
+
+        # Ignore a trailing partial line still being written by another process
+        complete = data[:data.rfind(b'\n') + 1]
+        self._index_offset += len(complete)
+
+        live_updates = []
+        for line in complete.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record['op'] == 'add':
+                row = record['row']
+                self.ids.append(record['id'])
+                self.reg_numbers.append(record.get('reg_number'))
+                self.versions.append(record.get('version'))
+                self.templates.append(record.get('template', ENROLLMENT_TEMPLATE))
+                self._rows_by_id.setdefault(self._key(record['id']), []).append(row)
+                live_updates.append((row, True))
+            elif record['op'] == 'delete':
+                for row in record['rows']:
+                    live_updates.append((row, False))
+                    rows = self._rows_by_id.get(self._key(self.ids[row]), [])
+                    if row in rows:
+                        rows.remove(row)
+
+        if live_updates:
+            self._state_version += 1
+            if len(self._live) < len(self.ids):
+                self._live = np.concatenate([self._live, np.zeros(len(self.ids) - len(self._live), dtype=bool)])
+            for row, alive in live_updates:
+                self._live[row] = alive
+
+        self._map_matrix()
+
+    def _map_matrix(self):
+        """(Re)open the read-only memory map when the row count has grown"""
+        rows = len(self.ids)
+        if rows == self._mapped_rows:
+            return
+        if rows == 0:
+            self._matrix = np.empty((0, self.dim), dtype=np.float32)
+        else:
+            self._matrix = np.memmap(self.matrix_path, dtype='<f4', mode='r', shape=(rows, self.dim))
+        self._mapped_rows = rows
+
+    @staticmethod
+    def _key(student_id):
+        """Index key so 12 and '12' refer to the same student"""
+        return str(student_id)
+
+    @property
+    def matrix(self):
+        """Read-only memory-mapped view of every stored row (including tombstones)"""
+        return self._matrix
+
+    @property
+    def live_mask(self):
+        """Boolean mask of rows that have not been tombstoned"""
+        return self._live
+
+    def __len__(self):
+        return int(self._live.sum())
+
+    def __contains__(self, student_id):
+        return bool(self._rows_by_id.get(self._key(student_id)))
+
+    def rows_for(self, student_id):
+        """Live row indices enrolled for a student"""
+        return list(self._rows_by_id.get(self._key(student_id), []))
+
+    def _prepare_features(self, features):
+        """Decode and clean one encoding before it is written to the matrix"""
+        vector = np.nan_to_num(decode_features(features), nan=0.0)
+        if vector.ndim != 1 or vector.shape[0] != self.dim:
+            raise ValueError(f"Expected a {self.dim}-value feature vector, got shape {vector.shape}")
+        return vector
+
+    def version_of(self, student_id):
+        """Change-feed version of a student's newest live registration row, or None"""
+        rows = self._rows_by_id.get(self._key(student_id), [])
+        enrollments = [row for row in rows if self.templates[row] == ENROLLMENT_TEMPLATE]
+        return self.versions[enrollments[-1]] if enrollments else None
+
+    def add(self, student_id, features, reg_number=None, replace=True, version=None):
+        """Append an enrollment; with replace=True older rows for the student are tombstoned"""
+        vector = self._prepare_features(features)
+
+        handle = self._lock()
+        try:
+            self.refresh()
+            return self._add_locked(student_id, vector, reg_number, replace, version)
+        finally:
+            self._unlock(handle)
+
+    def _add_locked(self, student_id, vector, reg_number, replace, version=None, template=None):
+        row = len(self.ids)
+
+        # Write the row before its index record so readers never see a partial row
+        with open(self.matrix_path, 'r+b') as f:
+            f.seek(row * self.dim * 4)
+            f.write(vector.astype('<f4').tobytes())
+
+        records = []
+        old_rows = self.rows_for(student_id) if replace else []
+        if old_rows:
+            records.append({'op': 'delete', 'rows': old_rows})
+        record = {'op': 'add', 'row': row, 'id': student_id, 'reg_number': reg_number}
+        if version is not None:
+            record['version'] = str(version)
+        if template is not None and template != ENROLLMENT_TEMPLATE:
+            record['template'] = template
+        records.append(record)
+        self._append_records(records)
+
+        self.refresh()
+        return row
+
+    def remove(self, student_id):
+        """Tombstone every row of a student; returns the number of rows removed"""
+        handle = self._lock()
+        try:
+            self.refresh()
+            return self._remove_locked(student_id)
+        finally:
+            self._unlock(handle)
+
+    def _remove_locked(self, student_id):
+        rows = self.rows_for(student_id)
+        if rows:
+            self._append_records([{'op': 'delete', 'rows': rows}])
+            self.refresh()
+        return len(rows)
+
+    def add_template(self, student_id, features, source='attendance', max_templates=DEFAULT_MAX_TEMPLATES,
+                     eviction='oldest'):
+        """Add another template (e.g. an accepted attendance capture) for an enrolled student
+
+        Over max_templates, captures are evicted by the eviction policy; the
+        registration template is never evicted. Re-enrolling the student (add()
+        or a change-feed update) replaces every template.
+        """
+        if eviction not in TEMPLATE_EVICTION_POLICIES:
+            raise ValueError(f"Unknown eviction policy '{eviction}'. Use one of: {', '.join(TEMPLATE_EVICTION_POLICIES)}")
+        if source == ENROLLMENT_TEMPLATE:
+            raise ValueError(f"'{ENROLLMENT_TEMPLATE}' templates come from add(), not add_template()")
+        vector = self._prepare_features(features)
+
+        handle = self._lock()
+        try:
+            self.refresh()
+            rows = self.rows_for(student_id)
+            if not rows:
+                raise ValueError(f'Student {student_id} is not enrolled')
+            row = self._add_locked(student_id, vector, self.reg_numbers[rows[-1]], False, template=source)
+            evicted = self._evict_templates_locked(student_id, max(1, int(max_templates)), eviction)
+            return {'row': row, 'evicted': evicted, 'templates': len(self.rows_for(student_id))}
+        finally:
+            self._unlock(handle)
+
+    def _evict_templates_locked(self, student_id, max_templates, eviction):
+        """Tombstone captured templates beyond max_templates; returns the evicted rows"""
+        rows = self.rows_for(student_id)
+        captures = [row for row in rows if self.templates[row] != ENROLLMENT_TEMPLATE]
+        excess = len(rows) - max_templates
+        if excess <= 0 or not captures:
+            return []
+
+        if eviction == 'oldest':
+            evicted = sorted(captures)[:excess]
+        else:
+            # A capture close to the student's other templates adds the least coverage
+            templates = np.asarray(self._matrix[rows], dtype=np.float32)
+            norms = np.linalg.norm(templates, axis=1, keepdims=True)
+            unit = templates / np.where(norms > 1e-6, norms, 1.0)
+            cosine = unit @ unit.T
+            np.fill_diagonal(cosine, 0.0)
+            redundancy = {row: cosine[i].sum() / (len(rows) - 1) for i, row in enumerate(rows)}
+            evicted = sorted(captures, key=lambda row: (-redundancy[row], row))[:excess]
+
+        evicted = sorted(evicted)
+        self._append_records([{'op': 'delete', 'rows': evicted}])
+        self.refresh()
+        return evicted
+
+    def templates_for(self, student_id):
+        """Live rows of a student with the source of each template"""
+        return [{'row': row, 'template': self.templates[row]} for row in self.rows_for(student_id)]
+
+    @property
+    def sync_mark(self):
+        """High-water mark of the last change-feed batch applied (None before the first sync)"""
+        # Read from disk: another process may have applied a batch since this one loaded meta.json
+        return self._read_meta().get('sync_mark')
+
+    def apply_changes(self, changes, high_water_mark=None):
+        """Apply a batch of changed students rows and advance the high-water mark
+
+        Each change is {'id', 'reg_number', 'face_encoding', 'version'}; a change with
+        'deleted' true or no encoding (deactivated, encoding cleared) removes the
+        student. A change whose version is already stored is skipped, so feeds that
+        re-read an overlapping window are harmless.
+        """
+        summary = {'added': 0, 'removed': 0, 'unchanged': 0, 'errors': []}
+        handle = self._lock()
+        try:
+            self.refresh()
+            for change in changes:
+                student_id = change.get('id')
+                try:
+                    if change.get('deleted') or not change.get('face_encoding'):
+                        summary['removed'] += 1 if self._remove_locked(student_id) else 0
+                        continue
+
+                    version = change.get('version')
+                    if version is not None and student_id in self and self.version_of(student_id) == str(version):
+                        summary['unchanged'] += 1
+                        continue
+
+                    vector = self._prepare_features(change['face_encoding'])
+                    self._add_locked(student_id, vector, change.get('reg_number'), True, version)
+                    summary['added'] += 1
+                except Exception as e:
+                    summary['errors'].append({'id': student_id, 'error': str(e)})
+
+            # The mark is stored only after the rows, so a crash replays the batch instead of skipping it
+            if high_water_mark is not None:
+                meta = self._read_meta()
+                meta['sync_mark'] = high_water_mark
+                self._write_meta(meta)
+                self.meta = meta
+
+            summary['high_water_mark'] = self.sync_mark
+            return summary
+        finally:
+            self._unlock(handle)
+
+    def _append_records(self, records):
+        with open(self.index_path, 'ab') as f:
+            f.write(''.join(json.dumps(record) + '\n' for record in records).encode('utf-8'))
+            f.flush()
+
+    def tombstone_count(self):
+        """Number of stored rows that compact() would drop"""
+        return len(self.ids) - len(self)
+
+    def compact(self):
+        """Rewrite the gallery without tombstoned rows; returns the number of rows dropped
+
+        Searches in this process keep using the old rows until the compacted state
+        is swapped in at the end, so they never wait for the rewrite.
+        """
+        handle = self._lock()
+        try:
+            self.refresh()
+            with self._state_lock:
+                live_rows = np.flatnonzero(self._live)
+                old_matrix, old_codes = self._matrix, self._codes
+                ids = [self.ids[row] for row in live_rows]
+                reg_numbers = [self.reg_numbers[row] for row in live_rows]
+                versions = [self.versions[row] for row in live_rows]
+                templates = [self.templates[row] for row in live_rows]
+
+            dropped = len(self.ids) - len(live_rows)
+            if dropped == 0:
+                return 0
+
+            matrix_tmp = self.matrix_path + '.tmp'
+            index_tmp = self.index_path + '.tmp'
+
+            with open(matrix_tmp, 'wb') as f:
+                for start in range(0, len(live_rows), 4096):
+                    f.write(np.ascontiguousarray(old_matrix[live_rows[start:start + 4096]]).astype('<f4').tobytes())
+
+            with open(index_tmp, 'w') as f:
+                for new_row, student_id in enumerate(ids):
+                    record = {'op': 'add', 'row': new_row, 'id': student_id, 'reg_number': reg_numbers[new_row]}
+                    if versions[new_row] is not None:
+                        record['version'] = versions[new_row]
+                    if templates[new_row] != ENROLLMENT_TEMPLATE:
+                        record['template'] = templates[new_row]
+                    f.write(json.dumps(record) + '\n')
+
+            os.replace(matrix_tmp, self.matrix_path)
+            os.replace(index_tmp, self.index_path)
+
+            # Bumping the generation tells other processes to reload from scratch
+            meta = self._read_meta()
+            meta['generation'] = int(meta.get('generation', 0)) + 1
+            self._write_meta(meta)
+
+            # This process already knows the compacted state: swap it in instead of re-reading the index
+            rows_by_id = {}
+            for new_row, student_id in enumerate(ids):
+                rows_by_id.setdefault(self._key(student_id), []).append(new_row)
+            matrix = (np.memmap(self.matrix_path, dtype='<f4', mode='r', shape=(len(ids), self.dim))
+                      if ids else np.empty((0, self.dim), dtype=np.float32))
+            codes = old_codes[live_rows[live_rows < len(old_codes)]] if len(old_codes) else old_codes
+
+            with self._state_lock:
+                self.meta = meta
+                self._generation = meta['generation']
+                self._index_offset = os.path.getsize(self.index_path)
+                self.ids, self.reg_numbers, self.versions, self.templates = ids, reg_numbers, versions, templates
+                self._live = np.ones(len(ids), dtype=bool)
+                self._rows_by_id = rows_by_id
+                self._matrix, self._mapped_rows = matrix, len(ids)
+                self._codes = codes  # Codes cover a prefix of the rows; quantized_codes() extends it
+                self._state_version += 1
+            return dropped
+        finally:
+            self._unlock(handle)
+
+    def quantized_codes(self, encoder):
+        """int8 codes for every stored row, quantizing only rows appended since the last call"""
+        with self._state_lock:
+            stored = len(self._codes)
+            if stored < self._matrix.shape[0]:
+                new_codes = encoder.build_quantized_index(self._matrix[stored:])
+                self._codes = np.concatenate([self._codes, new_codes])
+            return self._codes
+
+    @staticmethod
+    def course_partition(course_id, session_year, semester):
+        """Partition name for the students enrolled in one course offering (student_courses)"""
+        return f'course:{course_id}:{session_year}:{semester}'
+
+    def _read_partitions(self):
+        if not os.path.exists(self.partitions_path):
+            return {}
+        with open(self.partitions_path, 'r') as f:
+            return json.load(f)
+
+    def _write_partitions(self):
+        tmp_path = self.partitions_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._partitions, f)
+        os.replace(tmp_path, self.partitions_path)
+
+    def set_partition(self, name, student_ids):
+        """Store the member ids of a named partition; its cached slice is rebuilt on next use"""
+        with self._state_lock:
+            self._partitions[name] = list(student_ids)
+            self._slice_cache.pop(name, None)
+            self._write_partitions()
+
+    def drop_partition(self, name):
+        """Forget a named partition, e.g. when its course offering is removed"""
+        with self._state_lock:
+            existed = self._partitions.pop(name, None) is not None
+            self._slice_cache.pop(name, None)
+            if existed:
+                self._write_partitions()
+            return existed
+
+    @staticmethod
+    def _fingerprint(student_ids):
+        """Order-independent digest of a candidate id list"""
+        digest = hashlib.sha1()
+        for key in sorted(str(student_id) for student_id in student_ids):
+            digest.update(key.encode('utf-8') + b'\0')
+        return digest.hexdigest()
+
+    def candidate_slice(self, candidate_ids=None, partition=None):
+        """Contiguous copy of the live rows for a candidate subset, cached per partition
+
+        A cached slice is reused while both the partition membership (by fingerprint)
+        and the gallery contents are unchanged. Callers that send candidate_ids with
+        the partition name (FaceRecognitionManager reads them from student_courses)
+        therefore rebuild it as soon as enrollment changes; the ids also replace a
+        stored membership that has gone stale.
+        """
+        with self._state_lock:
+            if candidate_ids is None:
+                if partition not in self._partitions:
+                    raise KeyError(f"Unknown partition '{partition}'")
+                candidate_ids = self._partitions[partition]
+
+            fingerprint = self._fingerprint(candidate_ids)
+            entry = self._slice_cache.get(partition) if partition else None
+            if entry is not None and entry['fingerprint'] == fingerprint and entry['state'] == self._state_version:
+                self._slice_cache.move_to_end(partition)
+                return entry
+
+            if partition in self._partitions and self._fingerprint(self._partitions[partition]) != fingerprint:
+                self._partitions[partition] = list(candidate_ids)
+                self._write_partitions()
+
+            rows = sorted(row for student_id in candidate_ids for row in self._rows_by_id.get(self._key(student_id), []))
+            rows = np.array(rows, dtype=np.int64)
+            entry = {
+                'fingerprint': fingerprint,
+                'state': self._state_version,
+                'rows': rows,
+                'matrix': np.ascontiguousarray(self._matrix[rows]) if len(rows) else np.empty((0, self.dim), np.float32),
+                'codes': None
+            }
+
+            if partition:
+                self._slice_cache[partition] = entry
+                self._slice_cache.move_to_end(partition)
+                while len(self._slice_cache) > MAX_CACHED_SLICES:
+                    self._slice_cache.popitem(last=False)
+            return entry
+
+    def _search_target(self, encoder, search_mode, candidate_ids=None, partition=None):
+        """Snapshot of the matrix, mask, codes and row mapping to search, taken under the lock"""
+        with self._state_lock:
+            self.refresh()
+            if candidate_ids is None and partition is None:
+                return {
+                    'matrix': self._matrix,
+                    'row_mask': self._live.copy(),
+                    'codes': self.quantized_codes(encoder) if search_mode == 'two_stage' else None,
+                    'rows': None,
+                    'ids': self.ids,
+                    'reg_numbers': self.reg_numbers
+                }
+
+            entry = self.candidate_slice(candidate_ids, partition)
+            if search_mode == 'two_stage' and entry['codes'] is None:
+                entry['codes'] = encoder.build_quantized_index(entry['matrix'])
+            return {
+                'matrix': entry['matrix'],
+                'row_mask': None,
+                'codes': entry['codes'],
+                'rows': entry['rows'],
+                'ids': self.ids,
+                'reg_numbers': self.reg_numbers
+            }
+
+    @property
+    def identity_thresholds(self):
+        """Calibrated threshold per student key from thresholds.json ({} before calibration)"""
+        try:
+            mtime = os.path.getmtime(self.thresholds_path)
+        except OSError:
+            return {}
+        if mtime != self._thresholds_mtime:
+            with open(self.thresholds_path, 'r') as f:
+                self._thresholds = json.load(f).get('thresholds', {})
+            self._thresholds_mtime = mtime
+        return self._thresholds
+
+    def calibrate_thresholds(self, encoder, target_far=0.001, min_threshold=0.5, max_threshold=0.9,
+                             impostor_sample=2000, seed=0):
+        """Derive a per-student threshold from the stored genuine and impostor score distributions
+
+        Impostor scores are each template against (a sample of) other students'
+        rows; the threshold starts at their 1 - target_far quantile. Students with
+        several templates also have genuine (template vs template) scores: when
+        the weakest of those clears the impostor quantile the threshold moves to
+        the midpoint. Results are clipped to [min_threshold, max_threshold].
+        """
+        with self._state_lock:
+            self.refresh()
+            live_rows = np.flatnonzero(self._live)
+            keys = np.array([self._key(self.ids[row]) for row in live_rows])
+            matrix = np.asarray(self._matrix[live_rows], dtype=np.float32)
+
+        rng = np.random.default_rng(seed)
+        sample = np.arange(len(live_rows))
+        if len(sample) > impostor_sample:
+            sample = np.sort(rng.choice(sample, impostor_sample, replace=False))
+
+        thresholds, stats = {}, {}
+        for key in np.unique(keys):
+            own = np.flatnonzero(keys == key)
+            others = sample[keys[sample] != key]
+            impostor, genuine = [], []
+            for i, position in enumerate(own):
+                if len(others):
+                    impostor.append(encoder._score_gallery(matrix[position], matrix[others])['similarity_score'])
+                if i + 1 < len(own):
+                    genuine.append(encoder._score_gallery(matrix[position], matrix[own[i + 1:]])['similarity_score'])
+            if not impostor:
+                continue
+
+            impostor = np.concatenate(impostor)
+            impostor_limit = float(np.quantile(impostor, 1 - target_far))
+            threshold = impostor_limit
+            genuine_min = float(np.concatenate(genuine).min()) if genuine else None
+            if genuine_min is not None and genuine_min > impostor_limit:
+                threshold = (impostor_limit + genuine_min) / 2
+            thresholds[key] = round(float(np.clip(threshold, min_threshold, max_threshold)), 6)
+            stats[key] = {
+                'templates': int(len(own)),
+                'impostor_limit': round(impostor_limit, 6),
+                'genuine_min': round(genuine_min, 6) if genuine_min is not None else None
+            }
+
+        calibration = {
+            'calibrated_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'target_far': target_far,
+            'min_threshold': min_threshold,
+            'max_threshold': max_threshold,
+            'live_rows': int(len(live_rows)),
+            'thresholds': thresholds,
+            'stats': stats
+        }
+        tmp_path = self.thresholds_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(calibration, f)
+        os.replace(tmp_path, self.thresholds_path)
+
+        values = np.array(list(thresholds.values())) if thresholds else np.zeros(0)
+        return {
+            'identities': len(thresholds),
+            'target_far': target_far,
+            'threshold_min': float(values.min()) if len(values) else None,
+            'threshold_median': float(np.median(values)) if len(values) else None,
+            'threshold_max': float(values.max()) if len(values) else None
+        }
+
+    def _matrix_ids(self, target):
+        """Gallery ids aligned with the rows of the searched matrix"""
+        if target['rows'] is not None:
+            return [target['ids'][row] for row in target['rows']]
+        return target['ids']
+
+    def _label_matches(self, target, matches):
+        """Map matrix positions back to gallery rows and attach id and reg_number"""
+        for match in matches:
+            row = int(target['rows'][match['index']]) if target['rows'] is not None else match['index']
+            match['index'] = row
+            match['id'] = target['ids'][row]
+            match['reg_number'] = target['reg_numbers'][row]
+
+    def identify(self, encoder, probe, top_k=5, threshold=0.6, search_mode='exact', rerank_candidates=None,
+                 candidate_ids=None, partition=None, aggregate=None, calibrated=False):
+        """Identify a probe against the live rows (or a candidate subset) using ImageEncoder.identify
+
+        aggregate ('max' or 'mean') ranks students over all their templates; calibrated
+        applies the thresholds from calibrate_thresholds() where a student has one.
+        """
+        target = self._search_target(encoder, search_mode, candidate_ids, partition)
+        identity_thresholds = self.identity_thresholds if calibrated else None
+        gallery_ids = self._matrix_ids(target) if aggregate or identity_thresholds else None
+
+        result = encoder.identify(probe, target['matrix'], top_k, threshold, gallery_ids, row_mask=target['row_mask'],
+                                  search_mode=search_mode, quantized_index=target['codes'],
+                                  rerank_candidates=rerank_candidates, aggregate=aggregate,
+                                  identity_thresholds=identity_thresholds)
+        self._label_matches(target, result.get('matches', []))
+
+        if partition:
+            result['partition'] = partition
+        return result
+
+    def identify_many(self, encoder, probes, top_k=5, threshold=0.6, search_mode='exact', rerank_candidates=None,
+                      candidate_ids=None, partition=None, aggregate=None, calibrated=False):
+        """Identify every face of a group frame against one snapshot; each student is matched at most once"""
+        target = self._search_target(encoder, search_mode, candidate_ids, partition)
+
+        # Ids aligned with the searched matrix so contested identities are resolved per student
+        batch = encoder.identify_faces(probes, target['matrix'], top_k, threshold, gallery_ids=self._matrix_ids(target),
+                                       row_mask=target['row_mask'], search_mode=search_mode,
+                                       quantized_index=target['codes'], rerank_candidates=rerank_candidates,
+                                       aggregate=aggregate,
+                                       identity_thresholds=self.identity_thresholds if calibrated else None)
+        for result in batch.get('results', []):
+            self._label_matches(target, result.get('matches', []))
+
+        if partition:
+            batch['partition'] = partition
+        return batch
+
+    def import_rows(self, rows):
+        """Bulk-load rows shaped like the students table (id, reg_number, face_encoding JSON)"""
+        imported = 0
+        errors = []
+        for row in rows:
+            try:
+                self.add(row['id'], row['face_encoding'], reg_number=row.get('reg_number'))
+                imported += 1
+            except Exception as e:
+                errors.append({'id': row.get('id'), 'error': str(e)})
+        return imported, errors
+
+    def info(self):
+        """Summary of the gallery state"""
+        return {
+            'gallery_dir': self.gallery_dir,
+            'version': self.meta.get('version'),
+            'dim': self.dim,
+            'extraction_method': self.extraction_method,
+            'generation': self.meta.get('generation'),
+            'stored_rows': len(self.ids),
+            'live_rows': len(self),
+            'identities': sum(1 for rows in self._rows_by_id.values() if rows),
+            'calibrated_identities': len(self.identity_thresholds),
+            'tombstones': self.tombstone_count(),
+            'sync_mark': self.sync_mark,
+            'partitions': len(self._partitions),
+            'cached_slices': len(self._slice_cache)
+        }
+
+
+class GalleryCompactor:
+    """Background thread that compacts a gallery once tombstones pile up
+
+    Re-enrollments and deactivations only tombstone rows, so without compaction
+    the matrix grows with every change. Compaction runs off the request path and
+    swaps its result in, so searches never wait for it.
+    """
+
+    def __init__(self, gallery, interval=300, min_tombstones=256, max_tombstone_ratio=0.2):
+        self.gallery = gallery
+        self.interval = interval
+        self.min_tombstones = min_tombstones
+        self.max_tombstone_ratio = max_tombstone_ratio
+        self.compactions = 0
+        self.last_error = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def should_compact(self):
+        tombstones = self.gallery.tombstone_count()
+        stored = len(self.gallery.ids)
+        return tombstones > 0 and (tombstones >= self.min_tombstones or
+                                   tombstones >= self.max_tombstone_ratio * stored)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='gallery-compactor', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                self.gallery.refresh()
+                if self.should_compact():
+                    self.gallery.compact()
+                    self.compactions += 1
+            except Exception as e:
+                self.last_error = str(e)
+
+
+if __name__ == "__main__":
+    usage = ('Usage: python face_gallery.py <gallery_dir> info | '
+             'import <students.json> | sync <changes.json> | remove <student_id> | compact | '
+             'calibrate [target_far]')
+
+    if len(sys.argv) < 3:
+        print(json.dumps({'success': False, 'message': usage}))
+        sys.exit(1)
+
+    gallery = FaceGallery(sys.argv[1])
+    command = sys.argv[2]
+
+    try:
+        if command == 'info':
+            result = {'success': True, 'data': gallery.info()}
+        elif command == 'import' and len(sys.argv) >= 4:
+            with open(sys.argv[3], 'r') as f:
+                imported, errors = gallery.import_rows(json.load(f))
+            result = {'success': True, 'imported': imported, 'errors': errors, 'data': gallery.info()}
+        elif command == 'sync' and len(sys.argv) >= 4:
+            # {"changes": [...], "high_water_mark": ...} as produced by FaceRecognitionManager::syncGallery
+            with open(sys.argv[3], 'r') as f:
+                batch = json.load(f)
+            result = {'success': True, 'data': gallery.apply_changes(batch['changes'], batch.get('high_water_mark'))}
+        elif command == 'remove' and len(sys.argv) >= 4:
+            result = {'success': True, 'removed_rows': gallery.remove(sys.argv[3])}
+        elif command == 'compact':
+            result = {'success': True, 'dropped_rows': gallery.compact(), 'data': gallery.info()}
+        elif command == 'calibrate':
+            from opencv_face_encoder import ImageEncoder
+            target_far = float(sys.argv[3]) if len(sys.argv) >= 4 else 0.001
+            result = {'success': True, 'data': gallery.calibrate_thresholds(ImageEncoder(), target_far)}
+        else:
+            result = {'success': False, 'message': usage}
+    except Exception as e:
+        result = {'success': False, 'message': f'Gallery error: {str(e)}'}
+
+    print(json.dumps(result))
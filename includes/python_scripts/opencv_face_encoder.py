@@ -1,20 +1,278 @@
 import base64
-import cv2
+import functools
+import importlib
 import numpy as np
 import json
-from PIL import Image
-import io
 import os
+import struct
 import sys
+import threading
+import time
+
+class _LazyModule:
+    """Stand-in for a heavy module that imports it on first attribute access
+
+    On first use the real module replaces this placeholder in the module globals,
+    so later lookups cost nothing extra.
+    """
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._name] = module
+        return getattr(module, attr)
+
+# OpenCV is only needed for decoding and detection; comparison and identification are NumPy only
+cv2 = _LazyModule('cv2')
+
+DETECTION_MODES = ('exhaustive', 'tiered')
+
+# Exhaustive passes from this index on (alt, profile, equalized, CLAHE) are fallbacks to the default-cascade sweep
+FALLBACK_PASS_START = 20
+
+# How overlapping detections collapse: keep the first box of each cluster, or average the cluster
+MERGE_STRATEGIES = ('first', 'fused')
+
+# How identify() scores an identity enrolled with several templates (gallery rows sharing an id)
+TEMPLATE_AGGREGATES = ('max', 'mean')
+
+# Weights of the metrics combined into compare_faces/identify similarity_score
+SIMILARITY_WEIGHTS = {'cosine': 0.35, 'euclidean': 0.25, 'correlation': 0.25, 'manhattan': 0.15}
+
+EXTRACTION_METHOD = 'OpenCV_Enhanced_Features'
+
+# Compact face encoding: 'FEv1:' + base64(header + little-endian payload)
+# header = magic 'FE', version, dtype code, dimension (uint16), method length, method name
+# int8 payloads are preceded by their float32 dequantization scale
+ENCODING_FORMATS = ('json', 'f32', 'f16', 'int8')
+ENCODING_PREFIX = 'FEv1:'
+_ENCODING_HEADER = struct.Struct('<2sBBHB')
+_ENCODING_DTYPES = {'f32': (0, '<f4'), 'f16': (1, '<f2'), 'int8': (2, 'i1')}
+_ENCODING_CODES = {code: (name, dtype) for name, (code, dtype) in _ENCODING_DTYPES.items()}
+
+def encode_features(features, encoding_format='f32', extraction_method=EXTRACTION_METHOD):
+    """Pack a feature vector into the versioned compact text encoding"""
+    if encoding_format not in _ENCODING_DTYPES:
+        raise ValueError(f"Unknown compact encoding format '{encoding_format}'")
+    vector = np.asarray(features, dtype=np.float32).ravel()
+    code, dtype = _ENCODING_DTYPES[encoding_format]
+    method = extraction_method.encode('utf-8')[:255]
+
+    parts = [_ENCODING_HEADER.pack(b'FE', 1, code, len(vector), len(method)), method]
+    if encoding_format == 'int8':
+        # Symmetric quantization: x ~= q * scale
+        max_abs = float(np.max(np.abs(vector))) if len(vector) else 0.0
+        scale = max_abs / 127.0 if max_abs > 0 else 1.0
+        parts.append(struct.pack('<f', scale))
+        parts.append(np.clip(np.round(vector / scale), -127, 127).astype(dtype).tobytes())
+    else:
+        parts.append(vector.astype(dtype).tobytes())
+
+    return ENCODING_PREFIX + base64.b64encode(b''.join(parts)).decode('ascii')
+
+def parse_encoding(encoded):
+    """Decode a compact encoding into (float32 vector, header dict)"""
+    raw = base64.b64decode(encoded[len(ENCODING_PREFIX):])
+    magic, version, code, dim, method_len = _ENCODING_HEADER.unpack_from(raw, 0)
+    if magic != b'FE' or version != 1 or code not in _ENCODING_CODES:
+        raise ValueError('Unrecognized compact face encoding')
+
+    offset = _ENCODING_HEADER.size
+    method = raw[offset:offset + method_len].decode('utf-8')
+    offset += method_len
+    name, dtype = _ENCODING_CODES[code]
+
+    scale = None
+    if name == 'int8':
+        scale = struct.unpack_from('<f', raw, offset)[0]
+        offset += 4
+
+    vector = np.frombuffer(raw, dtype=dtype, count=dim, offset=offset).astype(np.float32)
+    if scale is not None:
+        vector *= scale
+
+    header = {'version': version, 'format': name, 'dimension': dim, 'extraction_method': method}
+    return vector, header
+
+def decode_features(value):
+    """Accept a list, array, JSON string or compact encoding and return a float32 vector"""
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    if isinstance(value, str):
+        if value.startswith(ENCODING_PREFIX):
+            return parse_encoding(value)[0]
+        value = json.loads(value)
+    return np.asarray(value, dtype=np.float32)
+
+def decode_feature_matrix(rows):
+    """Stack a list of encodings (any format accepted by decode_features) into a matrix"""
+    if isinstance(rows, np.ndarray):
+        return rows
+    if isinstance(rows, (str, bytes)):
+        rows = json.loads(rows)
+    if len(rows) > 0 and isinstance(rows[0], (str, bytes)):
+        return np.vstack([decode_features(row) for row in rows])
+    return rows
+
+def _timed_stage(stage):
+    """Record the decorated method's latency under 'stage' when metrics are enabled"""
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.metrics is None:
+                return method(self, *args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self._record_stage(stage, time.perf_counter() - started)
+        return wrapper
+    return decorate
+
+def _instrumented_operation(operation):
+    """Time a public entry point and collect its stage timings into last_timing"""
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.metrics is None:
+                return method(self, *args, **kwargs)
+
+            # Nested entry points (e.g. identify inside identify_faces) report into the outer call
+            if self._operation_depth == 0:
+                self._trace = {}
+            self._operation_depth += 1
+            started = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                self._operation_depth -= 1
+                if self._operation_depth == 0:
+                    self.metrics.observe(operation, elapsed)
+                    self.metrics.increment(f'{operation}_calls')
+                    self.last_timing = {
+                        'operation': operation,
+                        'total_ms': round(elapsed * 1000, 3),
+                        'stages_ms': {stage: round(seconds * 1000, 3) for stage, seconds in self._trace.items()}
+                    }
+        return wrapper
+    return decorate
+
+def configure_opencv_threads(workers=1, detection_threads=1, opencv_threads=None):
+    """Size OpenCV's internal thread pool for the given concurrency and return the value used
+
+    cv2.setNumThreads is process wide. Every detectMultiScale call already spreads
+    its scales over that pool, so with several request workers (or parallel
+    detector passes) each using a full pool the cores get oversubscribed.
+    By default the cores are split between concurrent callers:
+
+      - one request at a time, lowest latency: workers=1, detection_threads=cores
+        (OpenCV then runs single threaded inside each pass)
+      - many requests, highest throughput: workers=cores, detection_threads=1
+    """
+    if opencv_threads is None:
+        opencv_threads = max(1, (os.cpu_count() or 1) // max(1, workers * detection_threads))
+    cv2.setNumThreads(int(opencv_threads))
+    return int(opencv_threads)
+
+# JPEG start-of-frame markers (SOF0-SOF15 except DHT, JPG and DAC), which carry the image size
+_JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+_JPEG_REDUCTIONS = (8, 4, 2)
+
+def _jpeg_dimensions(data):
+    """(width, height) from a JPEG header without decoding it, or None if data is not a JPEG"""
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    offset = 2
+    while offset + 9 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            offset += 1  # Fill byte
+            continue
+        if marker in _JPEG_SOF_MARKERS:
+            height, width = struct.unpack_from('>HH', data, offset + 5)
+            return width, height
+        offset += 2 + struct.unpack_from('>H', data, offset + 2)[0]
+    return None
+
+def _image_source_bytes(source):
+    """Encoded image bytes for an in-memory source, or None when source is a file path or decoded image"""
+    if isinstance(source, str):
+        if not source.startswith('data:'):
+            return None
+        # data:image/jpeg;base64,<payload>
+        return base64.b64decode(source.split(',', 1)[1] if ',' in source else '')
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    if isinstance(source, np.ndarray) and source.ndim == 1:
+        return source.astype(np.uint8, copy=False).tobytes()
+    return None
 
 class ImageEncoder:
-    def __init__(self):
+    def __init__(self, detection_mode='exhaustive', encoding_format='json'):
         self.supported_formats = ['jpg', 'jpeg', 'png', 'bmp']
+
+        # 'exhaustive' runs every detector pass; 'tiered' stops at the first pass that finds a face
+        if detection_mode not in DETECTION_MODES:
+            raise ValueError(f"Unknown detection mode '{detection_mode}'. Use one of: {', '.join(DETECTION_MODES)}")
+        self.detection_mode = detection_mode
+
+        # 'json' keeps float lists in responses; 'f32', 'f16' and 'int8' use the compact encoding
+        if encoding_format not in ENCODING_FORMATS:
+            raise ValueError(f"Unknown encoding format '{encoding_format}'. Use one of: {', '.join(ENCODING_FORMATS)}")
+        self.encoding_format = encoding_format
+        self.tiered_fast_max_side = 480  # Longest image side for the downscaled first pass
+        self.last_detection = None
+
+        # 'first' keeps the earliest box of each overlapping cluster (original behaviour); 'fused' averages them
+        self.merge_strategy = 'first'
+        # Skip the alt/profile/equalized/CLAHE fallbacks once every face from the default-cascade
+        # sweep was found by at least this many of its passes (None always runs them)
+        self.fallback_skip_votes = None
+
+        # Exhaustive detector passes run on this many threads (1 keeps them sequential);
+        # pair with configure_opencv_threads so the process does not oversubscribe cores
+        self.detection_threads = 1
+        self._detection_pool = None
+        self._pool_cascades = threading.local()
+
+        # Large JPEGs are decoded at 1/2, 1/4 or 1/8 scale while the longest side stays at or above
+        # this many pixels (None decodes at full resolution); face_region is reported in original pixels
+        self.max_decode_side = None
+        self.last_decode = None
+
+        # Registration/extraction responses carry the PNG face crop unless a call opts out;
+        # a skipped crop can be fetched later with face_thumbnail(image, face_region)
+        self.include_thumbnail = True
+        # The crop/CLAHE/blur chain writes into per-encoder working buffers instead of new arrays
+        # (an encoder serves one extraction at a time; see _working_buffers)
+        self.reuse_buffers = True
+        self._buffers = None
+
+        # Metric weights of similarity_score (see SIMILARITY_WEIGHTS); thresholds are tuned for the defaults
+        self.similarity_weights = dict(SIMILARITY_WEIGHTS)
+
+        # Gallery rows scored per block in identify() to bound temporary memory
+        self.identify_block_rows = 8192
+        self.rerank_candidates = 64  # Candidates re-scored exactly in 'two_stage' search
+        # Group (classroom) frames are not limited to validate_image's 5 faces
+        self.group_max_faces = 40
+
+        # Optional ResultCache (see result_cache.py) for validate/extract results keyed by content hash
+        self.result_cache = None
+
+        # Optional StageMetrics (see encoder_metrics.py); None keeps instrumentation to one attribute check
+        self.metrics = None
+        self.last_timing = None
+        self._trace = {}
+        self._operation_depth = 0
         
-        # Initialize multiple face detectors for better detection
-        self.face_cascade_default = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-        self.face_cascade_alt = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_alt.xml')
-        self.face_cascade_profile = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_profileface.xml')
+        # Multiple face detectors for better detection, each loaded on first use (see _cascade)
+        self._cascades = {}
         
         # Try to initialize DNN face detector if available
         self.dnn_net = None
@@ -25,184 +283,485 @@ class ImageEncoder:
         except:
             pass
     
+    CASCADE_FILES = {
+        'default': 'haarcascade_frontalface_default.xml',
+        'alt': 'haarcascade_frontalface_alt.xml',
+        'profile': 'haarcascade_profileface.xml'
+    }
+
+    def _cascade(self, name):
+        """Haar cascade by name, parsed from its XML the first time a detector pass needs it"""
+        cascade = self._cascades.get(name)
+        if cascade is None:
+            cascade = cv2.CascadeClassifier(cv2.data.haarcascades + self.CASCADE_FILES[name])
+            self._cascades[name] = cascade
+        return cascade
+
+    def _pool_cascade(self, name):
+        """Per-thread classifier for parallel passes; one CascadeClassifier must not detect concurrently"""
+        cascades = getattr(self._pool_cascades, 'cascades', None)
+        if cascades is None:
+            cascades = self._pool_cascades.cascades = {}
+        cascade = cascades.get(name)
+        if cascade is None:
+            cascade = cv2.CascadeClassifier(cv2.data.haarcascades + self.CASCADE_FILES[name])
+            cascades[name] = cascade
+        return cascade
+
+    def _detection_executor(self):
+        """Thread pool for parallel detector passes, (re)created to match detection_threads"""
+        if self._detection_pool is None or self._detection_pool._max_workers != self.detection_threads:
+            from concurrent.futures import ThreadPoolExecutor
+            if self._detection_pool is not None:
+                self._detection_pool.shutdown(wait=False)
+            self._detection_pool = ThreadPoolExecutor(max_workers=self.detection_threads,
+                                                      thread_name_prefix='face-detect')
+        return self._detection_pool
+
+    @property
+    def face_cascade_default(self):
+        return self._cascade('default')
+
+    @property
+    def face_cascade_alt(self):
+        return self._cascade('alt')
+
+    @property
+    def face_cascade_profile(self):
+        return self._cascade('profile')
+
+    @_instrumented_operation('validate_image')
     def validate_image(self, image_path):
-        """Validate if the uploaded image is valid and contains a face"""
+        """Validate if the uploaded image (path, bytes, data URL or array) is valid and contains a face"""
+        try:
+            source_error = self._check_image_source(image_path)
+        except Exception as e:
+            return False, f"Error validating image: {str(e)}"
+        if source_error is not None:
+            return False, source_error
+
+        cache_key = self._result_cache_key(image_path, 'validate')
+        if cache_key is not None:
+            cached = self.result_cache.get(cache_key)
+            if cached is not None:
+                return cached[0], cached[1]
+
+        is_valid, message, _ = self._validate_and_detect(image_path)
+
+        if cache_key is not None and not message.startswith('Error'):
+            self.result_cache.put(cache_key, [is_valid, message])
+        return is_valid, message
+
+    def enable_metrics(self, metrics=None):
+        """Turn on per-stage timing; pass a shared StageMetrics to aggregate several encoders"""
+        if metrics is None:
+            from encoder_metrics import StageMetrics
+            metrics = StageMetrics()
+        self.metrics = metrics
+        return metrics
+
+    def _record_stage(self, stage, seconds):
+        self.metrics.observe(stage, seconds)
+        self._trace[stage] = self._trace.get(stage, 0.0) + seconds
+
+    def cache_config(self):
+        """Settings that change validate/extract results; part of every result cache key"""
+        return {
+            'extraction_method': EXTRACTION_METHOD,
+            'detection_mode': self.detection_mode,
+            'tiered_fast_max_side': self.tiered_fast_max_side,
+            'max_decode_side': self.max_decode_side,
+            'merge_strategy': self.merge_strategy,
+            'fallback_skip_votes': self.fallback_skip_votes
+        }
+
+    @_timed_stage('cache_lookup')
+    def _result_cache_key(self, image_path, kind):
+        """Content-hash cache key, or None when caching is off or the source cannot be read"""
+        if self.result_cache is None:
+            return None
         try:
+            if isinstance(image_path, np.ndarray) and image_path.ndim > 1:
+                content_hash = self.result_cache.bytes_hash(
+                    np.ascontiguousarray(image_path).tobytes(), f'{image_path.shape}{image_path.dtype}')
+            else:
+                data = _image_source_bytes(image_path)
+                if data is None:
+                    content_hash = self.result_cache.content_hash(image_path)
+                else:
+                    content_hash = self.result_cache.bytes_hash(data)
+        except (OSError, ValueError):
+            return None
+        return self.result_cache.make_key(content_hash, kind, self.cache_config())
+
+    def _reduced_decode_factor(self, width, height):
+        """Largest IMREAD_REDUCED factor that keeps the longest side at or above max_decode_side"""
+        if not self.max_decode_side:
+            return 1
+        for factor in _JPEG_REDUCTIONS:
+            if max(width, height) // factor >= self.max_decode_side:
+                return factor
+        return 1
+
+    @_timed_stage('decode')
+    def _decode_image(self, image_path):
+        """Decode an image once; returns (image, gray) or (None, None) if it cannot be read
+
+        image_path may also be encoded image bytes, a base64 data URL or a NumPy
+        array (encoded bytes when 1-D, an already decoded BGR or gray image otherwise).
+        """
+        if isinstance(image_path, np.ndarray) and image_path.ndim > 1:
+            image = image_path
+            if image.ndim == 2:
+                gray = image
+            else:
+                gray = cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY if image.shape[2] == 4 else cv2.COLOR_BGR2GRAY)
+            self.last_decode = {'scale': 1, 'width': image.shape[1], 'height': image.shape[0], 'reduced': False}
+            return image, gray
+
+        data = _image_source_bytes(image_path)
+
+        # 1. JPEGs much larger than detection needs are decoded straight to a reduced grayscale image
+        factor = 1
+        dimensions = None
+        if self.max_decode_side:
+            if data is None:
+                with open(image_path, 'rb') as f:
+                    dimensions = _jpeg_dimensions(f.read(64 * 1024))
+            else:
+                dimensions = _jpeg_dimensions(data)
+            if dimensions is not None:
+                factor = self._reduced_decode_factor(*dimensions)
+
+        # 2. Decode from the file or straight from memory
+        flag = getattr(cv2, f'IMREAD_REDUCED_GRAYSCALE_{factor}') if factor > 1 else cv2.IMREAD_COLOR
+        if data is None:
+            image = cv2.imread(image_path, flag)
+        else:
+            image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag) if data else None
+        if image is None:
+            return None, None
+
+        gray = image if factor > 1 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        width, height = dimensions if factor > 1 else (image.shape[1], image.shape[0])
+        self.last_decode = {'scale': factor, 'width': width, 'height': height, 'reduced': factor > 1}
+        return image, gray
+
+    def _to_original_coordinates(self, face_region):
+        """Scale a face_region from a reduced decode back to original image pixels"""
+        scale = self.last_decode['scale'] if self.last_decode else 1
+        if scale == 1:
+            return face_region
+        return {key: int(value * scale) for key, value in face_region.items()}
+
+    def _check_image_source(self, image_path):
+        """Cheap existence, size and extension checks; returns the failure message or None
+
+        These depend on the path rather than the content, so they run before any cache lookup.
+        """
+        if isinstance(image_path, str) and not image_path.startswith('data:'):
             # Check if file exists
             if not os.path.exists(image_path):
-                return False, "Image file not found"
-            
+                return "Image file not found"
+
             # Check file size
             file_size = os.path.getsize(image_path)
             if file_size == 0:
-                return False, "Image file is empty"
-            
+                return "Image file is empty"
+
             # Check file extension
             file_ext = image_path.lower().split('.')[-1]
             if file_ext not in self.supported_formats:
-                return False, f"Unsupported format. Supported formats: {', '.join(self.supported_formats)}"
-            
-            # Load and validate image
-            image = cv2.imread(image_path)
+                return f"Unsupported format. Supported formats: {', '.join(self.supported_formats)}"
+        elif image_path is None or len(image_path) == 0:
+            return "Image file is empty"
+        return None
+
+    def _validate_and_detect(self, image_path):
+        """Validate an image and keep the decoded image and detections for reuse"""
+        try:
+            source_error = self._check_image_source(image_path)
+            if source_error is not None:
+                return False, source_error, None
+
+            # Load and validate image (grayscale conversion happens with the decode)
+            image, gray = self._decode_image(image_path)
             if image is None:
-                return False, "Could not load image file"
-            
-            # Check image dimensions
-            height, width = image.shape[:2]
+                return False, "Could not load image file", None
+
+            # Check image dimensions (of the original, not a reduced decode)
+            height, width = self.last_decode['height'], self.last_decode['width']
             if height < 50 or width < 50:
-                return False, "Image is too small for face detection"
-            
-            # Convert to grayscale for face detection
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+                return False, "Image is too small for face detection", None
             
             # Try multiple detection methods
             faces = self._detect_faces_multiple_methods(gray)
+            state = {'image': image, 'gray': gray, 'faces': faces}
             
             if len(faces) == 0:
-                return False, "No face detected in the image. Please ensure good lighting and face is clearly visible."
+                return False, "No face detected in the image. Please ensure good lighting and face is clearly visible.", state
             
             if len(faces) > 5:  # Relaxed from 1 to allow some flexibility
-                return False, f"Too many faces detected ({len(faces)}). Please upload an image with fewer faces"
+                return False, f"Too many faces detected ({len(faces)}). Please upload an image with fewer faces", state
             
-            return True, f"Image is valid - {len(faces)} face(s) detected"
+            return True, f"Image is valid - {len(faces)} face(s) detected", state
             
         except Exception as e:
-            return False, f"Error validating image: {str(e)}"
+            return False, f"Error validating image: {str(e)}", None
     
-    def _detect_faces_multiple_methods(self, gray_image):
+    @_timed_stage('detect')
+    def _detect_faces_multiple_methods(self, gray_image, mode=None):
         """Try multiple face detection methods for better accuracy"""
-        all_faces = []
-        
+        mode = mode or self.detection_mode
+        if mode == 'tiered':
+            faces, passes, votes = self._detect_faces_tiered(gray_image)
+        else:
+            mode = 'exhaustive'
+            faces, passes, votes = self._detect_faces_exhaustive(gray_image)
+
+        # votes[i]: how many detector passes found faces[i] (a cheap confidence signal)
+        self.last_detection = {
+            'mode': mode,
+            'passes': passes,
+            'faces_found': len(faces),
+            'votes': votes
+        }
+        if self.metrics is not None:
+            self.metrics.increment('detection_passes', passes)
+            self.metrics.increment('faces_found', len(faces))
+        return faces
+
+    def _exhaustive_detection_passes(self):
+        """(cascade, preprocessing, scaleFactor, minNeighbors, flags) for every exhaustive pass, in merge order"""
         # Method 1: Default frontal face detector with multiple scale factors
-        for scale_factor in [1.05, 1.1, 1.15, 1.2, 1.3]:
-            for min_neighbors in [3, 4, 5, 6]:
-                try:
-                    faces = self.face_cascade_default.detectMultiScale(
-                        gray_image,
-                        scaleFactor=scale_factor,
-                        minNeighbors=min_neighbors,
-                        minSize=(20, 20),  # Reduced minimum size
-                        maxSize=(300, 300),  # Added maximum size
-                        flags=cv2.CASCADE_SCALE_IMAGE
-                    )
-                    if len(faces) > 0:
-                        all_faces.extend(faces)
-                except:
-                    continue
-        
-        # Method 2: Alternative frontal face detector
-        try:
-            faces_alt = self.face_cascade_alt.detectMultiScale(
-                gray_image,
-                scaleFactor=1.1,
-                minNeighbors=4,
-                minSize=(20, 20),
-                maxSize=(300, 300)
-            )
-            if len(faces_alt) > 0:
-                all_faces.extend(faces_alt)
-        except:
-            pass
-        
-        # Method 3: Profile face detector
+        passes = [('default', None, scale_factor, min_neighbors, cv2.CASCADE_SCALE_IMAGE)
+                  for scale_factor in [1.05, 1.1, 1.15, 1.2, 1.3]
+                  for min_neighbors in [3, 4, 5, 6]]
+        return passes + [
+            ('alt', None, 1.1, 4, 0),            # Method 2: Alternative frontal face detector
+            ('profile', None, 1.1, 4, 0),        # Method 3: Profile face detector
+            ('default', 'equalize', 1.1, 4, 0),  # Method 4: Histogram equalization
+            ('default', 'clahe', 1.1, 4, 0)      # Method 5: CLAHE (Contrast Limited Adaptive Histogram Equalization)
+        ]
+
+    def _run_detection_pass(self, gray_image, cascade, preprocessing, scale_factor, min_neighbors, flags):
+        """One detectMultiScale pass; a pass OpenCV rejects contributes no faces"""
         try:
-            faces_profile = self.face_cascade_profile.detectMultiScale(
+            if preprocessing == 'equalize':
+                gray_image = cv2.equalizeHist(gray_image)
+            elif preprocessing == 'clahe':
+                clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+                gray_image = clahe.apply(gray_image)
+
+            return cascade.detectMultiScale(
                 gray_image,
-                scaleFactor=1.1,
-                minNeighbors=4,
-                minSize=(20, 20),
-                maxSize=(300, 300)
-            )
-            if len(faces_profile) > 0:
-                all_faces.extend(faces_profile)
-        except:
-            pass
-        
-        # Method 4: Try with histogram equalization
-        try:
-            equalized = cv2.equalizeHist(gray_image)
-            faces_eq = self.face_cascade_default.detectMultiScale(
-                equalized,
-                scaleFactor=1.1,
-                minNeighbors=4,
-                minSize=(20, 20),
-                maxSize=(300, 300)
+                scaleFactor=scale_factor,
+                minNeighbors=min_neighbors,
+                minSize=(20, 20),  # Reduced minimum size
+                maxSize=(300, 300),  # Added maximum size
+                flags=flags
             )
-            if len(faces_eq) > 0:
-                all_faces.extend(faces_eq)
-        except:
-            pass
-        
-        # Method 5: Try with CLAHE (Contrast Limited Adaptive Histogram Equalization)
-        try:
-            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-            clahe_img = clahe.apply(gray_image)
-            faces_clahe = self.face_cascade_default.detectMultiScale(
-                clahe_img,
-                scaleFactor=1.1,
-                minNeighbors=4,
-                minSize=(20, 20),
-                maxSize=(300, 300)
-            )
-            if len(faces_clahe) > 0:
-                all_faces.extend(faces_clahe)
-        except:
-            pass
-        
+        except cv2.error:
+            return ()
+
+    def _run_detection_passes(self, gray_image, passes):
+        """Detections of each pass, in pass order (on the detection pool when detection_threads > 1)"""
+        # The passes are independent and OpenCV releases the GIL, so they can run side by side;
+        # results are still merged in pass order, which keeps the output identical
+        if self.detection_threads > 1:
+            return list(self._detection_executor().map(
+                lambda spec: self._run_detection_pass(gray_image, self._pool_cascade(spec[0]), *spec[1:]), passes))
+        return [self._run_detection_pass(gray_image, self._cascade(spec[0]), *spec[1:]) for spec in passes]
+
+    def _detect_faces_exhaustive(self, gray_image):
+        """Run every detector pass and merge the results (original behaviour)"""
+        passes = self._exhaustive_detection_passes()
+        results = self._run_detection_passes(gray_image, passes[:FALLBACK_PASS_START])
+
+        # A face every sweep pass agrees on needs no fallback detector
+        if self.fallback_skip_votes is not None:
+            sweep_faces, sweep_votes = self._merge_detections(results)
+            if len(sweep_faces) > 0 and min(sweep_votes) >= self.fallback_skip_votes:
+                return sweep_faces, len(results), sweep_votes
+
+        results += self._run_detection_passes(gray_image, passes[FALLBACK_PASS_START:])
+
         # Remove duplicates and merge overlapping detections
-        if len(all_faces) > 0:
-            all_faces = self._merge_overlapping_faces(all_faces)
-        
-        return all_faces
+        all_faces, votes = self._merge_detections(results)
+        return all_faces, len(passes), votes
+
+    def _tiered_detection_passes(self):
+        """Ordered (name, cascade name, preprocessing, scale_factor, min_neighbors, downscaled) passes"""
+        return [
+            # Tier 1: cheap pass on a downscaled image finds most well-lit frontal faces
+            ('default_fast', 'default', None, 1.1, 5, True),
+            # Tier 2: full resolution with the standard settings
+            ('default', 'default', None, 1.1, 4, False),
+            # Tier 3: fallbacks for harder images, cheapest first
+            ('alt', 'alt', None, 1.1, 4, False),
+            ('clahe', 'default', 'clahe', 1.1, 4, False),
+            ('equalized', 'default', 'equalize', 1.1, 4, False),
+            ('profile', 'profile', None, 1.1, 4, False),
+            ('default_sensitive', 'default', None, 1.05, 3, False)
+        ]
+
+    def _detect_faces_tiered(self, gray_image):
+        """Run detector passes cheapest first and stop at the first pass that finds a face"""
+        height, width = gray_image.shape[:2]
+        longest_side = max(height, width)
+
+        # Downscale factor for the fast pass (1.0 when the image is already small)
+        scale = min(1.0, self.tiered_fast_max_side / float(longest_side))
+        small_image = None
+        preprocessed = {}
+        passes = 0
+
+        for name, cascade_name, preprocessing, scale_factor, min_neighbors, downscaled in self._tiered_detection_passes():
+            # Skip the fast pass outright when there is nothing to downscale
+            if downscaled and scale >= 1.0:
+                continue
+
+            if downscaled:
+                if small_image is None:
+                    small_image = cv2.resize(gray_image, (int(round(width * scale)), int(round(height * scale))),
+                                             interpolation=cv2.INTER_AREA)
+                image, pass_scale = small_image, scale
+            else:
+                image, pass_scale = gray_image, 1.0
+
+            if preprocessing is not None:
+                key = (preprocessing, downscaled)
+                if key not in preprocessed:
+                    if preprocessing == 'clahe':
+                        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+                        preprocessed[key] = clahe.apply(image)
+                    else:
+                        preprocessed[key] = cv2.equalizeHist(image)
+                image = preprocessed[key]
+
+            min_side = max(12, int(round(20 * pass_scale)))
+            max_side = max(min_side + 1, int(round(300 * pass_scale)))
+
+            passes += 1
+            try:
+                faces = self._cascade(cascade_name).detectMultiScale(
+                    image,
+                    scaleFactor=scale_factor,
+                    minNeighbors=min_neighbors,
+                    minSize=(min_side, min_side),
+                    maxSize=(max_side, max_side)
+                )
+            except:
+                continue
+
+            if len(faces) > 0:
+                # Map detections back to full-resolution coordinates
+                if pass_scale != 1.0:
+                    faces = np.round(np.asarray(faces, dtype=np.float64) / pass_scale).astype(np.int32)
+                    faces[:, 0] = np.clip(faces[:, 0], 0, width - 1)
+                    faces[:, 1] = np.clip(faces[:, 1], 0, height - 1)
+                    faces[:, 2] = np.minimum(faces[:, 2], width - faces[:, 0])
+                    faces[:, 3] = np.minimum(faces[:, 3], height - faces[:, 1])
+                merged, votes = self._merge_detections([faces])
+                return merged, passes, votes
+
+        return [], passes, []
     
-    def _merge_overlapping_faces(self, faces):
-        """Merge overlapping face detections"""
+    def _merge_detections(self, pass_results):
+        """Merge the boxes of several passes; returns (faces, votes) where votes counts the passes behind each face"""
+        boxes = [face for faces in pass_results for face in faces]
+        if len(boxes) == 0:
+            return [], []
+        pass_ids = np.repeat(np.arange(len(pass_results)), [len(faces) for faces in pass_results])
+        return self._merge_overlapping_faces(boxes, pass_ids, with_votes=True)
+
+    def _merge_overlapping_faces(self, faces, pass_ids=None, with_votes=False):
+        """Merge overlapping face detections
+
+        Boxes are visited in order and a box overlapping an already kept box by more
+        than 30% of the smaller area joins that box's cluster. The overlap test runs
+        as one NumPy matrix, so the Python loop only steps once per kept face.
+        """
         if len(faces) <= 1:
-            return faces
-        
-        # Convert to list of tuples for easier processing
-        faces_list = [tuple(face) for face in faces]
-        merged_faces = []
-        
-        for face in faces_list:
-            x1, y1, w1, h1 = face
-            is_duplicate = False
-            
-            for existing_face in merged_faces:
-                x2, y2, w2, h2 = existing_face
-                
-                # Calculate overlap
-                overlap_x = max(0, min(x1 + w1, x2 + w2) - max(x1, x2))
-                overlap_y = max(0, min(y1 + h1, y2 + h2) - max(y1, y2))
-                overlap_area = overlap_x * overlap_y
-                
-                area1 = w1 * h1
-                area2 = w2 * h2
-                
-                # If overlap is significant, consider it a duplicate
-                if overlap_area > 0.3 * min(area1, area2):
-                    is_duplicate = True
-                    break
-            
-            if not is_duplicate:
-                merged_faces.append(face)
-        
-        return np.array(merged_faces)
-    
-    def extract_face_features(self, image_path):
+            return (faces, [1] * len(faces)) if with_votes else faces
+
+        boxes = np.asarray(faces)
+        x1, y1, w, h = boxes.astype(np.int64).T
+        x2, y2 = x1 + w, y1 + h
+
+        # Pairwise overlap area against 30% of the smaller box
+        overlap_x = np.maximum(0, np.minimum(x2[:, None], x2[None, :]) - np.maximum(x1[:, None], x1[None, :]))
+        overlap_y = np.maximum(0, np.minimum(y2[:, None], y2[None, :]) - np.maximum(y1[:, None], y1[None, :]))
+        area = w * h
+        duplicate = overlap_x * overlap_y > 0.3 * np.minimum(area[:, None], area[None, :])
+
+        # Greedy assignment, one step per kept box: the earliest unassigned box starts a cluster
+        # and takes every unassigned box it overlaps (the first kept box a box overlaps wins)
+        keep = []
+        owner = np.empty(len(boxes), dtype=np.int64)
+        unassigned = np.ones(len(boxes), dtype=bool)
+        while unassigned.any():
+            i = int(np.argmax(unassigned))
+            members = unassigned & duplicate[i]
+            members[i] = True
+            owner[members] = i
+            unassigned &= ~members
+            keep.append(i)
+
+        if self.merge_strategy == 'fused':
+            # Average each cluster's corners (weighted box fusion with equal weights)
+            corners = np.stack([x1, y1, x2, y2], axis=1).astype(np.float64)
+            sums = np.zeros((len(boxes), 4))
+            np.add.at(sums, owner, corners)
+            counts = np.bincount(owner, minlength=len(boxes))[keep]
+            fused = np.round(sums[keep] / counts[:, None]).astype(boxes.dtype)
+            merged = np.stack([fused[:, 0], fused[:, 1], fused[:, 2] - fused[:, 0], fused[:, 3] - fused[:, 1]], axis=1)
+        else:
+            merged = boxes[keep]
+
+        if not with_votes:
+            return merged
+
+        # Votes count distinct passes, not boxes (one pass may report a face twice)
+        voters = owner if pass_ids is None else np.unique(np.stack([owner, pass_ids], axis=1), axis=0)[:, 0]
+        counts = np.bincount(voters, minlength=len(boxes))
+        return merged, [int(counts[k]) for k in keep]
+
+    @_instrumented_operation('extract_face_features')
+    def extract_face_features(self, image_path, include_thumbnail=None):
         """Extract face features using multiple methods for better accuracy"""
+        include_thumbnail = self.include_thumbnail if include_thumbnail is None else include_thumbnail
+        cache_key = self._result_cache_key(image_path, 'extract' if include_thumbnail else 'extract:features')
+        if cache_key is not None:
+            cached = self.result_cache.get(cache_key)
+            if cached is not None:
+                return cached[0], cached[1]
+
+        face_data, message = self._extract_face_features_uncached(image_path, include_thumbnail)
+
+        # Only deterministic outcomes are cached; unexpected errors are retried next time
+        if cache_key is not None and not message.startswith('Error'):
+            self.result_cache.put(cache_key, [face_data, message])
+        return face_data, message
+
+    def _extract_face_features_uncached(self, image_path, include_thumbnail=True):
         try:
-            # Load image
-            image = cv2.imread(image_path)
+            # Load image and convert to grayscale
+            image, gray = self._decode_image(image_path)
             if image is None:
                 return None, "Could not load image file"
             
-            # Convert to grayscale
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            
             # Detect faces using improved method
             faces = self._detect_faces_multiple_methods(gray)
             
+            return self._extract_from_detections(gray, faces, include_thumbnail)
+            
+        except Exception as e:
+            return None, f"Error extracting face features: {str(e)}"
+
+    def _extract_from_detections(self, gray, faces, include_thumbnail=True):
+        """Extract features for the main face of an already decoded and detected image"""
+        try:
             if len(faces) == 0:
                 return None, "No face found in image"
             
@@ -210,70 +769,153 @@ class ImageEncoder:
             if len(faces) > 1:
                 face_areas = [w * h for (x, y, w, h) in faces]
                 largest_face_idx = np.argmax(face_areas)
-                x, y, w, h = faces[largest_face_idx]
+                face = faces[largest_face_idx]
             else:
-                x, y, w, h = faces[0]
-            
-            # Add some padding around the face
-            padding = int(min(w, h) * 0.1)
-            x = max(0, x - padding)
-            y = max(0, y - padding)
-            w = min(gray.shape[1] - x, w + 2 * padding)
-            h = min(gray.shape[0] - y, h + 2 * padding)
-            
-            # Extract face region
-            face_roi = gray[y:y+h, x:x+w]
-            
-            # Resize face to standard size for consistency
-            face_resized = cv2.resize(face_roi, (100, 100))
-            
-            # Apply preprocessing to improve feature extraction
-            face_processed = self._preprocess_face(face_resized)
-            
-            # Extract multiple types of features for better recognition
-            features = []
-            
-            # 1. Histogram features
-            hist_features = self._extract_histogram_features(face_processed)
-            features.extend(hist_features)
-            
-            # 2. Simple LBP features (fixed version)
-            lbp_features = self._extract_simple_lbp_features(face_processed)
-            features.extend(lbp_features)
-            
-            # 3. Pixel intensity features (normalized)
-            pixel_features = self._extract_pixel_features(face_processed)
-            features.extend(pixel_features)
-            
-            # 4. Gradient features
-            gradient_features = self._extract_gradient_features(face_processed)
-            features.extend(gradient_features)
-            
-            # Convert to numpy array and normalize
-            features = np.array(features, dtype=np.float32)
-            features = self._normalize_features(features)
+                face = faces[0]
+
+            features, face_region, face_resized = self._extract_face_region(gray, face)
             
             # Store face data
             face_data = {
                 'features': features.tolist(),
-                'face_region': {
-                    'x': int(x),
-                    'y': int(y),
-                    'width': int(w),
-                    'height': int(h)
-                },
-                'face_image_base64': self._face_to_base64(face_resized),
-                'total_faces_detected': len(faces)
+                'face_region': self._to_original_coordinates(face_region),
+                'face_image_base64': self._face_to_base64(face_resized) if include_thumbnail else None,
+                'total_faces_detected': len(faces),
+                'detection': dict(self.last_detection)
             }
             
             return face_data, "Face feature extraction successful"
             
         except Exception as e:
             return None, f"Error extracting face features: {str(e)}"
+
+    @_instrumented_operation('extract_all_face_features')
+    def extract_all_face_features(self, image_path, max_faces=None, include_thumbnails=False):
+        """Extract features for every face in one decode (group / classroom frames)"""
+        try:
+            image, gray = self._decode_image(image_path)
+            if image is None:
+                return None, "Could not load image file"
+
+            faces = self._detect_faces_multiple_methods(gray)
+            if len(faces) == 0:
+                return None, "No face found in image"
+
+            # Keep the largest faces when over the limit, then report them left to right
+            max_faces = max_faces or self.group_max_faces
+            order = np.argsort([-(w * h) for (x, y, w, h) in faces], kind='stable')[:max_faces]
+            order = sorted(order, key=lambda i: (faces[i][0], faces[i][1]))
+            votes = self.last_detection['votes']
+
+            face_list = []
+            for face_index, i in enumerate(order):
+                features, face_region, face_resized = self._extract_face_region(gray, faces[i])
+                face_data = {
+                    'face_index': face_index,
+                    'features': features.tolist(),
+                    'face_region': self._to_original_coordinates(face_region),
+                    'votes': votes[i]
+                }
+                if include_thumbnails:
+                    face_data['face_image_base64'] = self._face_to_base64(face_resized)
+                face_list.append(face_data)
+
+            return {
+                'faces': face_list,
+                'total_faces_detected': len(face_list),
+                'detection': dict(self.last_detection)
+            }, f"Extracted features for {len(face_list)} face(s)"
+
+        except Exception as e:
+            return None, f"Error extracting face features: {str(e)}"
+
+    def _working_buffers(self):
+        """Preallocated arrays for one face through the crop/CLAHE/blur/gradient chain, or None when disabled"""
+        if not self.reuse_buffers:
+            return None
+        if self._buffers is None:
+            self._buffers = {
+                'resized': np.empty((100, 100), dtype=np.uint8),
+                'enhanced': np.empty((100, 100), dtype=np.uint8),
+                'blurred': np.empty((100, 100), dtype=np.uint8),
+                'padded': np.empty((102, 102), dtype=np.float64),
+                'small': np.empty((16, 16), dtype=np.uint8),
+                'clahe': cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+            }
+        return self._buffers
+
+    @_timed_stage('extract')
+    def _extract_face_region(self, gray, face):
+        """Feature vector, padded region and 100x100 crop for one detected face
+
+        With reuse_buffers the crop is a working buffer, overwritten by the next extraction.
+        """
+        x, y, w, h = face
+
+        # Add some padding around the face
+        padding = int(min(w, h) * 0.1)
+        x = max(0, x - padding)
+        y = max(0, y - padding)
+        w = min(gray.shape[1] - x, w + 2 * padding)
+        h = min(gray.shape[0] - y, h + 2 * padding)
+        
+        # Extract face region
+        face_roi = gray[y:y+h, x:x+w]
+        
+        # Resize face to standard size for consistency
+        buffers = self._working_buffers()
+        if buffers is not None:
+            face_resized = cv2.resize(face_roi, (100, 100), dst=buffers['resized'])
+        else:
+            face_resized = cv2.resize(face_roi, (100, 100))
+        
+        # Apply preprocessing to improve feature extraction
+        face_processed = self._preprocess_face(face_resized)
+        
+        # Extract multiple types of features for better recognition
+        features = []
+
+        # Sobel gradients are computed once and shared by the region and global gradient features
+        gradients = self._compute_face_gradients(face_processed)
+        
+        # 1. Histogram features
+        hist_features = self._extract_histogram_features(face_processed)
+        features.extend(hist_features)
+        
+        # 2. Simple LBP features (fixed version)
+        lbp_features = self._extract_simple_lbp_features(face_processed, gradients)
+        features.extend(lbp_features)
+        
+        # 3. Pixel intensity features (normalized)
+        pixel_features = self._extract_pixel_features(face_processed)
+        features.extend(pixel_features)
+        
+        # 4. Gradient features
+        gradient_features = self._extract_gradient_features(face_processed, gradients)
+        features.extend(gradient_features)
+        
+        # Convert to numpy array and normalize
+        features = np.array(features, dtype=np.float32)
+        features = self._normalize_features(features)
+
+        face_region = {
+            'x': int(x),
+            'y': int(y),
+            'width': int(w),
+            'height': int(h)
+        }
+        return features, face_region, face_resized
     
+    @_timed_stage('extract.preprocess')
     def _preprocess_face(self, face_image):
         """Preprocess face image for better feature extraction"""
         try:
+            buffers = self._working_buffers() if face_image.shape == (100, 100) else None
+            if buffers is not None:
+                # Same CLAHE and blur, written into the encoder's working buffers
+                enhanced = buffers['clahe'].apply(face_image, buffers['enhanced'])
+                return cv2.GaussianBlur(enhanced, (3, 3), 0, dst=buffers['blurred'])
+
             # Apply CLAHE for better contrast
             clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
             enhanced = clahe.apply(face_image)
@@ -285,15 +927,73 @@ class ImageEncoder:
         except:
             return face_image
     
-    def _extract_gradient_features(self, face_image):
+    def _sobel_3x3(self, padded):
+        """3x3 Sobel (x, y) over a stack of images already padded by one pixel on each side"""
+        # Same integer kernels as cv2.Sobel(ksize=3), evaluated with array slicing
+        left, centre, right = padded[:, :, :-2], padded[:, :, 1:-1], padded[:, :, 2:]
+        horizontal_diff = right - left
+        horizontal_sum = left + 2 * centre + right
+        grad_x = horizontal_diff[:, :-2] + 2 * horizontal_diff[:, 1:-1] + horizontal_diff[:, 2:]
+        grad_y = horizontal_sum[:, 2:] - horizontal_sum[:, :-2]
+        return grad_x, grad_y
+
+    @_timed_stage('extract.gradients')
+    def _compute_face_gradients(self, face_image):
+        """Compute Sobel gradients for the whole face and for every 6x6 grid region in one pass"""
+        try:
+            h, w = face_image.shape
+            regions_h, regions_w = 6, 6
+            region_h, region_w = h // regions_h, w // regions_w
+
+            # Reflect-101 padding reproduces cv2.Sobel's default border handling
+            buffers = self._working_buffers()
+            if buffers is not None and buffers['padded'].shape == (h + 2, w + 2):
+                padded = buffers['padded']
+                face = padded[1:-1, 1:-1]
+                np.copyto(face, face_image)
+                padded[0, 1:-1], padded[-1, 1:-1] = padded[2, 1:-1], padded[-3, 1:-1]
+                padded[:, 0], padded[:, -1] = padded[:, 2], padded[:, -3]
+            else:
+                face = face_image.astype(np.float64)
+                padded = np.pad(face, 1, mode='reflect')
+            grad_x, grad_y = self._sobel_3x3(padded[np.newaxis])
+            gradients = {
+                'grad_x': grad_x[0],
+                'grad_y': grad_y[0],
+                'magnitude': np.sqrt(grad_x[0]**2 + grad_y[0]**2),
+                'regions': None
+            }
+
+            # Region gradients are taken per region (each with its own border), as in the loop version
+            if region_h >= 2 and region_w >= 2:
+                grid = face[:regions_h * region_h, :regions_w * region_w]
+                regions = (grid.reshape(regions_h, region_h, regions_w, region_w)
+                               .transpose(0, 2, 1, 3)
+                               .reshape(regions_h * regions_w, region_h, region_w))
+                region_grad_x, region_grad_y = self._sobel_3x3(
+                    np.pad(regions, ((0, 0), (1, 1), (1, 1)), mode='reflect')
+                )
+                gradients['regions'] = regions
+                gradients['region_magnitude'] = np.sqrt(region_grad_x**2 + region_grad_y**2)
+
+            return gradients
+        except:
+            return None
+
+    @_timed_stage('extract.gradient_features')
+    def _extract_gradient_features(self, face_image, gradients=None):
         """Extract gradient-based features"""
         try:
-            # Calculate gradients
-            grad_x = cv2.Sobel(face_image, cv2.CV_64F, 1, 0, ksize=3)
-            grad_y = cv2.Sobel(face_image, cv2.CV_64F, 0, 1, ksize=3)
+            # Calculate gradients (reuse the shared buffers when available)
+            if gradients is not None:
+                grad_x, grad_y = gradients['grad_x'], gradients['grad_y']
+                magnitude = gradients['magnitude']
+            else:
+                grad_x = cv2.Sobel(face_image, cv2.CV_64F, 1, 0, ksize=3)
+                grad_y = cv2.Sobel(face_image, cv2.CV_64F, 0, 1, ksize=3)
+                magnitude = np.sqrt(grad_x**2 + grad_y**2)
             
-            # Gradient magnitude and direction
-            magnitude = np.sqrt(grad_x**2 + grad_y**2)
+            # Gradient direction
             direction = np.arctan2(grad_y, grad_x)
             
             # Extract statistical features from gradients
@@ -310,6 +1010,7 @@ class ImageEncoder:
         except:
             return [0.0] * 6
     
+    @_timed_stage('extract.histogram')
     def _extract_histogram_features(self, face_image):
         """Extract histogram features from face image"""
         try:
@@ -322,8 +1023,31 @@ class ImageEncoder:
         except:
             return [0.0] * 64
     
-    def _extract_simple_lbp_features(self, face_image):
+    @_timed_stage('extract.lbp')
+    def _extract_simple_lbp_features(self, face_image, gradients=None):
         """Extract simplified LBP features - IMPROVED VERSION"""
+        if gradients is None:
+            gradients = self._compute_face_gradients(face_image)
+
+        # Vectorized path: all 36 region statistics from the precomputed region stack
+        if gradients is not None and gradients.get('regions') is not None:
+            try:
+                regions = gradients['regions']
+                region_magnitude = gradients['region_magnitude']
+                stats = np.stack([
+                    regions.mean(axis=(1, 2)),
+                    regions.std(axis=(1, 2)),
+                    region_magnitude.mean(axis=(1, 2)),
+                    region_magnitude.std(axis=(1, 2))
+                ], axis=1)
+                return stats.ravel().tolist()
+            except:
+                pass
+
+        return self._extract_simple_lbp_features_loop(face_image)
+
+    def _extract_simple_lbp_features_loop(self, face_image):
+        """Per-region loop version of the grid features, used for faces too small for the vectorized path"""
         try:
             lbp_features = []
             
@@ -381,17 +1105,21 @@ class ImageEncoder:
             except:
                 return [0.0, 0.0, 0.0, 0.0]
     
+    @_timed_stage('extract.pixels')
     def _extract_pixel_features(self, face_image):
         """Extract normalized pixel intensity features"""
         try:
             # Resize to smaller size for manageable feature vector
-            small_face = cv2.resize(face_image, (16, 16))  # Reduced from 20x20 for efficiency
+            buffers = self._working_buffers()
+            small_face = cv2.resize(face_image, (16, 16),  # Reduced from 20x20 for efficiency
+                                    dst=buffers['small'] if buffers is not None else None)
             # Normalize pixel values
             pixels = small_face.flatten().astype(np.float32) / 255.0
             return pixels.tolist()
         except:
             return [0.0] * 256
     
+    @_timed_stage('extract.normalize')
     def _normalize_features(self, features):
         """Normalize feature vector"""
         try:
@@ -414,6 +1142,7 @@ class ImageEncoder:
         except:
             return np.zeros_like(features, dtype=np.float32)
     
+    @_timed_stage('thumbnail')
     def _face_to_base64(self, face_image):
         """Convert face image to base64 string for storage"""
         try:
@@ -424,15 +1153,37 @@ class ImageEncoder:
             return face_base64
         except:
             return None
+
+    def face_thumbnail(self, image_path, face_region):
+        """Base64 PNG crop for a face_region returned by an extraction that skipped the thumbnail"""
+        try:
+            image, gray = self._decode_image(image_path)
+            if image is None:
+                return None, "Could not load image file"
+
+            # face_region is in original pixels; map it onto the (possibly reduced) decode
+            scale = self.last_decode['scale']
+            x, y = int(face_region['x']) // scale, int(face_region['y']) // scale
+            w, h = int(face_region['width']) // scale, int(face_region['height']) // scale
+            face_roi = gray[y:y+h, x:x+w]
+            if face_roi.size == 0:
+                return None, "Face region is outside the image"
+
+            return self._face_to_base64(cv2.resize(face_roi, (100, 100))), "Thumbnail created"
+        except Exception as e:
+            return None, f"Error creating thumbnail: {str(e)}"
     
-    def process_student_image(self, image_path, student_id):
+    @_instrumented_operation('process_student_image')
+    def process_student_image(self, image_path, student_id, encoding_format=None, include_thumbnail=None):
         """Complete processing of student image for registration"""
+        encoding_format = encoding_format or self.encoding_format
+        include_thumbnail = self.include_thumbnail if include_thumbnail is None else include_thumbnail
         try:
             # Log processing start
             # sys.stderr.write(f"Starting image processing for student {student_id}\n")
             
-            # Validate image
-            is_valid, validation_msg = self.validate_image(image_path)
+            # Validate and extract from one decode and detection pass (or the result cache)
+            is_valid, validation_msg, face_data, extraction_msg = self._validate_and_extract(image_path, include_thumbnail)
             # sys.stderr.write(f"Validation result: {is_valid}, {validation_msg}\n")
             
             if not is_valid:
@@ -442,8 +1193,6 @@ class ImageEncoder:
                     'data': None
                 }
             
-            # Extract face features
-            face_data, extraction_msg = self.extract_face_features(image_path)
             # sys.stderr.write(f"Feature extraction result: {extraction_msg}\n")
             
             if face_data is None:
@@ -453,17 +1202,28 @@ class ImageEncoder:
                     'data': None
                 }
             
+            # Compact mode stores one packed string in place of the list and its JSON copy
+            if encoding_format == 'json':
+                face_encoding = face_data['features']
+                face_features_json = json.dumps(face_data['features'])
+            else:
+                face_encoding = encode_features(face_data['features'], encoding_format)
+                face_features_json = face_encoding
+
             # Format response to match PHP expectations
             processed_data = {
-                'face_encoding': face_data['features'],  # Direct array for PHP compareFaces()
+                'face_encoding': face_encoding,  # Direct array for PHP compareFaces()
                 'student_id': student_id,
-                'face_features_json': json.dumps(face_data['features']),  # For database storage
+                'face_features_json': face_features_json,  # For database storage
                 'face_region': json.dumps(face_data['face_region']),
                 'face_image_base64': face_data['face_image_base64'],
                 'features_length': len(face_data['features']),
                 'validation_message': validation_msg,
-                'extraction_method': 'OpenCV_Enhanced_Features',
-                'total_faces_detected': face_data.get('total_faces_detected', 1)
+                'extraction_method': EXTRACTION_METHOD,
+                'encoding_format': encoding_format,
+                'total_faces_detected': face_data.get('total_faces_detected', 1),
+                'detection_mode': face_data['detection']['mode'],
+                'detection_passes': face_data['detection']['passes']
             }
             
             # sys.stderr.write(f"Successfully processed {len(face_data['features'])} features\n")
@@ -483,14 +1243,41 @@ class ImageEncoder:
                 'data': None
             }
     
+    def _validate_and_extract(self, image_path, include_thumbnail=True):
+        """Validation and main-face extraction for registration; returns (is_valid, validation_msg, face_data, extraction_msg)"""
+        try:
+            source_error = self._check_image_source(image_path)
+        except Exception as e:
+            return False, f"Error validating image: {str(e)}", None, None
+        if source_error is not None:
+            return False, source_error, None, None
+
+        cache_key = self._result_cache_key(image_path, 'register' if include_thumbnail else 'register:features')
+        if cache_key is not None:
+            cached = self.result_cache.get(cache_key)
+            if cached is not None:
+                return tuple(cached)
+
+        # The decoded image and detections from validation are kept for extraction
+        is_valid, validation_msg, state = self._validate_and_detect(image_path)
+        face_data, extraction_msg = None, None
+        if is_valid:
+            face_data, extraction_msg = self._extract_from_detections(state['gray'], state['faces'], include_thumbnail)
+
+        outcome = (is_valid, validation_msg, face_data, extraction_msg)
+        if cache_key is not None and not validation_msg.startswith('Error') and not (extraction_msg or '').startswith('Error'):
+            self.result_cache.put(cache_key, list(outcome))
+        return outcome
+
+    @_instrumented_operation('compare_faces')
     def compare_faces(self, features1, features2, threshold=0.6):  # Lowered threshold slightly
         """Compare two face feature sets using multiple similarity metrics"""
         try:
-            # Convert to numpy arrays if they're lists
-            if isinstance(features1, list):
-                features1 = np.array(features1, dtype=np.float32)
-            if isinstance(features2, list):
-                features2 = np.array(features2, dtype=np.float32)
+            # Convert to numpy arrays if they're lists or encoded strings
+            if isinstance(features1, (list, str, bytes)):
+                features1 = decode_features(features1)
+            if isinstance(features2, (list, str, bytes)):
+                features2 = decode_features(features2)
             
             # Handle NaN values
             features1 = np.nan_to_num(features1, nan=0.0)
@@ -533,13 +1320,14 @@ class ImageEncoder:
             manhattan_sim = 1 / (1 + manhattan_dist)
             
             # Combined similarity score (weighted average)
-            similarity = (cosine_sim * 0.35 + euclidean_sim * 0.25 + 
-                         (correlation + 1) / 2 * 0.25 + manhattan_sim * 0.15)
+            weights = self.similarity_weights
+            similarity = (cosine_sim * weights['cosine'] + euclidean_sim * weights['euclidean'] +
+                         (correlation + 1) / 2 * weights['correlation'] + manhattan_sim * weights['manhattan'])
             
             # Ensure similarity is between 0 and 1
             similarity = max(0, min(1, similarity))
             
-            is_match = similarity >= threshold
+            is_match = bool(similarity >= threshold)
             
             return {
                 'is_match': is_match,
@@ -560,11 +1348,393 @@ class ImageEncoder:
                 'error': str(e)
             }
 
+    @_timed_stage('identify.score')
+    def _score_gallery(self, probe, gallery):
+        """Compute the compare_faces metrics for a probe against every gallery row"""
+        # 1. Cosine similarity
+        dot_products = gallery @ probe
+        probe_norm = np.linalg.norm(probe)
+        gallery_norms = np.linalg.norm(gallery, axis=1)
+        norm_products = gallery_norms * probe_norm
+        valid = (gallery_norms > 1e-6) & (probe_norm > 1e-6)
+        cosine_sim = np.where(valid, dot_products / np.where(valid, norm_products, 1.0), 0.0)
+
+        # 2. Euclidean and 4. Manhattan distances share one difference matrix
+        diff = gallery - probe
+        euclidean_dist = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+        manhattan_dist = np.abs(diff).sum(axis=1)
+        euclidean_sim = 1 / (1 + euclidean_dist)
+        manhattan_sim = 1 / (1 + manhattan_dist)
+
+        # 3. Correlation coefficient (Pearson, same as np.corrcoef per pair)
+        probe_centered = probe - probe.mean()
+        gallery_centered = gallery - gallery.mean(axis=1, keepdims=True)
+        corr_denominator = np.linalg.norm(gallery_centered, axis=1) * np.linalg.norm(probe_centered)
+        has_variance = corr_denominator > 0
+        correlation = np.where(
+            has_variance,
+            (gallery_centered @ probe_centered) / np.where(has_variance, corr_denominator, 1.0),
+            0.0
+        )
+        correlation = np.clip(correlation, -1.0, 1.0)
+
+        # Combined similarity score (same weights as compare_faces)
+        weights = self.similarity_weights
+        similarity = (cosine_sim * weights['cosine'] + euclidean_sim * weights['euclidean'] +
+                      (correlation + 1) / 2 * weights['correlation'] + manhattan_sim * weights['manhattan'])
+        similarity = np.clip(similarity, 0, 1)
+
+        return {
+            'similarity_score': similarity,
+            'cosine_similarity': cosine_sim,
+            'euclidean_similarity': euclidean_sim,
+            'correlation': correlation,
+            'manhattan_similarity': manhattan_sim,
+            'euclidean_distance': euclidean_dist,
+            'manhattan_distance': manhattan_dist
+        }
+
+    def build_quantized_index(self, gallery_matrix):
+        """Quantize L2-normalized gallery rows to int8 codes for the approximate search stage"""
+        gallery = np.asarray(decode_feature_matrix(gallery_matrix), dtype=np.float32)
+        if gallery.ndim == 1:
+            gallery = gallery.reshape(1, -1)
+
+        codes = np.empty(gallery.shape, dtype=np.int8)
+        for start in range(0, gallery.shape[0], self.identify_block_rows):
+            block = np.nan_to_num(gallery[start:start + self.identify_block_rows], nan=0.0)
+            norms = np.linalg.norm(block, axis=1, keepdims=True)
+            normalized = block / np.where(norms > 1e-6, norms, 1.0)
+            codes[start:start + len(block)] = np.clip(np.round(normalized * 127), -127, 127)
+        return codes
+
+    @_timed_stage('identify.quantized_scan')
+    def _quantized_cosine_scan(self, probe, codes):
+        """Approximate cosine scores of a probe against int8 codes (scaled by 127^2)"""
+        probe_norm = np.linalg.norm(probe)
+        probe_codes = np.round(probe / (probe_norm if probe_norm > 1e-6 else 1.0) * 127).astype(np.float32)
+
+        # NumPy has no int8 GEMV, so cache-sized blocks are widened to float32 for BLAS
+        scores = np.empty(codes.shape[0], dtype=np.float32)
+        for start in range(0, codes.shape[0], self.identify_block_rows):
+            block = codes[start:start + self.identify_block_rows]
+            scores[start:start + len(block)] = block.astype(np.float32) @ probe_codes
+        return scores
+
+    @_instrumented_operation('identify')
+    def identify(self, probe, gallery_matrix, top_k=5, threshold=0.6, gallery_ids=None, row_mask=None,
+                 search_mode='exact', quantized_index=None, rerank_candidates=None, aggregate=None,
+                 identity_thresholds=None):
+        """Identify a probe against a whole gallery matrix in one vectorized pass
+
+        With aggregate ('max' or 'mean') rows sharing a gallery id are one identity and
+        matches are ranked per identity; identity_thresholds maps str(id) to a calibrated
+        threshold used instead of threshold for that identity.
+        """
+        try:
+            probe = np.nan_to_num(decode_features(probe), nan=0.0)
+
+            # Memory-mapped float32 galleries are used in place; only copy when cleaning is needed
+            gallery = np.asarray(decode_feature_matrix(gallery_matrix), dtype=np.float32)
+            if gallery.size == 0:
+                # An empty gallery is zero rows, not one row of length zero
+                gallery = gallery.reshape(0, probe.shape[0])
+            elif gallery.ndim == 1:
+                gallery = gallery.reshape(1, -1)
+            if gallery.size > 0 and np.isnan(gallery).any():
+                gallery = np.nan_to_num(gallery, nan=0.0)
+
+            # Rows excluded by the mask (e.g. tombstoned enrollments) are never returned
+            if row_mask is not None:
+                eligible = np.flatnonzero(np.asarray(row_mask, dtype=bool)[:gallery.shape[0]])
+            else:
+                eligible = None
+            gallery_size = gallery.shape[0] if eligible is None else len(eligible)
+
+            if gallery_size == 0:
+                return {
+                    'success': True,
+                    'matches': [],
+                    'best_match': None,
+                    'gallery_size': 0,
+                    'threshold': threshold,
+                    'search_mode': search_mode
+                }
+
+            # Ensure same length
+            if gallery.shape[1] != probe.shape[0]:
+                return {
+                    'success': False,
+                    'matches': [],
+                    'error': 'Probe and gallery feature vectors have different lengths'
+                }
+
+            if gallery_ids is not None and len(gallery_ids) != gallery.shape[0]:
+                return {
+                    'success': False,
+                    'matches': [],
+                    'error': 'gallery_ids does not match the number of gallery rows'
+                }
+
+            if aggregate is not None and (aggregate not in TEMPLATE_AGGREGATES or gallery_ids is None):
+                return {
+                    'success': False,
+                    'matches': [],
+                    'error': f"aggregate must be one of {', '.join(TEMPLATE_AGGREGATES)} and needs gallery_ids"
+                }
+
+            top_k = max(1, min(int(top_k), gallery_size))
+
+            if search_mode == 'two_stage':
+                # Stage 1: approximate cosine scan over int8 codes picks the candidates
+                codes = quantized_index if quantized_index is not None else self.build_quantized_index(gallery)
+                approx = self._quantized_cosine_scan(probe, codes)
+                if eligible is not None:
+                    excluded = np.ones(len(approx), dtype=bool)
+                    excluded[eligible] = False
+                    approx[excluded] = -np.inf
+                candidate_count = min(gallery_size, max(top_k, rerank_candidates or self.rerank_candidates))
+                scored_rows = np.sort(np.argpartition(-approx, candidate_count - 1)[:candidate_count])
+
+                # Stage 2: exact compare_faces score for the candidates only
+                scores = self._score_gallery(probe, gallery[scored_rows])
+            elif search_mode == 'exact':
+                # Score in row blocks so temporaries stay bounded for large galleries
+                block_scores = []
+                for start in range(0, gallery.shape[0], self.identify_block_rows):
+                    block_scores.append(self._score_gallery(probe, gallery[start:start + self.identify_block_rows]))
+                scores = {
+                    metric: np.concatenate([block[metric] for block in block_scores])
+                    for metric in block_scores[0]
+                }
+                if eligible is not None:
+                    scores = {metric: values[eligible] for metric, values in scores.items()}
+                scored_rows = eligible
+            else:
+                return {
+                    'success': False,
+                    'matches': [],
+                    'error': f"Unknown search mode '{search_mode}'"
+                }
+
+            # Collapse the scored rows to one entry per identity (row = its best-scoring template)
+            template_counts = None
+            if aggregate is not None:
+                if scored_rows is None:
+                    scored_rows = np.arange(gallery.shape[0])
+                scores, scored_rows, template_counts = self._aggregate_identities(
+                    scores, scored_rows, gallery_ids, aggregate)
+                top_k = min(top_k, len(scored_rows))
+
+            similarity = scores['similarity_score']
+
+            # Pick the top-k rows without sorting the whole gallery
+            if top_k < len(similarity):
+                candidates = np.argpartition(-similarity, top_k - 1)[:top_k]
+            else:
+                candidates = np.arange(len(similarity))
+            candidates = candidates[np.argsort(-similarity[candidates], kind='stable')]
+
+            matches = []
+            for rank, pos in enumerate(candidates, start=1):
+                idx = int(scored_rows[pos]) if scored_rows is not None else int(pos)
+                match_threshold = threshold
+                if identity_thresholds and gallery_ids is not None:
+                    match_threshold = identity_thresholds.get(str(gallery_ids[idx]), threshold)
+                match = {
+                    'rank': rank,
+                    'index': idx,
+                    'is_match': bool(similarity[pos] >= match_threshold)
+                }
+                if gallery_ids is not None:
+                    match['id'] = gallery_ids[idx]
+                for metric, values in scores.items():
+                    match[metric] = float(values[pos])
+                if template_counts is not None:
+                    match['templates'] = int(template_counts[pos])
+                if identity_thresholds:
+                    match['threshold'] = match_threshold
+                matches.append(match)
+
+            best_match = matches[0] if matches and matches[0]['is_match'] else None
+
+            return {
+                'success': True,
+                'matches': matches,
+                'best_match': best_match,
+                'gallery_size': int(gallery_size),
+                'threshold': threshold,
+                'search_mode': search_mode,
+                **({'aggregate': aggregate, 'identities': len(scored_rows)} if aggregate is not None else {})
+            }
+
+        except Exception as e:
+            return {
+                'success': False,
+                'matches': [],
+                'error': str(e)
+            }
+
+    def _aggregate_identities(self, scores, scored_rows, gallery_ids, aggregate='max'):
+        """Group per-row scores by gallery id; returns (scores, best row per identity, templates per identity)"""
+        keys = np.array([str(gallery_ids[row]) for row in scored_rows])
+        _, identity = np.unique(keys, return_inverse=True)
+        identity = identity.ravel()
+        counts = np.bincount(identity)
+
+        # Best-scoring row of each identity: sort by identity, then by descending score
+        order = np.lexsort((-scores['similarity_score'], identity))
+        best = order[np.r_[0, np.flatnonzero(np.diff(identity[order])) + 1]]
+
+        if aggregate == 'max':
+            aggregated = {metric: values[best] for metric, values in scores.items()}
+        else:
+            aggregated = {metric: np.bincount(identity, weights=values) / counts for metric, values in scores.items()}
+        return aggregated, np.asarray(scored_rows)[best], counts
+
+    @_instrumented_operation('identify_faces')
+    def identify_faces(self, probes, gallery_matrix, top_k=5, threshold=0.6, gallery_ids=None, row_mask=None,
+                       search_mode='exact', quantized_index=None, rerank_candidates=None, unique=True,
+                       aggregate=None, identity_thresholds=None):
+        """Identify several probes (e.g. every face of a group frame) against one prepared gallery"""
+        try:
+            # Decode the gallery and build the int8 index once for the whole batch
+            gallery = np.asarray(decode_feature_matrix(gallery_matrix), dtype=np.float32)
+            if gallery.ndim == 1:
+                gallery = gallery.reshape(1, -1)
+            if gallery.size > 0 and np.isnan(gallery).any():
+                gallery = np.nan_to_num(gallery, nan=0.0)
+            if search_mode == 'two_stage' and quantized_index is None and gallery.size > 0:
+                quantized_index = self.build_quantized_index(gallery)
+
+            results = [
+                self.identify(probe, gallery, top_k, threshold, gallery_ids, row_mask, search_mode,
+                              quantized_index, rerank_candidates, aggregate, identity_thresholds)
+                for probe in probes
+            ]
+
+            if unique:
+                self._assign_unique_matches(results, gallery_ids)
+
+            # Searchable rows, so callers can tell an empty gallery from a frame with no matches
+            gallery_size = gallery.shape[0] if gallery.size > 0 else 0
+            if row_mask is not None:
+                gallery_size = int(np.count_nonzero(np.asarray(row_mask, dtype=bool)[:gallery_size]))
+
+            return {
+                'success': all(result['success'] for result in results),
+                'results': results,
+                'gallery_size': gallery_size,
+                'identified': sum(1 for result in results if result.get('best_match') is not None),
+                'threshold': threshold,
+                'search_mode': search_mode
+            }
+
+        except Exception as e:
+            return {
+                'success': False,
+                'results': [],
+                'error': str(e)
+            }
+
+    @_instrumented_operation('identify_group')
+    def identify_group(self, image_path, gallery_matrix, top_k=3, threshold=0.6, gallery_ids=None, row_mask=None,
+                       search_mode='exact', quantized_index=None, rerank_candidates=None, max_faces=None):
+        """Detect every face in a classroom frame and identify each one against the gallery"""
+        group, message = self.extract_all_face_features(image_path, max_faces)
+        if group is None:
+            return {'success': False, 'message': message, 'faces': []}
+
+        batch = self.identify_faces([face['features'] for face in group['faces']], gallery_matrix, top_k, threshold,
+                                    gallery_ids, row_mask, search_mode, quantized_index, rerank_candidates)
+        return self.group_response(group, batch, message)
+
+    def group_response(self, group, batch, message):
+        """Per-face bounding boxes and matches for a group frame"""
+        if not batch['success']:
+            return {'success': False, 'message': batch.get('error') or 'Identification failed', 'faces': []}
+
+        faces = []
+        for face, result in zip(group['faces'], batch['results']):
+            entry = {
+                'face_index': face['face_index'],
+                'face_region': face['face_region'],
+                'best_match': result['best_match'],
+                'matches': result['matches']
+            }
+            if result.get('contested'):
+                entry['contested'] = True
+            if 'face_image_base64' in face:
+                entry['face_image_base64'] = face['face_image_base64']
+            faces.append(entry)
+
+        return {
+            'success': True,
+            'message': message,
+            'faces': faces,
+            'total_faces_detected': group['total_faces_detected'],
+            'identified': batch['identified'],
+            'gallery_size': batch['gallery_size'],
+            'threshold': batch['threshold'],
+            'search_mode': batch['search_mode'],
+            'detection': group['detection'],
+            **({'partition': batch['partition']} if 'partition' in batch else {})
+        }
+
+    def _assign_unique_matches(self, results, gallery_ids=None):
+        """One person appears at most once per frame: the stronger face keeps a contested identity"""
+        def identity(match):
+            return match.get('id', match['index']) if gallery_ids is not None else match['index']
+
+        # Every above-threshold (face, candidate) pair, strongest first
+        pairs = []
+        for face_pos, result in enumerate(results):
+            for match in result.get('matches', []):
+                if match['is_match']:
+                    pairs.append((-match['similarity_score'], face_pos, match['rank'], match))
+        pairs.sort(key=lambda pair: pair[:3])
+
+        assigned, taken = {}, set()
+        for _, face_pos, _, match in pairs:
+            if face_pos in assigned or identity(match) in taken:
+                continue
+            assigned[face_pos] = match
+            taken.add(identity(match))
+
+        for face_pos, result in enumerate(results):
+            original = result.get('best_match')
+            result['best_match'] = assigned.get(face_pos)
+            if original is not None and result['best_match'] is not original:
+                result['contested'] = True
+
+# Encoder shared by the module-level helpers so cascades are loaded once per process
+_shared_encoder = None
+
+def get_encoder():
+    """Return the process-wide ImageEncoder, creating it on first use"""
+    global _shared_encoder
+    if _shared_encoder is None:
+        _shared_encoder = ImageEncoder(
+            detection_mode=os.environ.get('FACE_DETECTION_MODE', 'exhaustive'),
+            encoding_format=os.environ.get('FACE_ENCODING_FORMAT', 'json')
+        )
+        if os.environ.get('FACE_METRICS', '').lower() in ('1', 'true', 'yes'):
+            _shared_encoder.enable_metrics()
+        if os.environ.get('FACE_MAX_DECODE_SIDE'):
+            _shared_encoder.max_decode_side = int(os.environ['FACE_MAX_DECODE_SIDE'])
+    return _shared_encoder
+
+def _with_timing(encoder, result):
+    """Attach the stage timing block of the last call when metrics are enabled"""
+    if encoder.metrics is not None and isinstance(result, dict):
+        result['timing'] = encoder.last_timing
+    return result
+
 def register_student_image(image_path, student_id):
     """Function to be called from PHP during student registration"""
     try:
-        encoder = ImageEncoder()
-        result = encoder.process_student_image(image_path, student_id)
+        encoder = get_encoder()
+        result = _with_timing(encoder, encoder.process_student_image(image_path, student_id))
         
         # Return JSON response
         return json.dumps(result)
@@ -580,13 +1750,13 @@ def register_student_image(image_path, student_id):
 def compare_student_faces(features1_json, features2_json, threshold=0.6):
     """Function to compare two sets of face features"""
     try:
-        encoder = ImageEncoder()
+        encoder = get_encoder()
         
-        # Parse JSON strings back to lists
-        features1 = json.loads(features1_json) if isinstance(features1_json, str) else features1_json
-        features2 = json.loads(features2_json) if isinstance(features2_json, str) else features2_json
+        # Parse JSON or compact encoded strings back to vectors
+        features1 = decode_features(features1_json)
+        features2 = decode_features(features2_json)
         
-        result = encoder.compare_faces(features1, features2, threshold)
+        result = _with_timing(encoder, encoder.compare_faces(features1, features2, threshold))
         
         return json.dumps(result)
     except Exception as e:
@@ -595,6 +1765,41 @@ def compare_student_faces(features1_json, features2_json, threshold=0.6):
             'error': f'Comparison error: {str(e)}'
         })
 
+def identify_student_face(probe_json, gallery_json, top_k=5, threshold=0.6, gallery_ids=None):
+    """Function to identify one set of face features against a list of enrolled feature sets"""
+    try:
+        encoder = get_encoder()
+
+        # Parse JSON or compact encoded strings back to vectors
+        probe = decode_features(probe_json)
+        gallery = decode_feature_matrix(gallery_json)
+
+        result = _with_timing(encoder, encoder.identify(probe, gallery, top_k, threshold, gallery_ids))
+
+        return json.dumps(result)
+    except Exception as e:
+        return json.dumps({
+            'success': False,
+            'matches': [],
+            'error': f'Identification error: {str(e)}'
+        })
+
+def identify_group_image(image_path, gallery_json, top_k=3, threshold=0.6, gallery_ids=None):
+    """Function to identify every face of a classroom frame against a list of enrolled feature sets"""
+    try:
+        encoder = get_encoder()
+
+        gallery = decode_feature_matrix(gallery_json)
+        result = _with_timing(encoder, encoder.identify_group(image_path, gallery, top_k, threshold, gallery_ids))
+
+        return json.dumps(result)
+    except Exception as e:
+        return json.dumps({
+            'success': False,
+            'faces': [],
+            'message': f'Group identification error: {str(e)}'
+        })
+
 if __name__ == "__main__":
     # Check if being called directly or as a module
     if len(sys.argv) < 2:
@@ -0,0 +1,221 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import urllib.request
+import uuid
+
+JOB_STATUSES = ('queued', 'running', 'done', 'failed')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at);
+"""
+
+
+class QueueFull(Exception):
+    """Raised by JobQueue.submit when the backlog limit is reached"""
+
+
+class JobQueue:
+    """Durable job queue in a local SQLite file; uploads are spooled next to it so jobs survive a restart"""
+
+    def __init__(self, db_path, max_pending=500):
+        self.db_path = db_path
+        self.spool_dir = os.path.splitext(db_path)[0] + '_spool'
+        self.max_pending = max_pending
+        os.makedirs(self.spool_dir, exist_ok=True)
+
+        self._local = threading.local()
+        self._connect().conn.executescript(SCHEMA)
+
+        # A job that was running when the process died is simply run again
+        self.requeue_running()
+
+    def _connect(self):
+        """One connection per thread; sqlite3 connections must not be shared across threads"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return _Transaction(conn)
+
+    def spool_upload(self, job_id, filename, content):
+        """Write an uploaded image into the spool directory and return its path"""
+        ext = os.path.splitext(filename or '')[1].lower() or '.jpg'
+        path = os.path.join(self.spool_dir, job_id + ext)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def new_job_id(self):
+        return uuid.uuid4().hex
+
+    def submit(self, kind, payload, job_id=None):
+        """Queue a job and return its id; raises QueueFull when max_pending jobs are waiting"""
+        job_id = job_id or self.new_job_id()
+        with self._connect() as conn:
+            pending = conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+            if pending >= self.max_pending:
+                raise QueueFull(f'{pending} jobs pending')
+            conn.execute(
+                "INSERT INTO jobs (id, kind, status, payload, created_at) VALUES (?, ?, 'queued', ?, ?)",
+                (job_id, kind, json.dumps(payload), time.time())
+            )
+        return job_id
+
+    def claim(self):
+        """Atomically move the oldest queued job to 'running'; returns it or None"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1 WHERE id = ?",
+                (time.time(), row['id'])
+            )
+            return self._row_to_job(conn.execute('SELECT * FROM jobs WHERE id = ?', (row['id'],)).fetchone())
+
+    def complete(self, job_id, result):
+        """Store a finished job's result; unsuccessful results are recorded as 'failed'"""
+        status = 'done' if result.get('success') else 'failed'
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?",
+                (status, json.dumps(result), None if status == 'done' else result.get('message'), time.time(), job_id)
+            )
+        return status
+
+    def fail(self, job_id, error):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                (error, time.time(), job_id)
+            )
+
+    def requeue_running(self):
+        with self._connect() as conn:
+            return conn.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'").rowcount
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            return self._row_to_job(conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone())
+
+    def counts(self):
+        with self._connect() as conn:
+            rows = conn.execute('SELECT status, COUNT(*) AS n FROM jobs GROUP BY status').fetchall()
+        counts = {status: 0 for status in JOB_STATUSES}
+        counts.update({row['status']: row['n'] for row in rows})
+        return counts
+
+    def purge(self, older_than_seconds=7 * 24 * 3600):
+        """Delete finished jobs older than the cutoff"""
+        with self._connect() as conn:
+            return conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+                (time.time() - older_than_seconds,)
+            ).rowcount
+
+    def _row_to_job(self, row):
+        if row is None:
+            return None
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+
+class _Transaction:
+    """Context manager running a block in one IMMEDIATE transaction (serializes writers across processes)"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+        return False
+
+
+class JobWorkerPool:
+    """Background threads that claim jobs and run handler(job) -> result dict"""
+
+    def __init__(self, job_queue, handler, workers=2, poll_interval=0.2, callback_timeout=10, on_finished=None):
+        self.queue = job_queue
+        self.handler = handler
+        self.on_finished = on_finished  # Called with the job once its outcome is stored
+        self.workers = max(1, int(workers))
+        self.poll_interval = poll_interval
+        self.callback_timeout = callback_timeout
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'registration-job-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def notify(self):
+        """Wake idle workers after a submit instead of waiting for the next poll"""
+        self._wakeup.set()
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            job = self.queue.claim()
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            try:
+                result = self.handler(job)
+                status = self.queue.complete(job['id'], result)
+            except Exception as e:
+                result, status = {'success': False, 'message': f'Job error: {str(e)}', 'data': None}, 'failed'
+                self.queue.fail(job['id'], result['message'])
+
+            if self.on_finished is not None:
+                self.on_finished(job)
+
+            if job['payload'].get('callback_url'):
+                self._post_callback(job, status, result)
+
+    def _post_callback(self, job, status, result, retries=3):
+        """Best-effort push of the finished job to the caller's callback URL"""
+        body = json.dumps({'job_id': job['id'], 'status': status, 'result': result}).encode('utf-8')
+        for attempt in range(retries):
+            try:
+                request = urllib.request.Request(job['payload']['callback_url'], data=body,
+                                                 headers={'Content-Type': 'application/json'})
+                with urllib.request.urlopen(request, timeout=self.callback_timeout):
+                    return True
+            except Exception:
+                time.sleep(0.5 * (attempt + 1))
+        return False
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class ResultCache:
+    """LRU cache of encoder results keyed by image content hash, with an optional on-disk tier
+
+    Values are stored as JSON text, so every hit hands out a fresh copy that
+    callers may modify without affecting the cache.
+    """
+
+    def __init__(self, max_entries=256, cache_dir=None):
+        self.max_entries = max(1, int(max_entries))
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def content_hash(image_path, chunk_size=1 << 20):
+        """SHA-256 of the file contents"""
+        digest = hashlib.sha256()
+        with open(image_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def bytes_hash(data, salt=''):
+        """SHA-256 of in-memory image content (salt distinguishes decoded arrays by shape and dtype)"""
+        digest = hashlib.sha256(salt.encode('utf-8'))
+        digest.update(data)
+        return digest.hexdigest()
+
+    @staticmethod
+    def make_key(content_hash, kind, config):
+        """Cache key for one kind of result under one extractor configuration"""
+        config_hash = hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        return f'{content_hash}-{config_hash}-{kind}'
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def get(self, key):
+        """Cached value for key, or None"""
+        with self._lock:
+            text = self._entries.get(key)
+            if text is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(text)
+
+        if self.cache_dir:
+            try:
+                with open(self._disk_path(key), 'r') as f:
+                    text = f.read()
+                value = json.loads(text)
+            except (OSError, ValueError):
+                value = None
+            if value is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                    self._remember(key, text)
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """Store a JSON-serializable value in memory and, if configured, on disk"""
+        text = json.dumps(value)
+        with self._lock:
+            self._remember(key, text)
+
+        if self.cache_dir:
+            path = self._disk_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write-then-rename so concurrent readers (other workers) never see a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+
+    def _remember(self, key, text):
+        self._entries[key] = text
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """Drop the in-memory tier; the on-disk tier is left in place"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round((self.hits + self.disk_hits) / float(lookups), 4) if lookups else 0.0,
+                'cache_dir': self.cache_dir
+            }
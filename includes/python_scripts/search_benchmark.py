@@ -0,0 +1,119 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from opencv_face_encoder import ImageEncoder
+
+DEFAULT_UPLOADS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'uploads')
+
+
+def load_seed_encodings(encoder, uploads_dir):
+    """Encode every bundled upload image that has a detectable face"""
+    seeds = []
+    for path in sorted(glob.glob(os.path.join(uploads_dir, '*', '*'))):
+        face_data, _ = encoder.extract_face_features(path)
+        if face_data is not None:
+            seeds.append(face_data['features'])
+    return np.array(seeds, dtype=np.float32)
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return (matrix / np.where(norms > 1e-6, norms, 1.0)).astype(np.float32)
+
+
+def synthesize_gallery(seeds, size, rng, identity_noise=0.02):
+    """Synthetic identities: mixtures of two real encodings plus noise, L2-normalized like real features"""
+    first = seeds[rng.integers(0, len(seeds), size)]
+    second = seeds[rng.integers(0, len(seeds), size)]
+    weights = rng.random((size, 1), dtype=np.float32)
+    mixed = weights * first + (1 - weights) * second
+    mixed += rng.normal(0, identity_noise, mixed.shape).astype(np.float32)
+    return _normalize_rows(np.abs(mixed))
+
+
+def synthesize_probes(gallery, count, rng, capture_noise=0.01):
+    """New 'captures' of random enrolled identities; returns (probes, true row indices)"""
+    rows = rng.integers(0, len(gallery), count)
+    probes = gallery[rows] + rng.normal(0, capture_noise, (count, gallery.shape[1])).astype(np.float32)
+    return _normalize_rows(np.abs(probes)), rows
+
+
+def run_benchmark(sizes, probes_per_size=50, top_k=5, rerank_candidates=64, uploads_dir=DEFAULT_UPLOADS_DIR, seed=0):
+    """Compare exact and two-stage identification: recall against exact search and latency"""
+    encoder = ImageEncoder(detection_mode='tiered')
+    encoder.rerank_candidates = rerank_candidates
+    seeds = load_seed_encodings(encoder, uploads_dir)
+    if len(seeds) == 0:
+        raise RuntimeError(f'No face encodings could be extracted from {uploads_dir}')
+
+    rng = np.random.default_rng(seed)
+    results = []
+
+    for size in sizes:
+        gallery = synthesize_gallery(seeds, size, rng)
+        probes, truth = synthesize_probes(gallery, probes_per_size, rng)
+
+        started = time.perf_counter()
+        codes = encoder.build_quantized_index(gallery)
+        index_build_ms = (time.perf_counter() - started) * 1000
+
+        exact_ms, two_stage_ms = [], []
+        recall_hits, rank1_agree, exact_rank1_correct, two_stage_rank1_correct = 0, 0, 0, 0
+
+        for probe, true_row in zip(probes, truth):
+            started = time.perf_counter()
+            exact = encoder.identify(probe, gallery, top_k)
+            exact_ms.append((time.perf_counter() - started) * 1000)
+
+            started = time.perf_counter()
+            approx = encoder.identify(probe, gallery, top_k, search_mode='two_stage', quantized_index=codes)
+            two_stage_ms.append((time.perf_counter() - started) * 1000)
+
+            exact_rows = [match['index'] for match in exact['matches']]
+            approx_rows = [match['index'] for match in approx['matches']]
+            recall_hits += len(set(exact_rows) & set(approx_rows))
+            rank1_agree += int(exact_rows[0] == approx_rows[0])
+            exact_rank1_correct += int(exact_rows[0] == true_row)
+            two_stage_rank1_correct += int(approx_rows[0] == true_row)
+
+        results.append({
+            'gallery_size': size,
+            'probes': probes_per_size,
+            'top_k': top_k,
+            'rerank_candidates': rerank_candidates,
+            'recall_at_k_vs_exact': round(recall_hits / float(probes_per_size * top_k), 4),
+            'rank1_agreement_vs_exact': round(rank1_agree / float(probes_per_size), 4),
+            'exact_rank1_accuracy': round(exact_rank1_correct / float(probes_per_size), 4),
+            'two_stage_rank1_accuracy': round(two_stage_rank1_correct / float(probes_per_size), 4),
+            'exact_p50_ms': round(float(np.percentile(exact_ms, 50)), 3),
+            'exact_p95_ms': round(float(np.percentile(exact_ms, 95)), 3),
+            'two_stage_p50_ms': round(float(np.percentile(two_stage_ms, 50)), 3),
+            'two_stage_p95_ms': round(float(np.percentile(two_stage_ms, 95)), 3),
+            'index_build_ms': round(index_build_ms, 2),
+            'gallery_float32_mb': round(gallery.nbytes / 1e6, 2),
+            'index_int8_mb': round(codes.nbytes / 1e6, 2)
+        })
+
+    return {'seed_encodings': int(len(seeds)), 'results': results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Recall and latency of two-stage (int8 + re-rank) vs exact identification')
+    parser.add_argument('--sizes', default='1000,5000,20000', help='Comma-separated gallery sizes')
+    parser.add_argument('--probes', type=int, default=50)
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--rerank-candidates', type=int, default=64)
+    parser.add_argument('--uploads', default=DEFAULT_UPLOADS_DIR, help='Directory holding students/ and lecturers/ images')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    report = run_benchmark(sizes, args.probes, args.top_k, args.rerank_candidates, args.uploads, args.seed)
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
@@ -0,0 +1,68 @@
+"""Vectorized grid/gradient features against the loop and cv2.Sobel reference implementations
+
+Run from includes/python_scripts: python -m pytest -q tests
+"""
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from opencv_face_encoder import ImageEncoder  # noqa: E402
+
+# (height, width): the encoder's 100x100 crop, odd sizes with uneven 6x6 regions, and a tiny crop
+CROP_SHAPES = [(100, 100), (97, 103), (75, 61), (13, 17)]
+
+
+def _crops():
+    rng = np.random.default_rng(1234)
+    crops = []
+    for shape in CROP_SHAPES:
+        crops.append((f'random{shape[0]}x{shape[1]}', rng.integers(0, 256, shape, dtype=np.uint8)))
+        # Smooth crops exercise small gradients, where summation order matters most
+        smooth = cv2.GaussianBlur(rng.integers(0, 256, shape, dtype=np.uint8), (7, 7), 0)
+        crops.append((f'smooth{shape[0]}x{shape[1]}', smooth))
+    for value in (0, 128, 255):
+        crops.append((f'constant{value}', np.full((100, 100), value, dtype=np.uint8)))
+    crops.append(('constant128_odd', np.full((97, 103), 128, dtype=np.uint8)))
+    return crops
+
+
+CROPS = _crops()
+
+
+@pytest.fixture(params=[True, False], ids=['buffers', 'no_buffers'])
+def encoder(request):
+    encoder = ImageEncoder()
+    encoder.reuse_buffers = request.param
+    return encoder
+
+
+@pytest.mark.parametrize('name,crop', CROPS, ids=[name for name, _ in CROPS])
+def test_vectorized_grid_features_match_loop(encoder, name, crop):
+    vectorized = encoder._extract_simple_lbp_features(crop)
+    reference = encoder._extract_simple_lbp_features_loop(crop)
+
+    assert len(vectorized) == len(reference) == 144
+    np.testing.assert_allclose(vectorized, reference, rtol=1e-9, atol=1e-9)
+
+
+@pytest.mark.parametrize('name,crop', CROPS, ids=[name for name, _ in CROPS])
+def test_sobel_gradients_match_cv2(encoder, name, crop):
+    gradients = encoder._compute_face_gradients(crop)
+    assert gradients is not None
+
+    np.testing.assert_allclose(gradients['grad_x'], cv2.Sobel(crop, cv2.CV_64F, 1, 0, ksize=3), atol=1e-9)
+    np.testing.assert_allclose(gradients['grad_y'], cv2.Sobel(crop, cv2.CV_64F, 0, 1, ksize=3), atol=1e-9)
+
+
+@pytest.mark.parametrize('name,crop', CROPS, ids=[name for name, _ in CROPS])
+def test_gradient_stats_match_cv2(encoder, name, crop):
+    # Without precomputed gradients the feature falls back to cv2.Sobel
+    shared = encoder._extract_gradient_features(crop, encoder._compute_face_gradients(crop))
+    reference = encoder._extract_gradient_features(crop)
+
+    np.testing.assert_allclose(shared, reference, rtol=1e-9, atol=1e-9)
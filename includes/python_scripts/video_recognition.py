@@ -0,0 +1,278 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from opencv_face_encoder import DETECTION_MODES, ImageEncoder, decode_feature_matrix
+
+FRAME_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def iter_frames(source, max_frames=None):
+    """Yield (frame_number, BGR frame) from a directory of frames, a video file, a stream URL or a webcam index"""
+    count = 0
+    if os.path.isdir(source):
+        paths = sorted(path for path in glob.glob(os.path.join(source, '*'))
+                       if path.lower().endswith(FRAME_EXTENSIONS))
+        for path in paths:
+            if max_frames is not None and count >= max_frames:
+                return
+            frame = cv2.imread(path)
+            if frame is None:
+                continue
+            yield count, frame
+            count += 1
+        return
+
+    # VideoCapture handles files, MJPEG/RTSP URLs and (as an integer) local cameras
+    capture = cv2.VideoCapture(int(source) if str(source).isdigit() else source)
+    if not capture.isOpened():
+        raise IOError(f'Could not open video source: {source}')
+    try:
+        while max_frames is None or count < max_frames:
+            ok, frame = capture.read()
+            if not ok:
+                return
+            yield count, frame
+            count += 1
+    finally:
+        capture.release()
+
+
+def _iou(a, b):
+    """Intersection over union of two (x, y, w, h) boxes"""
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    ix = max(0, min(ax + aw, bx + bw) - max(ax, bx))
+    iy = max(0, min(ay + ah, by + bh) - max(ay, by))
+    inter = ix * iy
+    union = aw * ah + bw * bh - inter
+    return inter / float(union) if union > 0 else 0.0
+
+
+class FaceTrack:
+    """One face followed across frames; it is identified once, not once per frame"""
+
+    def __init__(self, track_id, box, gray, frame_number):
+        self.track_id = track_id
+        self.box = tuple(int(v) for v in box)
+        self.first_frame = frame_number
+        self.last_frame = frame_number
+        self.hits = 1
+        self.missed_detections = 0
+        self.identity = None
+        self.identify_attempts = 0
+        self.template = self._crop(gray)
+
+    def _crop(self, gray):
+        x, y, w, h = self.box
+        return gray[y:y + h, x:x + w].copy()
+
+    def update_from_detection(self, box, gray, frame_number):
+        self.box = tuple(int(v) for v in box)
+        self.last_frame = frame_number
+        self.hits += 1
+        self.missed_detections = 0
+        self.template = self._crop(gray)
+
+    def follow(self, gray, frame_number, search_margin=0.5, min_score=0.5):
+        """Move the box between detections by matching the last face crop in a window around it"""
+        x, y, w, h = self.box
+        if self.template.size == 0:
+            return False
+
+        margin_x, margin_y = int(w * search_margin), int(h * search_margin)
+        x0, y0 = max(0, x - margin_x), max(0, y - margin_y)
+        x1, y1 = min(gray.shape[1], x + w + margin_x), min(gray.shape[0], y + h + margin_y)
+        window = gray[y0:y1, x0:x1]
+        if window.shape[0] < self.template.shape[0] or window.shape[1] < self.template.shape[1]:
+            return False
+
+        scores = cv2.matchTemplate(window, self.template, cv2.TM_CCOEFF_NORMED)
+        _, best_score, _, best_loc = cv2.minMaxLoc(scores)
+        if best_score < min_score:
+            return False
+
+        self.box = (x0 + best_loc[0], y0 + best_loc[1], w, h)
+        self.last_frame = frame_number
+        return True
+
+
+class VideoRecognizer:
+    """Generator pipeline: decode -> detect every N frames -> track -> extract once per face -> identify"""
+
+    def __init__(self, encoder=None, gallery=None, gallery_matrix=None, gallery_ids=None, detect_every=5,
+                 threshold=0.6, search_mode='exact', partition=None, candidate_ids=None,
+                 iou_match=0.3, max_missed_detections=2, max_identify_attempts=3):
+        if gallery is None and gallery_matrix is None:
+            raise ValueError('A FaceGallery or a gallery matrix is required')
+
+        self.encoder = encoder or ImageEncoder(detection_mode='tiered')
+        self.gallery = gallery
+        self.gallery_matrix = None if gallery_matrix is None else np.asarray(
+            decode_feature_matrix(gallery_matrix), dtype=np.float32)
+        self.gallery_ids = gallery_ids
+        self.detect_every = max(1, int(detect_every))
+        self.threshold = threshold
+        self.search_mode = search_mode
+        self.partition = partition
+        self.candidate_ids = candidate_ids
+        self.iou_match = iou_match
+        self.max_missed_detections = max_missed_detections
+        self.max_identify_attempts = max_identify_attempts
+
+        self.quantized_index = None
+        if self.gallery_matrix is not None and search_mode == 'two_stage':
+            self.quantized_index = self.encoder.build_quantized_index(self.gallery_matrix)
+
+        self.tracks = {}
+        self._next_track_id = 1
+        self.stats = {}
+
+    def _identify(self, features):
+        if self.gallery is not None:
+            return self.gallery.identify(self.encoder, features, 1, self.threshold, self.search_mode,
+                                         candidate_ids=self.candidate_ids, partition=self.partition)
+        return self.encoder.identify(features, self.gallery_matrix, 1, self.threshold, self.gallery_ids,
+                                     search_mode=self.search_mode, quantized_index=self.quantized_index)
+
+    def _associate(self, faces, gray, frame_number):
+        """Greedy IoU matching of fresh detections to live tracks; returns the new tracks"""
+        pairs = sorted(
+            ((_iou(track.box, face), track_id, i)
+             for track_id, track in self.tracks.items() for i, face in enumerate(faces)),
+            reverse=True
+        )
+        matched_tracks, matched_faces = set(), set()
+        for overlap, track_id, i in pairs:
+            if overlap < self.iou_match:
+                break
+            if track_id in matched_tracks or i in matched_faces:
+                continue
+            self.tracks[track_id].update_from_detection(faces[i], gray, frame_number)
+            matched_tracks.add(track_id)
+            matched_faces.add(i)
+
+        for track_id, track in self.tracks.items():
+            if track_id not in matched_tracks:
+                track.missed_detections += 1
+
+        new_tracks = []
+        for i, face in enumerate(faces):
+            if i not in matched_faces:
+                track = FaceTrack(self._next_track_id, face, gray, frame_number)
+                self.tracks[track.track_id] = track
+                self._next_track_id += 1
+                new_tracks.append(track)
+        return new_tracks
+
+    def _track_event(self, event, track, frame_number, **extra):
+        x, y, w, h = track.box
+        record = {
+            'event': event,
+            'track_id': track.track_id,
+            'frame': frame_number,
+            'face_region': {'x': int(x), 'y': int(y), 'width': int(w), 'height': int(h)}
+        }
+        record.update(extra)
+        return record
+
+    def run(self, frames):
+        """Consume (frame_number, frame) pairs and yield identification and track events"""
+        started = time.perf_counter()
+        frame_count = detections_run = identifications_run = 0
+
+        for frame_number, frame in frames:
+            frame_count += 1
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+
+            if frame_number % self.detect_every == 0:
+                # 1. Detection frame: refresh boxes and start tracks for new faces
+                faces = self.encoder._detect_faces_multiple_methods(gray)
+                detections_run += 1
+                self._associate(list(faces), gray, frame_number)
+
+                for track_id in [tid for tid, track in self.tracks.items()
+                                 if track.missed_detections > self.max_missed_detections]:
+                    track = self.tracks.pop(track_id)
+                    yield self._track_event('track_ended', track, frame_number,
+                                            identity=track.identity, frames_seen=track.last_frame - track.first_frame + 1)
+            else:
+                # 2. Between detections: follow each box by template matching
+                for track in self.tracks.values():
+                    if track.missed_detections == 0:
+                        track.follow(gray, frame_number)
+
+            # 3. Extract and identify once per tracked face (retrying a few times while unmatched)
+            for track in self.tracks.values():
+                if track.identity is not None or track.identify_attempts >= self.max_identify_attempts:
+                    continue
+                if track.last_frame != frame_number or frame_number % self.detect_every != 0:
+                    continue  # Only identify from fresh detector boxes
+
+                features, _, _ = self.encoder._extract_face_region(gray, track.box)
+                result = self._identify(features)
+                track.identify_attempts += 1
+                identifications_run += 1
+
+                best = result.get('best_match')
+                if best is not None:
+                    track.identity = best.get('id', best['index'])
+                    yield self._track_event('identified', track, frame_number, match=best,
+                                            attempts=track.identify_attempts)
+                elif track.identify_attempts >= self.max_identify_attempts:
+                    top = result['matches'][0] if result.get('matches') else None
+                    yield self._track_event('unrecognized', track, frame_number, best_candidate=top)
+
+        for track in self.tracks.values():
+            yield self._track_event('track_ended', track, track.last_frame,
+                                    identity=track.identity, frames_seen=track.last_frame - track.first_frame + 1)
+        self.tracks = {}
+
+        elapsed = time.perf_counter() - started
+        self.stats = {
+            'frames': frame_count,
+            'detections_run': detections_run,
+            'identifications_run': identifications_run,
+            'tracks_created': self._next_track_id - 1,
+            'elapsed_seconds': round(elapsed, 3),
+            'sustained_fps': round(frame_count / elapsed, 2) if elapsed > 0 else 0.0
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Streaming face recognition over a video, MJPEG stream or frame directory')
+    parser.add_argument('source', help='Video file, stream URL, webcam index or directory of frames')
+    gallery_source = parser.add_mutually_exclusive_group(required=True)
+    gallery_source.add_argument('--gallery', help='Gallery directory (see face_gallery.py)')
+    gallery_source.add_argument('--gallery-json', help='JSON file with {"gallery": [...], "ids": [...]}')
+    parser.add_argument('--partition', help='Gallery partition to search, e.g. course:7:2024/2025:first')
+    parser.add_argument('--detect-every', type=int, default=5, help='Run the face detector every N frames')
+    parser.add_argument('--detection-mode', choices=DETECTION_MODES, default='tiered')
+    parser.add_argument('--search-mode', choices=('exact', 'two_stage'), default='exact')
+    parser.add_argument('--threshold', type=float, default=0.6)
+    parser.add_argument('--max-frames', type=int, default=None)
+    args = parser.parse_args()
+
+    encoder = ImageEncoder(detection_mode=args.detection_mode)
+    if args.gallery:
+        from face_gallery import FaceGallery
+        recognizer = VideoRecognizer(encoder, gallery=FaceGallery(args.gallery), detect_every=args.detect_every,
+                                     threshold=args.threshold, search_mode=args.search_mode, partition=args.partition)
+    else:
+        with open(args.gallery_json, 'r') as f:
+            gallery_data = json.load(f)
+        recognizer = VideoRecognizer(encoder, gallery_matrix=gallery_data['gallery'], gallery_ids=gallery_data.get('ids'),
+                                     detect_every=args.detect_every, threshold=args.threshold,
+                                     search_mode=args.search_mode)
+
+    for event in recognizer.run(iter_frames(args.source, args.max_frames)):
+        sys.stdout.write(json.dumps(event) + '\n')
+        sys.stdout.flush()
+
+    sys.stderr.write(json.dumps({'summary': recognizer.stats}) + '\n')
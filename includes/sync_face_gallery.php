@@ -0,0 +1,32 @@
+<?php
+/**
+ * Bring the encoder's resident gallery up to date with the students table
+ *
+ * Registration syncs the new student straight away; this catches everything
+ * else (deactivations, edits, failed syncs). Run it from cron every few minutes:
+ *
+ *   php includes/sync_face_gallery.php [api_url]
+ */
+
+if (php_sapi_name() !== 'cli') {
+    http_response_code(403);
+    exit("Run from the command line\n");
+}
+
+require_once __DIR__ . '/../config/database.php';
+require_once __DIR__ . '/FaceRecognitionManager.php';
+
+$api_url = $argv[1] ?? 'https://facerecognitionapi-24ec.onrender.com';
+
+$db = new Database();
+$conn = $db->getConnection();
+
+$faceManager = new FaceRecognitionManager($conn, false, $api_url);
+$result = $faceManager->syncGallery();
+
+if (!$result['success']) {
+    fwrite(STDERR, "Gallery sync failed: " . $result['message'] . "\n");
+    exit(1);
+}
+
+echo "Gallery synced up to {$result['high_water_mark']}: " . json_encode($result['data']) . "\n";
@@ -243,8 +243,12 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST' && isset($_POST['action']) && $_POST['
                             $faceManager = new FaceRecognitionManager($conn, debug:true, api_url:'https://facerecognitionapi-24ec.onrender.com');
 
 
-                            // Recognize student from captured image
-                            $recognitionResult = $faceManager->recognizeStudentForAttendance($temp_img_path, 'sc.student_id');
+                            // Recognize student from captured image, searching only students enrolled in this course
+                            $recognitionResult = $faceManager->recognizeStudentForAttendance($temp_img_path, 'sc.student_id', [
+                                'course_id' => $selected_course['course_id'],
+                                'session_year' => $current_session,
+                                'semester' => $current_semester
+                            ]);
 
                             if ($recognitionResult['success']) {
                                 $recognition_result = $recognitionResult;
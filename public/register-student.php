@@ -250,6 +250,13 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST') {
                 $debug_info[] = "- Image path saved: " . $insertedData['image_path'];
             }
 
+            // Enroll just this student in the encoder's resident gallery (short timeout);
+            // anything missed is picked up by the cron sync (includes/sync_face_gallery.php)
+            $enrollResult = $faceManager->enrollStudentInGallery($conn->lastInsertId());
+            if (!$enrollResult['success']) {
+                error_log("Gallery enrollment after registration of {$reg_number} failed: " . $enrollResult['message']);
+            }
+
             header("Location: login.php?role=student&success=1");
             exit;
 